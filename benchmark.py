@@ -0,0 +1,571 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from datetime import timezone, datetime, timedelta
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+from timescaledb_util import TimeScaleDBUtil
+from parquet_store_util import ParquetStoreUtil
+from trades_download_util import TradesDownloadUtil
+from trade_stream_util import BinanceWebSocketTradeStream
+from window_controller_util import WindowDensityStore
+from dollarbar_generate_util import DollarbarGenerateUtil, dollarbar_aggregate, aggregate_dollarbars
+from fixedpoint_util import compute_dollar_cumsums, compute_dollar_cumsums_decimal, fixedpoint_to_decimal, get_decimal_value
+
+def generate_synthetic_trades(rows=100_000, seed=0):
+    """
+    ベンチマーク用に約定テーブルと同じ列を持つ合成約定データを作る関数
+    パラメータ
+    ----------
+    rows : int, default = 100_000
+        生成する約定の件数。
+    seed : int, default = 0
+        乱数のシード。
+
+    返り値
+    -------
+    df : pandas.DataFrame
+        約定テーブルと同じ列を持つデータフレーム。数値列はDecimal。
+    """
+    _rng = np.random.default_rng(seed)
+    _start = datetime(2021, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+
+    _prices = np.round(30000 + np.cumsum(_rng.normal(0, 5, rows)), 1)
+    _amounts = np.round(_rng.exponential(0.05, rows) + 0.001, 3)
+    _sides = np.where(_rng.random(rows) < 0.5, 'buy', 'sell')
+
+    _df = pd.DataFrame({
+        'datetime': [_start + timedelta(milliseconds=int(i)) for i in range(rows)],
+        'id': [str(i) for i in range(rows)],
+        'side': _sides,
+        'liquidation': _rng.random(rows) < 0.01,
+        'price': [Decimal(f'{p:.1f}') for p in _prices],
+        'amount': [Decimal(f'{a:.3f}') for a in _amounts],
+    })
+    _df['dollar'] = _df['price'] * _df['amount']
+    _df['dollar_cumsum'] = _df['dollar'].cumsum()
+    _df['buy_dollar_cumsum'] = _df['dollar'].where(_df['side'] == 'buy', Decimal(0)).cumsum()
+    _df['sell_dollar_cumsum'] = _df['dollar'].where(_df['side'] == 'sell', Decimal(0)).cumsum()
+    return _df
+
+class FakeCcxtExchange:
+    """
+    ベンチマーク用のccxtクライアントの代わり。binanceと同じパラメータ(startTime, endTime, limit)で決まった合成約定を返す
+    TradesDownloadUtilはワーカースレッドごとにtype(client)(config)でクライアントを作り直すので、約定の設定はcreateで作るサブクラスの属性に持つ。
+    """
+    id = 'binance'
+    rateLimit = 0.001
+    rows = 100_000
+    trades_per_second = 50
+    latency = 0.0
+    start_timestamp_ms = 0
+    timestamps_ms = None
+
+    def __init__(self, config={}):
+        self.markets = {'BTC/USDT': {'symbol': 'BTC/USDT', 'precision': {'price': 1, 'amount': 3}}}
+        self.currencies = {}
+
+    @classmethod
+    def create(cls, rows=100_000, trades_per_second=50, latency=0.0, burst_ratio=1, live_seconds=0):
+        """
+        現在時刻までのrows件の約定を、1秒あたりtrades_per_second件の間隔で返すクライアントのクラスを作る関数
+        パラメータ
+        ----------
+        rows : int, default = 100_000
+            約定の件数。
+        trades_per_second : int, default = 50
+            1秒あたりの約定の件数。
+        latency : float, default = 0.0
+            fetch_tradesの1回ごとに待つ秒数。取引所APIの応答時間の代わり。
+        burst_ratio : int, default = 1
+            1より大きい場合、約定の頻度がtrades_per_second件の期間とその倍の期間を10分ごとに繰り返す。
+        live_seconds : int, default = 0
+            現在時刻からlive_seconds秒後まで、1秒あたりtrades_per_second件の約定を追加する。
+            これらの約定はfetch_tradesでは時刻が来たものだけが返り、FakeTradeWebSocketServerから配信される。
+
+        返り値
+        -------
+        FakeCcxtExchangeのサブクラス。request_countにfetch_tradesの呼び出し回数が記録される。
+        """
+        # 約定の時刻は頻度の異なる期間を交互に並べて作る
+        _regime_rows = trades_per_second * 600
+        _rates = np.where((np.arange(rows) // _regime_rows) % 2 == 1, trades_per_second * burst_ratio, trades_per_second)
+        _offsets_ms = np.floor(np.cumsum(1000 / _rates)).astype(np.int64)
+        _now_ms = int(time.time() * 1000)
+        _start_timestamp_ms = _now_ms - int(_offsets_ms[-1]) - 1000
+        _live_offsets_ms = np.floor(np.arange(1, live_seconds * trades_per_second + 1) * 1000 / trades_per_second).astype(np.int64)
+        return type('FakeCcxtExchange', (cls,), {
+            'rows': rows,
+            'trades_per_second': trades_per_second,
+            'latency': latency,
+            'start_timestamp_ms': _start_timestamp_ms,
+            'timestamps_ms': np.concatenate([_start_timestamp_ms + _offsets_ms, _now_ms + _live_offsets_ms]),
+            'request_count': 0,
+            '_lock': threading.Lock(),
+        })
+
+    @classmethod
+    def get_start_datetime(cls):
+        return datetime.fromtimestamp(cls.start_timestamp_ms / 1000, tz=timezone.utc)
+
+    @classmethod
+    def get_trade(cls, k):
+        # k番目の約定の(売買方向, 価格, 数量)
+        return 'buy' if (k * 7) % 10 < 5 else 'sell', 30000 + ((k * 7919) % 2001 - 1000) / 10, ((k * 104729) % 997 + 1) / 1000
+
+    def load_markets(self):
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.markets = markets
+
+    def market(self, symbol):
+        return self.markets[symbol]
+
+    def fetch_trades(self, symbol, since=None, limit=None, params={}):
+        with self._lock:
+            type(self).request_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        # startTime <= timestamp <= endTime の約定を古い順にlimit件まで返す
+        _first = int(np.searchsorted(self.timestamps_ms, params['startTime'], side='left'))
+        # まだ時刻が来ていない約定は返さない
+        _end_time = min(params['endTime'], int(time.time() * 1000))
+        _last = int(np.searchsorted(self.timestamps_ms, _end_time, side='right')) - 1
+        _last = min(_last, _first + params.get('limit', 1000) - 1)
+
+        _trades = []
+        for k in range(_first, _last + 1):
+            _timestamp = int(self.timestamps_ms[k])
+            _side, _price, _amount = self.get_trade(k)
+            _trades.append({
+                'info': {},
+                'id': str(k),
+                'timestamp': _timestamp,
+                'datetime': datetime.fromtimestamp(_timestamp / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+                'symbol': symbol,
+                'side': _side,
+                'price': _price,
+                'amount': _amount,
+            })
+        return _trades
+
+class InMemoryTradeStore:
+    """
+    ベンチマーク用のTimeScaleDBUtilの代わり。書き込まれたデータフレームをメモリ上に保持するだけで、ダウンロード処理だけの速度を計測できる
+    write_latencyを指定すると、df_to_sqlの1回ごとにその秒数だけ待ってDBの書き込み時間を模擬する。
+    """
+    def __init__(self, write_latency=0.0):
+        self._write_latency = write_latency
+        self._tables = {}
+        self._checkpoints = {}
+
+    def get_trade_table_name(self, exchange, symbol):
+        return (f'{exchange}_{symbol}_trade').lower()
+
+    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False):
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        if _table_name not in self._tables or force == True:
+            self._tables[_table_name] = []
+
+    def get_latest_trade(self, exchange='binance', symbol='BTC/USDT'):
+        _dfs = self._tables.get(self.get_trade_table_name(exchange, symbol), [])
+        if len(_dfs) <= 0:
+            return None
+        _df = fixedpoint_to_decimal(_dfs[-1].iloc[-1:])
+        return _df.assign(datetime=pd.to_datetime(_df['datetime'], utc=True)).iloc[0]
+
+    def df_to_sql(self, df=None, schema=None, if_exists='fail', method=None, on_conflict_do_nothing=True, checkpoint=None):
+        if df is None or df.empty or schema == None:
+            return
+        if self._write_latency > 0:
+            time.sleep(self._write_latency)
+        self._tables.setdefault(schema, []).append(df)
+        if checkpoint is not None:
+            self._checkpoints[(checkpoint['exchange'], checkpoint['symbol'])] = pd.Series(checkpoint)
+        return len(df)
+
+    def get_trade_checkpoint(self, exchange='binance', symbol='BTC/USDT'):
+        return self._checkpoints.get((exchange, symbol))
+
+    def count_rows(self, table_name):
+        return sum([len(_df) for _df in self._tables.get(table_name, [])])
+
+    def read_table(self, table_name):
+        # 書き込まれた全てのデータフレームを、数値列をDecimalにしてつなげる
+        return pd.concat([fixedpoint_to_decimal(_df) for _df in self._tables.get(table_name, [])], ignore_index=True)
+
+class FakeTradeWebSocketServer:
+    """
+    ベンチマーク用のBinanceのTrade Streamsの代わり。FakeCcxtExchange.createのlive_secondsで追加した約定を、その時刻にbinanceと同じ形式で配信するローカルのWebSocketサーバー
+    パラメータ
+    ----------
+    exchange_class : FakeCcxtExchange, 必須
+        配信する約定を持つFakeCcxtExchange.createのクラス。
+    disconnect_after : int, default = None
+        1回の接続でこの件数を配信したら接続を切る。再接続とRESTでの取りこぼしの取得を試すために使う。
+    """
+    def __init__(self, exchange_class=None, disconnect_after=None):
+        self._exchange_class = exchange_class
+        self._disconnect_after = disconnect_after
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.url = None
+        self.connection_count = 0
+
+    async def _handle(self, request):
+        _ws = web.WebSocketResponse()
+        await _ws.prepare(request)
+        self.connection_count += 1
+
+        # 接続した時刻より後の約定を配信する
+        _timestamps_ms = self._exchange_class.timestamps_ms
+        _k = int(np.searchsorted(_timestamps_ms, int(time.time() * 1000), side='right'))
+        _sent = 0
+        while _k < len(_timestamps_ms) and (self._disconnect_after is None or _sent < self._disconnect_after):
+            _timestamp = int(_timestamps_ms[_k])
+            await asyncio.sleep(max(0, _timestamp / 1000 - time.time()))
+            _side, _price, _amount = self._exchange_class.get_trade(_k)
+            await _ws.send_str(json.dumps({'e': 'trade', 'E': _timestamp, 's': 'BTCUSDT', 't': _k, 'p': f'{_price:.1f}', 'q': f'{_amount:.3f}', 'T': _timestamp, 'm': _side == 'sell'}))
+            _k += 1
+            _sent += 1
+
+        await _ws.close()
+        return _ws
+
+    def start(self):
+        """
+        別スレッドでサーバーを起動し、接続先のURLを返す関数
+        """
+        _ready = threading.Event()
+
+        async def _start():
+            _app = web.Application()
+            _app.router.add_get('/ws/{stream}', self._handle)
+            self._runner = web.AppRunner(_app)
+            await self._runner.setup()
+            _site = web.TCPSite(self._runner, '127.0.0.1', 0)
+            await _site.start()
+            self.url = f'ws://127.0.0.1:{self._runner.addresses[0][1]}/ws'
+
+        def _run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(_start())
+            _ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        _ready.wait()
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+def _create_fake_tradesutil(dbutil, exchange_class, work_dir, limit=1000):
+    # 偽の取引所を使い、ページの上限件数をlimitにしたTradesDownloadUtilを作る。学習した約定の頻度はwork_dirに保存する
+    _tradesutil = TradesDownloadUtil(dbutil, ccxt_clients={'binance': exchange_class()}, window_density_store=WindowDensityStore(os.path.join(work_dir, 'window_density.json')))
+    _tradesutil.trades_params = dict(TradesDownloadUtil.trades_params)
+    _tradesutil.trades_params['binance'] = dict(TradesDownloadUtil.trades_params['binance'], limit=limit)
+    return _tradesutil
+
+def benchmark_download(rows=100_000, trades_per_second=50, limit=1000, concurrency=1, latency=0.0, burst_ratio=1, write_latency=0.0):
+    """
+    偽の取引所からTradesDownloadUtil.download_tradesで約定を取得し、データフレームに変換する速度を計測する関数
+    パラメータ
+    ----------
+    rows : int, default = 100_000
+        取引所が返す約定の件数。
+    trades_per_second : int, default = 50
+        1秒あたりの約定の件数。多いほど取得間隔の調整が必要になる。
+    limit : int, default = 1000
+        1回のリクエストで返す約定の上限件数。trades_paramsのlimitと同じ意味。
+    concurrency : int, default = 1
+        download_tradesのconcurrency。
+    latency : float, default = 0.0
+        リクエスト1回あたりの応答時間(秒)。
+    burst_ratio : int, default = 1
+        約定の頻度が高い期間の頻度の倍率。FakeCcxtExchange.create参照。
+    write_latency : float, default = 0.0
+        書き込み1回あたりの応答時間(秒)。書き込みスレッドでまとめて書き込む効果を確認できる。
+
+    返り値
+    -------
+    dict
+        秒間取得約定数(trades_per_sec)とリクエスト数(requests)。
+    """
+    _exchange_class = FakeCcxtExchange.create(rows, trades_per_second, latency, burst_ratio)
+    _store = InMemoryTradeStore(write_latency)
+    _work_dir = tempfile.mkdtemp(prefix='benchmark_download_')
+    try:
+        _tradesutil = _create_fake_tradesutil(_store, _exchange_class, _work_dir, limit)
+
+        _start = time.perf_counter()
+        _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime(), concurrency=concurrency)
+        _elapsed = time.perf_counter() - _start
+    finally:
+        shutil.rmtree(_work_dir)
+
+    _rows = _store.count_rows(_store.get_trade_table_name('binance', 'BTC/USDT'))
+    _results = {'trades_per_sec': _rows / _elapsed, 'requests': _exchange_class.request_count}
+    print(f'download_trades concurrency={concurrency}: {_rows} trades in {_elapsed:.3f} sec, {_results["trades_per_sec"]:,.0f} trades/sec, {_results["requests"]} requests ({_rows / max(1, _results["requests"]):.0f} trades/request)')
+    
+    # 処理段階ごとの所要時間の内訳。並列取得や書き込みスレッドの時間は経過時間と重なる
+    for _timer in _tradesutil.metrics.snapshot()['timers']:
+        print(f"    {_timer['name']}: {_timer['count']} calls, {_timer['sum']:.3f} sec total, {_timer['max'] * 1000:.1f} ms max")
+    return _results
+
+def benchmark_stream(rows=10_000, trades_per_second=50, live_seconds=10, disconnect_after=None, batch_interval=1.0):
+    """
+    ローカルのWebSocketサーバーからTradesDownloadUtil.stream_tradesで約定を受け取り、取りこぼしや重複がなく累積和がつながっているかを確認する関数
+    パラメータ
+    ----------
+    rows : int, default = 10_000
+        ストリーミングの開始前にRESTで取得する約定の件数。
+    trades_per_second : int, default = 50
+        1秒あたりの約定の件数。
+    live_seconds : int, default = 10
+        ストリーミングする秒数。
+    disconnect_after : int, default = None
+        サーバーが1回の接続で配信する約定の件数。指定した場合は再接続時のRESTでの取得も確認できる。
+    batch_interval : float, default = 1.0
+        stream_tradesのbatch_interval。
+
+    返り値
+    -------
+    dict
+        ストリームから書き込んだ約定数(streamed)、取りこぼした約定数(missing)、重複した約定数(duplicated)、接続回数(connections)。
+    """
+    _exchange_class = FakeCcxtExchange.create(rows, trades_per_second, live_seconds=live_seconds)
+    _store = InMemoryTradeStore()
+    _server = FakeTradeWebSocketServer(_exchange_class, disconnect_after)
+    _url = _server.start()
+    _work_dir = tempfile.mkdtemp(prefix='benchmark_stream_')
+    try:
+        _tradesutil = _create_fake_tradesutil(_store, _exchange_class, _work_dir)
+        _streamed = _tradesutil.stream_trades(exchange='binance', symbol='BTC/USDT', stream=BinanceWebSocketTradeStream('BTC/USDT', url=_url), since_datetime=_exchange_class.get_start_datetime(), batch_interval=batch_interval, reconnect_wait=0.1, duration=live_seconds + 1)
+    finally:
+        _server.stop()
+        shutil.rmtree(_work_dir)
+
+    # 時刻が来た約定が全て1回ずつ書き込まれ、取引額の累積和がつながっていることを確認する
+    _df = _store.read_table(_store.get_trade_table_name('binance', 'BTC/USDT'))
+    _expected = int(np.searchsorted(_exchange_class.timestamps_ms, int(time.time() * 1000), side='right'))
+    _ids = _df['id'].astype(int)
+    _chained = (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
+    _results = {'streamed': _streamed, 'missing': len(set(range(_expected)) - set(_ids)), 'duplicated': len(_ids) - _ids.nunique(), 'connections': _server.connection_count}
+    print(f'stream_trades: {_streamed} trades streamed in {live_seconds} sec, {len(_df)} trades in table, missing: {_results["missing"]}, duplicated: {_results["duplicated"]}, connections: {_results["connections"]}, dollar_cumsum chained: {_chained}')
+    return _results
+
+def benchmark_ingest(rows=100_000, batch_size=1000):
+    """
+    ダウンロード時と同じ大きさのバッチでParquetStoreUtil.df_to_sqlに書き込む速度を計測する関数
+    パラメータ
+    ----------
+    rows : int, default = 100_000
+        書き込む約定の件数。
+    batch_size : int, default = 1000
+        1回のdf_to_sqlで書き込む件数。
+
+    返り値
+    -------
+    dict
+        数値列の形式(固定小数点、Decimal)ごとの秒間書き込み行数。
+    """
+    _df = generate_synthetic_trades(rows)
+    _df_raw = _df[['datetime', 'id', 'side', 'liquidation']].assign(price=_df['price'].astype(str), amount=_df['amount'].astype(str))
+    _results = {}
+
+    for _name, _compute in [('fixedpoint', compute_dollar_cumsums), ('decimal', compute_dollar_cumsums_decimal)]:
+        # 書き込むバッチは計測の前に作っておく
+        _batches = []
+        _offsets = [Decimal(0), Decimal(0), Decimal(0)]
+        for _index in range(0, rows, batch_size):
+            _batch = _compute(_df_raw.iloc[_index:_index + batch_size], *_offsets)
+            _offsets = [get_decimal_value(_batch, _column) for _column in ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']]
+            _batches.append(_batch)
+
+        _root_dir = tempfile.mkdtemp(prefix='benchmark_parquet_')
+        try:
+            _store = ParquetStoreUtil(_root_dir)
+            _store.init_trade_table('binance', 'BTC/USDT')
+            _table_name = _store.get_trade_table_name('binance', 'BTC/USDT')
+
+            _start = time.perf_counter()
+            for _batch in _batches:
+                _store.df_to_sql(df=_batch, schema=_table_name, if_exists='append')
+            _store.compact_partitions()
+            _elapsed = time.perf_counter() - _start
+        finally:
+            shutil.rmtree(_root_dir)
+
+        _results[_name] = rows / _elapsed
+        print(f'ParquetStoreUtil.df_to_sql ({_name}, batch_size={batch_size}): {rows} rows in {_elapsed:.3f} sec, {_results[_name]:,.0f} rows/sec')
+
+    return _results
+
+def benchmark_generate_dollarbar(rows=100_000, intervals=[100_000, 1_000_000], fetch_size=10000, trades_per_second=50):
+    """
+    偽の取引所からParquetStoreUtilにダウンロードした約定で、DollarbarGenerateUtil.generate_dollarbarのドルバー生成速度を計測する関数
+    パラメータ
+    ----------
+    rows : int, default = 100_000
+        約定の件数。
+    intervals : list, default = [100_000, 1_000_000]
+        ドルバーの金額のリスト。
+    fetch_size : int, default = 10000
+        generate_dollarbarのfetch_size。
+    trades_per_second : int, default = 50
+        1秒あたりの約定の件数。
+
+    返り値
+    -------
+    dict
+        秒間読み込み約定数(trades_per_sec)と秒間生成ドルバー数(bars_per_sec)。
+    """
+    _exchange_class = FakeCcxtExchange.create(rows, trades_per_second)
+    _root_dir = tempfile.mkdtemp(prefix='benchmark_parquet_')
+    try:
+        _store = ParquetStoreUtil(_root_dir)
+        _tradesutil = _create_fake_tradesutil(_store, _exchange_class, _root_dir)
+        _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+        _store.compact_partitions()
+
+        # ダウンロードは済んでいるので、generate_dollarbarの中のダウンロードは最新の約定を確認するだけになる
+        _dollarbarutil = DollarbarGenerateUtil(_store, tradesutil=_tradesutil)
+        _start = time.perf_counter()
+        _dollarbarutil.generate_dollarbar('binance', 'BTC/USDT', intervals, fetch_size=fetch_size)
+        _elapsed = time.perf_counter() - _start
+
+        _bars = sum([_store.get_dataset(_store.get_dollarbar_table_name('binance', 'BTC/USDT', _interval)).count_rows() for _interval in intervals])
+    finally:
+        shutil.rmtree(_root_dir)
+
+    _results = {'trades_per_sec': rows / _elapsed, 'bars_per_sec': _bars / _elapsed}
+    print(f'generate_dollarbar intervals={intervals}: {rows} trades, {_bars} bars in {_elapsed:.3f} sec, {_results["trades_per_sec"]:,.0f} trades/sec, {_results["bars_per_sec"]:,.0f} bars/sec')
+    return _results
+
+def benchmark_df_to_sql(dbutil=None, rows=100_000, methods=['insert', 'copy']):
+    """
+    TimeScaleDBUtil.df_to_sqlの書き込み方式ごとの書き込み速度を計測する関数
+    パラメータ
+    ----------
+    dbutil : TimeScaleDBUtil, 必須
+        書き込み先のデータベース。
+    rows : int, default = 100_000
+        書き込む約定の件数。
+    methods : list, default = ['insert', 'copy']
+        計測するdf_to_sqlのmethod。
+
+    返り値
+    -------
+    dict
+        methodごとの秒間書き込み行数。
+    """
+    _table_name = 'benchmark_df_to_sql_trade'
+    _df = generate_synthetic_trades(rows)
+    _results = {}
+
+    for _method in methods:
+        dbutil.sql_execute(f'DROP TABLE IF EXISTS "{_table_name}";'
+                           f' CREATE TABLE "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, id text, side enum_side NOT NULL, liquidation BOOL NOT NULL, price NUMERIC NOT NULL, amount NUMERIC NOT NULL, dollar NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, buy_dollar_cumsum NUMERIC NOT NULL, sell_dollar_cumsum NUMERIC NOT NULL, UNIQUE(datetime, id));')
+
+        _start = time.perf_counter()
+        dbutil.df_to_sql(df=_df, schema=_table_name, if_exists='append', method=_method)
+        _elapsed = time.perf_counter() - _start
+
+        _results[_method] = rows / _elapsed
+        print(f'df_to_sql method={_method}: {rows} rows in {_elapsed:.3f} sec, {_results[_method]:,.0f} rows/sec')
+
+    dbutil.sql_execute(f'DROP TABLE IF EXISTS "{_table_name}"')
+    return _results
+
+def benchmark_dollarbar_aggregate(rows=100_000, interval=100_000):
+    """
+    groupby.apply(dollarbar_aggregate)とaggregate_dollarbarsのドルバー生成速度を計測する関数
+    パラメータ
+    ----------
+    rows : int, default = 100_000
+        合成約定の件数。
+    interval : int, default = 100_000
+        ドルバーの金額。
+
+    返り値
+    -------
+    dict
+        集計方式ごとの秒間ドルバー生成数。
+    """
+    _df = generate_synthetic_trades(rows)
+    _df_fixedpoint = compute_dollar_cumsums(_df[['datetime', 'id', 'side', 'liquidation']].assign(price=_df['price'].astype(str), amount=_df['amount'].astype(str)))
+    _results = {}
+
+    _start = time.perf_counter()
+    _df_grouped = _df.assign(dollarbar_id=_df['dollar_cumsum'] // interval)
+    _df_bars = _df_grouped.groupby('dollarbar_id', as_index=False).apply(dollarbar_aggregate)
+    _elapsed = time.perf_counter() - _start
+    _results['groupby_apply'] = len(_df_bars) / _elapsed
+    print(f'groupby.apply(dollarbar_aggregate): {len(_df_bars)} bars in {_elapsed:.3f} sec, {_results["groupby_apply"]:,.0f} bars/sec')
+
+    for _name, _df_input in [('vectorized_decimal', _df), ('vectorized_fixedpoint', _df_fixedpoint)]:
+        _start = time.perf_counter()
+        _df_bars = aggregate_dollarbars(_df_input, interval)
+        _elapsed = time.perf_counter() - _start
+        _results[_name] = len(_df_bars) / _elapsed
+        print(f'aggregate_dollarbars ({_name}): {len(_df_bars)} bars in {_elapsed:.3f} sec, {_results[_name]:,.0f} bars/sec')
+
+    return _results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hot paths of crypto_trades_downloader')
+    parser.add_argument('target', choices=['df_to_sql', 'dollarbar_aggregate', 'download', 'ingest', 'generate_dollarbar', 'stream', 'all'], help='benchmark target. all runs every target which does not need TimescaleDB')
+    parser.add_argument('--rows', type=int, default=100_000, help='number of synthetic trades')
+    parser.add_argument('--interval', type=int, default=100_000, help='bar unit in dollar for dollarbar_aggregate and generate_dollarbar')
+    parser.add_argument('--trades-per-second', type=int, default=50, help='trade density of the fake exchange')
+    parser.add_argument('--limit', type=int, default=1000, help='page limit of the fake exchange')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrency of download_trades')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake exchange waits for each request')
+    parser.add_argument('--write-latency', type=float, default=0.0, help='seconds the in-memory store waits for each write in the download benchmark')
+    parser.add_argument('--burst-ratio', type=int, default=1, help='trade density multiplier of the busy periods of the fake exchange')
+    parser.add_argument('--live-seconds', type=int, default=10, help='seconds of live trades streamed by the fake WebSocket server')
+    parser.add_argument('--disconnect-after', type=int, default=None, help='number of trades the fake WebSocket server sends before closing each connection')
+    parser.add_argument('--fetch-size', type=int, default=10000, help='fetch_size of generate_dollarbar')
+
+    args = parser.parse_args()
+
+    if args.target == 'df_to_sql':
+        # PostgreSQL設定
+        _pg_config = {
+            'user': os.environ['POSTGRES_USER'],
+            'password': os.environ['POSTGRES_PASSWORD'],
+            'host': os.environ['POSTGRES_HOST'],
+            'port': os.environ['POSTGRES_PORT'],
+            'database': os.environ['POSTGRES_DATABASE']
+        }
+        _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
+        benchmark_df_to_sql(_dbutil, rows=args.rows)
+    if args.target in ['dollarbar_aggregate', 'all']:
+        benchmark_dollarbar_aggregate(rows=args.rows, interval=args.interval)
+    if args.target in ['download', 'all']:
+        benchmark_download(rows=args.rows, trades_per_second=args.trades_per_second, limit=args.limit, concurrency=args.concurrency, latency=args.latency, burst_ratio=args.burst_ratio, write_latency=args.write_latency)
+    if args.target in ['ingest', 'all']:
+        benchmark_ingest(rows=args.rows)
+    if args.target in ['generate_dollarbar', 'all']:
+        benchmark_generate_dollarbar(rows=args.rows, intervals=[args.interval, args.interval * 10], fetch_size=args.fetch_size, trades_per_second=args.trades_per_second)
+    if args.target in ['stream', 'all']:
+        benchmark_stream(rows=min(args.rows, 10_000), trades_per_second=args.trades_per_second, live_seconds=args.live_seconds, disconnect_after=args.disconnect_after)
+
+if __name__ == "__main__":
+    main()
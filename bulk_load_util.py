@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import uuid
+
+import pyarrow as pa
+
+# load_trades / load_barsで読み出せる列。数値列はfloat64、時刻はマイクロ秒単位のUTCのタイムスタンプで返す
+LOAD_TRADE_COLUMNS = ['datetime', 'id', 'side', 'liquidation', 'price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+LOAD_BAR_COLUMNS = ['datetime', 'datetime_from', 'id', 'id_from', 'open', 'high', 'low', 'close', 'amount', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+# columnsを指定しない場合にload_barsが返す列(従来のload_dollarbarsと同じ)
+DEFAULT_BAR_COLUMNS = ['datetime', 'open', 'high', 'low', 'close', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+LOAD_OUTPUTS = ['pandas', 'numpy', 'arrow']
+
+_TIMESTAMP_COLUMNS = ['datetime', 'datetime_from']
+_STRING_COLUMNS = ['id', 'id_from', 'side']
+_BOOL_COLUMNS = ['liquidation']
+LOAD_TIMESTAMP_TYPE = pa.timestamp('us', tz='UTC')
+
+def get_load_type(column):
+    """
+    load_trades / load_barsで返す列の型を返す関数
+    """
+    if column in _TIMESTAMP_COLUMNS:
+        return LOAD_TIMESTAMP_TYPE
+    if column in _STRING_COLUMNS:
+        return pa.string()
+    if column in _BOOL_COLUMNS:
+        return pa.bool_()
+    return pa.float64()
+
+def check_load_params(columns, available_columns, output):
+    """
+    読み出す列と出力形式を確認し、読み出す列のリストを返す関数
+    """
+    if output not in LOAD_OUTPUTS:
+        raise ValueError(f'outputには{LOAD_OUTPUTS}のいずれかを指定してください : {output}')
+    _unknown = [_column for _column in columns if _column not in available_columns]
+    if len(_unknown) > 0:
+        raise ValueError(f'読み出せない列が指定されています : {_unknown}')
+    if len(columns) <= 0:
+        raise ValueError(f'読み出す列を指定してください')
+    return list(columns)
+
+def empty_load_table(columns):
+    """
+    指定された列を持つ0行のArrowテーブルを返す関数
+    """
+    return pa.schema([(_column, get_load_type(_column)) for _column in columns]).empty_table()
+
+def convert_load_table(table, output = 'pandas'):
+    """
+    load_trades / load_barsで読み出したArrowテーブルを指定された形式に変換する関数
+    パラメータ
+    ----------
+    table : pyarrow.Table, 必須
+        変換するテーブル。
+    output : str, default = 'pandas'
+        'pandas'はデータフレーム、'numpy'は列名をキーとするnumpy.ndarrayのdict、'arrow'はpyarrow.Tableをそのまま返す。
+        数値列と時刻列はコピーせずに変換される。
+    """
+    if output == 'arrow':
+        return table
+    if output == 'numpy':
+        return {_name: table[_name].to_numpy() for _name in table.column_names}
+    return table.to_pandas()
+
+class LoadCache:
+    """
+    load_trades / load_barsの結果を、テーブル名と読み出し条件ごとにArrowのIPCファイルとしてローカルディスクに保存するクラス
+    読み出すときはメモリマップで開くので、ファイルの大きさによらずすぐに使える。
+    パラメータ
+    ----------
+    cache_dir : str, 必須
+        キャッシュファイルを保存するディレクトリ。
+    """
+    def __init__(self, cache_dir = None):
+        if cache_dir == None:
+            raise ValueError(f'キャッシュファイルを保存するディレクトリを指定してください')
+        self._cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _get_prefix(table_name):
+        # テーブル名のシンボルに含まれる/などはファイル名に使えないので置き換える
+        return table_name.replace('/', '-').replace(':', '-')
+
+    def get_path(self, table_name, **conditions):
+        # 同じテーブルのキャッシュはファイル名の先頭がそろうので、テーブルごとに消しやすい
+        _key = json.dumps({'table_name': table_name, **conditions}, sort_keys=True, default=str)
+        return os.path.join(self._cache_dir, f'{self._get_prefix(table_name)}-{hashlib.sha1(_key.encode()).hexdigest()[:16]}.arrow')
+
+    def read(self, path):
+        """
+        キャッシュファイルを読み、pyarrow.Tableで返す関数。ファイルがない場合はNone
+        """
+        if os.path.exists(path) == False:
+            return None
+        with pa.memory_map(path, 'r') as _source:
+            return pa.ipc.open_file(_source).read_all()
+
+    def write(self, path, table):
+        """
+        pyarrow.Tableをキャッシュファイルに書き込む関数。書き込み途中のファイルは読まれないように最後に名前を変える
+        """
+        _temp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+        with pa.OSFile(_temp_path, 'wb') as _sink, pa.ipc.new_file(_sink, table.schema) as _writer:
+            _writer.write_table(table)
+        os.replace(_temp_path, path)
+
+    def clear(self, table_name = None):
+        """
+        キャッシュファイルを消す関数
+        パラメータ
+        ----------
+        table_name : str, default = None
+            このテーブルのキャッシュだけを消す。Noneの場合は全て消す。
+        """
+        for _file in os.listdir(self._cache_dir):
+            if _file.endswith('.arrow') and (table_name is None or _file.startswith(f'{self._get_prefix(table_name)}-')):
+                os.remove(os.path.join(self._cache_dir, _file))
+
+def load_with_cache(cache_dir, table_name, columns, from_str, to_str, output, refresh, loader):
+    """
+    キャッシュがあればキャッシュから、なければloader()で読み出してキャッシュに保存し、outputの形式で返す関数
+    to_strがNoneの範囲は後から約定やバーが追加されるので、キャッシュしない。
+    """
+    if cache_dir is None or to_str is None:
+        return convert_load_table(loader(), output)
+
+    _cache = LoadCache(cache_dir)
+    _path = _cache.get_path(table_name, columns=columns, from_str=from_str, to_str=to_str)
+    _table = None if refresh == True else _cache.read(_path)
+    if _table is None:
+        _table = loader()
+        _cache.write(_path, _table)
+    return convert_load_table(_table, output)
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import shutil
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+class BybitArchivePrefetcher:
+    """
+    Bybitの日次約定履歴ファイル(public.bybit.com/trading/<SYMBOL>/<SYMBOL>YYYY-MM-DD.csv.gz)を
+    ワーカースレッドで先読みしてローカルのキャッシュディレクトリに保存するクラス
+    パラメータ
+    ----------
+    cache_dir : str, default = '~/.cache/crypto_trades_downloader/bybit'
+        ダウンロードしたファイルを保存するディレクトリ。
+    base_url : str, default = 'https://public.bybit.com/trading'
+        ダウンロード元のURL。テスト時はローカルのHTTPサーバーを指定できる。
+    max_workers : int, default = 4
+        同時にダウンロードするファイル数。
+    prefetch_days : int, default = 8
+        処理中の日付より何日先までダウンロードしておくか。
+    retry : int, default = 5
+        ダウンロードに失敗したときに再試行する回数。
+    retry_wait : float, default = 3
+        再試行までの待ち時間(秒)。再試行のたびに倍になる。
+    """
+    def __init__(self, cache_dir = '~/.cache/crypto_trades_downloader/bybit', base_url = 'https://public.bybit.com/trading', max_workers = 4, prefetch_days = 8, retry = 5, retry_wait = 3):
+        if max_workers < 1:
+            raise ValueError(f'max_workersには1以上を指定してください : {max_workers}')
+
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._base_url = base_url.rstrip('/')
+        self._max_workers = max_workers
+        self._prefetch_days = max(prefetch_days, max_workers)
+        self._retry = retry
+        self._retry_wait = retry_wait
+
+    def get_file_name(self, exchange_symbol, target_date):
+        return f'{exchange_symbol}{target_date.year:04d}-{target_date.month:02d}-{target_date.day:02d}.csv.gz'
+
+    def get_url(self, exchange_symbol, target_date):
+        return f'{self._base_url}/{exchange_symbol}/{self.get_file_name(exchange_symbol, target_date)}'
+
+    def get_cache_path(self, exchange_symbol, target_date):
+        return os.path.join(self._cache_dir, exchange_symbol, self.get_file_name(exchange_symbol, target_date))
+
+    def _sha256(self, path):
+        _hash = hashlib.sha256()
+        with open(path, 'rb') as _f:
+            for _block in iter(lambda: _f.read(1024 * 1024), b''):
+                _hash.update(_block)
+        return _hash.hexdigest()
+
+    def is_cached(self, exchange_symbol, target_date):
+        """
+        キャッシュ済みのファイルが存在し、ダウンロード完了時に記録したチェックサムと一致するかを返す関数
+        """
+        _path = self.get_cache_path(exchange_symbol, target_date)
+        if os.path.exists(_path) == False or os.path.exists(f'{_path}.sha256') == False:
+            return False
+        with open(f'{_path}.sha256', 'r') as _f:
+            _checksum = _f.read().strip()
+        return _checksum == self._sha256(_path)
+
+    def fetch(self, exchange_symbol, target_date):
+        """
+        指定された日付のファイルをキャッシュに保存し、そのパスを返す関数
+        パラメータ
+        ----------
+        exchange_symbol : str, 必須
+            Bybitのシンボル名。例: BTCUSD
+        target_date : datetime, 必須
+            ファイルの日付。
+
+        返り値
+        -------
+        キャッシュ上のファイルパス。ファイルがサーバー上に存在しない場合はNone。
+        """
+        _path = self.get_cache_path(exchange_symbol, target_date)
+        if self.is_cached(exchange_symbol, target_date):
+            return _path
+
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        _url = self.get_url(exchange_symbol, target_date)
+        _tmp_path = f'{_path}.{os.getpid()}.tmp'
+        _retry_wait = self._retry_wait
+
+        for _attempt in range(self._retry + 1):
+            try:
+                with urllib.request.urlopen(_url, timeout=60) as _response, open(_tmp_path, 'wb') as _f:
+                    shutil.copyfileobj(_response, _f)
+
+                # ダウンロードが完了してからチェックサムを書き、ファイルを置き換える
+                _checksum = self._sha256(_tmp_path)
+                os.replace(_tmp_path, _path)
+                with open(f'{_path}.sha256', 'w') as _f:
+                    _f.write(_checksum)
+                return _path
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    # まだ公開されていない日付か、シンボルの最初のファイルより前の日付。どちらかは呼び出し側で判断する
+                    return None
+                print(f'Bybit archive download failed ({_url}) : {e}')
+            except (urllib.error.URLError, OSError) as e:
+                print(f'Bybit archive download failed ({_url}) : {e}')
+            finally:
+                if os.path.exists(_tmp_path):
+                    os.remove(_tmp_path)
+
+            if _attempt < self._retry:
+                sleep(_retry_wait)
+                _retry_wait *= 2
+
+        raise IOError(f'Bybitのファイルをダウンロードできませんでした : {_url}')
+
+    def iter_files(self, exchange_symbol, target_dates):
+        """
+        日付のリストの順番にキャッシュ上のファイルパスを返すジェネレータ。後続の日付はワーカースレッドで先読みする
+        パラメータ
+        ----------
+        exchange_symbol : str, 必須
+            Bybitのシンボル名。例: BTCUSD
+        target_dates : list, 必須
+            日付のリスト。
+
+        返り値
+        -------
+        (datetime, str)
+            日付とキャッシュ上のファイルパス。ファイルがサーバー上に存在しない日付のパスはNone。
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='bybit-prefetch') as _executor:
+            _pending = deque()
+            _dates = iter(target_dates)
+
+            for _target_date in _dates:
+                _pending.append((_target_date, _executor.submit(self.fetch, exchange_symbol, _target_date)))
+                if len(_pending) >= self._prefetch_days:
+                    break
+
+            try:
+                while len(_pending) > 0:
+                    _target_date, _future = _pending.popleft()
+                    _next_date = next(_dates, None)
+                    if _next_date is not None:
+                        _pending.append((_next_date, _executor.submit(self.fetch, exchange_symbol, _next_date)))
+                    yield _target_date, _future.result()
+            finally:
+                for _, _future in _pending:
+                    _future.cancel()
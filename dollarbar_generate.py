@@ -1,33 +1,87 @@
 import os
 import argparse
+from decimal import Decimal
 
 from timescaledb_util import TimeScaleDBUtil
+from parquet_store_util import ParquetStoreUtil
 from trades_download_util import TradesDownloadUtil
-from dollarbar_generate_util import DollarbarGenerateUtil
+from metrics_util import profile
+from dollarbar_generate_util import DollarbarGenerateUtil, BAR_TYPES
 
 def main():
-    # PostgreSQL設定
-    _pg_config = {
-        'user': os.environ['POSTGRES_USER'],
-        'password': os.environ['POSTGRES_PASSWORD'],
-        'host': os.environ['POSTGRES_HOST'],
-        'port': os.environ['POSTGRES_PORT'],
-        'database': os.environ['POSTGRES_DATABASE']
-    }
-    
-    _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
-    _dollarbarutil = DollarbarGenerateUtil(_dbutil)
-
     # Commandline arguments
     parser = argparse.ArgumentParser(description='Generate dollarbar from the date in TimescaleDB')
 
-    parser.add_argument('exchange', help=f'exchange name. {_dollarbarutil._exchange_list}')
+    parser.add_argument('exchange', help=f'exchange name. {list(TradesDownloadUtil.trades_params.keys())}')
     parser.add_argument('symbol', help='symbol name. Example: BTC/USD')
-    parser.add_argument('interval', help='Bar unit in dollar. Example: 10000000')
+    parser.add_argument('interval', nargs='+', help=f'Bar unit in dollar, or <bar type>:<unit> for other bar types {BAR_TYPES}. Tick bars count trades, volume bars sum amounts, time bars use seconds. Multiple bars are generated in one pass. Example: 10000000 50000000 tick:1000 volume:10 time:60 dollar_imbalance:1000000')
+    parser.add_argument('--stream', action='store_true', help='keep streaming trades over WebSocket and write each dollar bar as soon as it is closed')
+    parser.add_argument('--server-side', action='store_true', help='aggregate dollar bars with INSERT ... SELECT in TimescaleDB instead of Python. Falls back to Python when the SQL fails')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve per stage timings and counters at http://0.0.0.0:<port>/metrics in Prometheus text format')
+    parser.add_argument('--metrics-log-interval', type=float, default=None, help='write per stage timings and counters to stderr as a JSON line every this many seconds')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    parser.add_argument('--parquet-dir', default=None, help='read trades from and write dollar bars to date partitioned Parquet files under this directory instead of TimescaleDB')
 
     args = parser.parse_args()
     
-    _dollarbarutil.generate_dollarbar(args.exchange, args.symbol, int(args.interval))
+    if args.parquet_dir is not None:
+        _dbutil = ParquetStoreUtil(args.parquet_dir)
+    else:
+        # PostgreSQL設定
+        _pg_config = {
+            'user': os.environ['POSTGRES_USER'],
+            'password': os.environ['POSTGRES_PASSWORD'],
+            'host': os.environ['POSTGRES_HOST'],
+            'port': os.environ['POSTGRES_PORT'],
+            'database': os.environ['POSTGRES_DATABASE']
+        }
+        _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
+    _tradesutil = TradesDownloadUtil(_dbutil)
+    _dollarbarutil = DollarbarGenerateUtil(_dbutil, tradesutil=_tradesutil)
+    
+    # 処理段階ごとの所要時間とカウンタの出力
+    if args.metrics_port is not None:
+        _tradesutil.metrics.start_http_server(args.metrics_port)
+    _metrics_log = None
+    if args.metrics_log_interval is not None:
+        _metrics_log = _tradesutil.metrics.start_json_log(args.metrics_log_interval)
+    
+    try:
+        if args.profile is not None:
+            with profile(args.profile):
+                _run(args, _dbutil, _tradesutil, _dollarbarutil)
+        else:
+            _run(args, _dbutil, _tradesutil, _dollarbarutil)
+    finally:
+        if _metrics_log is not None:
+            # 終了時点の集計値を書き出す
+            _metrics_log.set()
+            _tradesutil.metrics.log_json()
+
+def _run(args, dbutil, tradesutil, dollarbarutil):
+    # 種類を省略した大きさはドルバーとする。出来高バーの大きさは小数も指定できる
+    _bars = []
+    for _interval in args.interval:
+        _bar_type, _, _unit = _interval.rpartition(':')
+        _bar_type = _bar_type if len(_bar_type) > 0 else 'dollar'
+        _bars.append((_bar_type, Decimal(_unit) if _bar_type == 'volume' else int(_unit)))
+
+    dollarbarutil.generate_bars(args.exchange, args.symbol, _bars, server_side=args.server_side)
+
+    if args.stream == True:
+        # ストリームで書き込まれた約定のバッチごとに、確定したバーを書き込んで表示する
+        def _print_bars(exchange, symbol, bar_type, interval, df):
+            for _, _bar in df.iterrows():
+                print(f"{exchange}, {symbol}, {bar_type} bar, interval: {interval}, datetime: {_bar['datetime']}, open: {_bar['open']}, high: {_bar['high']}, low: {_bar['low']}, close: {_bar['close']}")
+
+        dollarbarutil.subscribe_bars(args.exchange, args.symbol, _bars, callback=_print_bars)
+        try:
+            tradesutil.stream_trades(exchange=args.exchange, symbol=args.symbol)
+        except KeyboardInterrupt:
+            pass
+
+    if args.parquet_dir is not None:
+        dbutil.compact_partitions()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import threading
 import time
 from tqdm import tqdm
 import traceback
@@ -5,12 +6,16 @@ import os
 
 from datetime import timezone, datetime, timedelta
 import dateutil.parser as dp
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING
 from math import ceil, floor
+import numpy as np
 import pandas as pd
 
 from timescaledb_util import TimeScaleDBUtil
 from trades_download_util import TradesDownloadUtil
+from fixedpoint_util import FIXEDPOINT_ATTRS_KEY, get_fixedpoint_attrs, floor_divide, fixedpoint_to_decimal, greater_than, get_decimal_value
+
+DOLLARBAR_COLUMNS = ['datetime', 'datetime_from', 'id', 'id_from', 'open', 'high', 'low', 'close', 'amount', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
 
 def dollarbar_aggregate(x):
    y = {
@@ -34,13 +39,373 @@ def dollarbar_aggregate(x):
    }
    return pd.Series(y)
 
+def _to_bool_array(values):
+    # DBから読んだbool列と、ダウンロード直後の'True'/'False'文字列の列の両方を扱う
+    if values.dtype == bool:
+        return values.to_numpy()
+    return values.astype(str).str.lower().to_numpy() == 'true'
+
+def get_dollarbar_ids(df=None, interval=None):
+    """
+    約定データフレームの各約定が属するドルバーのID(dollar_cumsum // interval)をint64の配列で返す関数
+    """
+    return floor_divide(df, 'dollar_cumsum', interval)
+
+def aggregate_dollarbars(df=None, interval=None, bar_ids=None):
+    """
+    dollar_cumsum順に並んだ約定データフレームから、dollarbar_aggregateと同じ列を持つドルバーを一括で計算する関数
+    パラメータ
+    ----------
+    df : pandas.DataFrame, 必須
+        dollar_cumsumの昇順に並んだ約定データフレーム。数値列はDecimalまたは固定小数点のint64。
+    interval : int, default = None
+        ドルバーの金額。bar_idsを指定しない場合は必須。
+    bar_ids : numpy.ndarray, default = None
+        各約定が属するバーのID。昇順である必要がある。
+
+    返り値
+    -------
+    df : pandas.DataFrame
+        バーごとに1行のデータフレーム。入力が固定小数点列を持つ場合は出力も固定小数点列になる。
+    """
+    if bar_ids is None:
+        bar_ids = get_dollarbar_ids(df, interval)
+    if len(df) == 0:
+        return pd.DataFrame(columns=DOLLARBAR_COLUMNS)
+
+    # 各バーの最初と最後の約定の位置
+    _starts = np.searchsorted(bar_ids, np.unique(bar_ids), side='left')
+    _ends = np.append(_starts[1:], len(df)) - 1
+
+    _price = df['price'].to_numpy()
+    _dollar = df['dollar'].to_numpy()
+    _is_buy = df['side'].to_numpy() == 'buy'
+    _is_sell = df['side'].to_numpy() == 'sell'
+    _is_liquidation = _to_bool_array(df['liquidation'])
+
+    _df_bars = pd.DataFrame({
+        'datetime': df['datetime'].iloc[_ends].reset_index(drop=True),
+        'datetime_from': df['datetime'].iloc[_starts].reset_index(drop=True),
+        'id': df['id'].iloc[_ends].reset_index(drop=True),
+        'id_from': df['id'].iloc[_starts].reset_index(drop=True),
+        'open': _price[_starts],
+        'high': np.maximum.reduceat(_price, _starts),
+        'low': np.minimum.reduceat(_price, _starts),
+        'close': _price[_ends],
+        'amount': np.add.reduceat(df['amount'].to_numpy(), _starts),
+        'dollar_volume': np.add.reduceat(_dollar, _starts),
+        'dollar_buy_volume': np.add.reduceat(_dollar * _is_buy, _starts),
+        'dollar_sell_volume': np.add.reduceat(_dollar * _is_sell, _starts),
+        'dollar_liquidation_buy_volume': np.add.reduceat(_dollar * (_is_buy & _is_liquidation), _starts),
+        'dollar_liquidation_sell_volume': np.add.reduceat(_dollar * (_is_sell & _is_liquidation), _starts),
+        'dollar_cumsum': df['dollar_cumsum'].to_numpy()[_ends],
+        'buy_dollar_cumsum': df['buy_dollar_cumsum'].to_numpy()[_ends],
+        'sell_dollar_cumsum': df['sell_dollar_cumsum'].to_numpy()[_ends],
+    })
+
+    # 固定小数点列のscaleとオフセットをバーの列に引き継ぐ
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is not None:
+        _scales = _fixedpoint['scales']
+        _df_bars.attrs[FIXEDPOINT_ATTRS_KEY] = {
+            'scales': {
+                'open': _scales['price'], 'high': _scales['price'], 'low': _scales['price'], 'close': _scales['price'],
+                'amount': _scales['amount'],
+                'dollar_volume': _scales['dollar'],
+                'dollar_buy_volume': _scales['dollar'],
+                'dollar_sell_volume': _scales['dollar'],
+                'dollar_liquidation_buy_volume': _scales['dollar'],
+                'dollar_liquidation_sell_volume': _scales['dollar'],
+                'dollar_cumsum': _scales['dollar_cumsum'],
+                'buy_dollar_cumsum': _scales['buy_dollar_cumsum'],
+                'sell_dollar_cumsum': _scales['sell_dollar_cumsum'],
+            },
+            'offsets': dict(_fixedpoint['offsets']),
+        }
+    return _df_bars
+
+def _get_scaled_values(df, column):
+    # 固定小数点列はint64の配列とscaleを、それ以外はDecimalの配列とscale 0を返す
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is not None and column in _fixedpoint['scales']:
+        return df[column].to_numpy(), _fixedpoint['scales'][column]
+    return np.array([Decimal(_value) for _value in df[column]], dtype=object), 0
+
+def _to_scaled_threshold(value, scale, integer):
+    # 10**scale倍した閾値。整数と比べる場合は切り上げても比較結果が変わらない
+    _scaled = Decimal(value).scaleb(scale)
+    if integer == True:
+        return int(_scaled.to_integral_value(rounding=ROUND_CEILING))
+    return _scaled
+
+class DollarBarSampler:
+    """
+    dollar_cumsum // intervalでドルバーを区切るクラス
+    """
+    bar_type = 'dollar'
+
+    def __init__(self, interval=None):
+        self.interval = interval
+
+    def get_bar_ids(self, df=None):
+        """
+        dollar_cumsum順に並んだ約定のチャンクの各約定が属するバーのIDを、昇順のint64の配列で返す関数
+        前回のチャンクの続きを渡すと、前回の最後の約定と同じバーに属する約定には同じIDを返す。
+        """
+        return get_dollarbar_ids(df, self.interval)
+
+class TimeBarSampler(DollarBarSampler):
+    """
+    約定時刻をinterval秒ごとに区切るクラス。UNIX時刻0からの経過秒数 // intervalをIDにする
+    """
+    bar_type = 'time'
+
+    def __init__(self, interval=None):
+        super().__init__(interval)
+        self._last_bar_id = None
+
+    def get_bar_ids(self, df=None):
+        _elapsed = pd.to_datetime(df['datetime'], utc=True) - pd.Timestamp(0, tz='UTC')
+        _bar_ids = (_elapsed // pd.Timedelta(seconds=self.interval)).to_numpy(dtype=np.int64, copy=True)
+        if len(_bar_ids) <= 0:
+            return _bar_ids
+        
+        # 約定時刻が前後している場合でもIDが減らないように、遅れた約定はその時点のバーに入れる
+        if self._last_bar_id is not None:
+            _bar_ids[0] = max(_bar_ids[0], self._last_bar_id)
+        _bar_ids = np.maximum.accumulate(_bar_ids)
+        self._last_bar_id = int(_bar_ids[-1])
+        return _bar_ids
+
+class ThresholdBarSampler(DollarBarSampler):
+    """
+    約定ごとの値を足していき、合計がinterval以上になった約定でバーを閉じて0から数え直すクラス
+    ティックバー(約定数)と出来高バー(amountの合計)に使う。バーを閉じた直後から数え直すので、確定したバーの続きから再開しても同じバーになる。
+    パラメータ
+    ----------
+    interval : int or Decimal, 必須
+        バーを閉じる合計値。
+    bar_type : str, default = 'tick'
+        'tick'の場合は約定数、'volume'の場合はamountを足す。
+    """
+    def __init__(self, interval=None, bar_type='tick'):
+        super().__init__(interval)
+        self.bar_type = bar_type
+        self._bar_id = 0
+        self._running = Decimal(0)
+
+    def _get_values(self, df):
+        if self.bar_type == 'tick':
+            return np.ones(len(df), dtype=np.int64), 0
+        return _get_scaled_values(df, 'amount')
+
+    def get_bar_ids(self, df=None):
+        _values, _scale = self._get_values(df)
+        _integer = _values.dtype != object
+        _cumsum = np.cumsum(_values)
+        _bar_ids = np.empty(len(df), dtype=np.int64)
+
+        # 値は0以上なので累積和は単調増加し、次にバーを閉じる約定は二分探索で見つかる
+        _threshold = _to_scaled_threshold(self.interval, _scale, _integer)
+        _base = 0
+        _needed = _to_scaled_threshold(self.interval - self._running, _scale, _integer)
+        _position = 0
+        _closed = False
+        while _position < len(df):
+            _close = int(np.searchsorted(_cumsum, _base + _needed, side='left'))
+            if _close >= len(df):
+                _bar_ids[_position:] = self._bar_id
+                break
+            _bar_ids[_position:_close + 1] = self._bar_id
+            self._bar_id += 1
+            _base = _cumsum[_close]
+            _needed = _threshold
+            _position = _close + 1
+            _closed = True
+
+        # 閉じていないバーの合計値を次のチャンクに持ち越す
+        _rest = Decimal(int(_cumsum[-1] - _base) if _integer else _cumsum[-1] - _base).scaleb(-_scale) if len(df) > 0 else Decimal(0)
+        self._running = _rest if _closed else self._running + _rest
+        return _bar_ids
+
+class DollarImbalanceBarSampler(ThresholdBarSampler):
+    """
+    買いの金額から売りの金額を引いた不均衡の絶対値がinterval以上になった約定でバーを閉じて0から数え直すクラス
+    約定ごとの不均衡はbuy_dollar_cumsumとsell_dollar_cumsumの差分と同じく、買いなら+dollar、売りなら-dollarとする。
+    """
+    def __init__(self, interval=None):
+        super().__init__(interval, 'dollar_imbalance')
+
+    def get_bar_ids(self, df=None):
+        _dollar, _scale = _get_scaled_values(df, 'dollar')
+        _signs = np.where(df['side'].to_numpy() == 'buy', 1, -1)
+        _values = (_dollar * _signs).tolist()
+        _bar_ids = np.empty(len(df), dtype=np.int64)
+
+        # 不均衡は増減するので二分探索できない。整数で計算できる場合は整数のまま1約定ずつ足す
+        _imbalance = self._running.scaleb(_scale)
+        _integer = _dollar.dtype != object and _imbalance == _imbalance.to_integral_value()
+        _threshold = _to_scaled_threshold(self.interval, _scale, _integer)
+        if _integer == True:
+            _imbalance = int(_imbalance)
+        for _index, _value in enumerate(_values):
+            _bar_ids[_index] = self._bar_id
+            _imbalance += _value
+            if abs(_imbalance) >= _threshold:
+                self._bar_id += 1
+                _imbalance = 0
+
+        self._running = Decimal(_imbalance).scaleb(-_scale)
+        return _bar_ids
+
+BAR_TYPES = ['dollar', 'tick', 'volume', 'time', 'dollar_imbalance']
+
+def create_bar_sampler(bar_type='dollar', interval=None):
+    """
+    バーの種類に応じて、約定をバーに区切るクラスのインスタンスを作る関数
+    パラメータ
+    ----------
+    bar_type : str, default = 'dollar'
+        'dollar'(金額), 'tick'(約定数), 'volume'(amountの合計), 'time'(秒), 'dollar_imbalance'(買いと売りの金額の差)のいずれか。
+    interval : int or Decimal, 必須
+        バーの大きさ。単位はbar_typeによる。
+    """
+    if interval == None:
+        raise ValueError(f'バーの大きさを指定してください')
+    if bar_type == 'dollar':
+        return DollarBarSampler(interval)
+    if bar_type == 'time':
+        return TimeBarSampler(interval)
+    if bar_type in ['tick', 'volume']:
+        return ThresholdBarSampler(interval, bar_type)
+    if bar_type == 'dollar_imbalance':
+        return DollarImbalanceBarSampler(interval)
+    raise ValueError(f'バーの種類には{BAR_TYPES}のいずれかを指定してください : {bar_type}')
+
+class DollarbarAccumulator:
+    """
+    約定のチャンクを順に受け取り、確定したドルバーを返すクラス
+    まだ確定していない最新のドルバーは集計済みの値(OHLCや出来高)だけを保持するので、1本のドルバーが多数のチャンクにまたがっても処理量はチャンクの大きさに比例する。
+    パラメータ
+    ----------
+    interval : int, 必須
+        ドルバーの金額。samplerを指定した場合は不要。
+    sampler : DollarBarSampler, default = None
+        約定をバーに区切るクラスのインスタンス(create_bar_sampler参照)。指定した場合はドルバー以外の種類のバーを集計する。
+    """
+    def __init__(self, interval=None, sampler=None):
+        if interval == None and sampler is None:
+            raise ValueError(f'ドルバーの金額を指定してください')
+        self._sampler = sampler if sampler is not None else DollarBarSampler(interval)
+        self._interval = self._sampler.interval
+        self._open_bar = None
+        self._open_bar_id = None
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def get_open_bar(self):
+        """
+        まだ確定していないドルバーをpandas.Seriesで返す関数。ない場合はNone
+        """
+        if self._open_bar is None:
+            return None
+        return pd.Series(self._open_bar)
+
+    def update(self, df=None):
+        """
+        dollar_cumsum順に並んだ約定のチャンクを追加し、確定したドルバーを返す関数
+        パラメータ
+        ----------
+        df : pandas.DataFrame, 必須
+            前回のチャンクの続きの約定。数値列はDecimalまたは固定小数点のint64。
+
+        返り値
+        -------
+        df : pandas.DataFrame
+            このチャンクで確定したドルバー。数値列はDecimal。
+        """
+        if df is None or len(df) == 0:
+            return pd.DataFrame(columns=DOLLARBAR_COLUMNS)
+
+        # チャンク内のドルバーを集計する。ドルバーの本数は約定よりずっと少ないので、ここでDecimalに戻す
+        _bar_ids = self._sampler.get_bar_ids(df)
+        _df_bars = fixedpoint_to_decimal(aggregate_dollarbars(df, bar_ids=_bar_ids))
+        _chunk_bar_ids = np.unique(_bar_ids).tolist()
+        _bars = _df_bars.to_dict('records')
+
+        # チャンクの最初のドルバーが未確定のドルバーの続きであれば結合する
+        if self._open_bar is not None and self._open_bar_id == _chunk_bar_ids[0]:
+            _bars[0] = self._merge_bars(self._open_bar, _bars[0])
+        elif self._open_bar is not None:
+            _bars.insert(0, self._open_bar)
+            _chunk_bar_ids.insert(0, self._open_bar_id)
+
+        # 最後のドルバーは次のチャンクで続きの約定が来るかもしれないので未確定として残す
+        self._open_bar = _bars.pop()
+        self._open_bar_id = _chunk_bar_ids.pop()
+
+        return pd.DataFrame(_bars, columns=DOLLARBAR_COLUMNS)
+
+    def _merge_bars(self, former, latter):
+        # 同じドルバーIDを持つ2つの集計結果を1つにまとめる
+        _bar = dict(latter)
+        _bar['datetime_from'] = former['datetime_from']
+        _bar['id_from'] = former['id_from']
+        _bar['open'] = former['open']
+        _bar['high'] = max(former['high'], latter['high'])
+        _bar['low'] = min(former['low'], latter['low'])
+        for _column in ['amount', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume']:
+            _bar[_column] = former[_column] + latter[_column]
+        return _bar
+
 class DollarbarGenerateUtil:
-    def __init__(self, dbutil=None):
+    def __init__(self, dbutil=None, tradesutil=None):
         self._dbutil = dbutil
-        self._tradesutil = TradesDownloadUtil(self._dbutil)
+        self._tradesutil = tradesutil if tradesutil is not None else TradesDownloadUtil(self._dbutil)
         self._exchange_list = list(self._tradesutil.trades_params.keys())
+        # 約定のダウンロードと同じMetricsに集計する
+        self._metrics = self._tradesutil.metrics
 
-    def generate_dollarbar(self, exchange=None, symbol=None, interval=None):
+    def generate_dollarbar(self, exchange=None, symbol=None, interval=None, fetch_size=10000, server_side=False):
+        """
+        DBの約定履歴からドルバーを生成してドルバーテーブルに書き込む関数
+        パラメータ
+        ----------
+        exchange : str, 必須
+            取引所名。
+        symbol : str, 必須
+            シンボル名。
+        interval : int or list, 必須
+            ドルバーの金額。リストを渡すと、約定履歴を1回読むだけで全ての金額のドルバーを生成する。
+        fetch_size : int, default = 10000
+            約定履歴を読み込むときに1回にDBから受け取る行数。
+        server_side : bool, default = False
+            Trueの場合、DB上のINSERT ... SELECTでドルバーを集計する(TimeScaleDBUtil.insert_dollarbars)。対応していない保存先やSQLが失敗した金額は約定履歴を読み込んで集計する。
+            Falseの場合は約定履歴を読み込んで集計する。
+        """
+        _intervals = interval if isinstance(interval, (list, tuple)) else [interval]
+        self.generate_bars(exchange, symbol, [('dollar', _interval) for _interval in _intervals], fetch_size, server_side)
+    
+    def generate_bars(self, exchange=None, symbol=None, bars=None, fetch_size=10000, server_side=False):
+        """
+        DBの約定履歴からドルバー、ティックバー、出来高バー、時間バー、ドル不均衡バーを生成してバーの種類と大きさごとのテーブルに書き込む関数
+        約定履歴を1回読むだけで全てのバーを生成し、バーごとに計算済みの最新のバーから再開する。
+        パラメータ
+        ----------
+        exchange : str, 必須
+            取引所名。
+        symbol : str, 必須
+            シンボル名。
+        bars : list, 必須
+            (バーの種類, 大きさ)のリスト。例: [('dollar', 10_000_000), ('tick', 1000), ('time', 60)]。種類と大きさの単位はcreate_bar_sampler参照。
+        fetch_size : int, default = 10000
+            約定履歴を読み込むときに1回にDBから受け取る行数。
+        server_side : bool, default = False
+            Trueの場合、ドルバーはDB上のINSERT ... SELECTで集計する(TimeScaleDBUtil.insert_dollarbars)。対応していない保存先やSQLが失敗した金額は約定履歴を読み込んで集計する。
+            Falseの場合は全てのバーを約定履歴を読み込んで集計する。
+        """
         _exchange_list = list(self._tradesutil.trades_params.keys())
         
         if exchange not in _exchange_list:
@@ -50,101 +415,227 @@ class DollarbarGenerateUtil:
         # 約定情報をダウンロードする
         self._tradesutil.download_trades(exchange=exchange, symbol=symbol, since_datetime=datetime(2019, 3, 5, 0, 0, 0, tzinfo=timezone.utc))
         
-        # トレードとドルバーを入れる空のデータフレームを作る
-        _df_trades = pd.DataFrame(columns=['datetime', 'id', 'side', 'price', 'amount', 'dollar', 'dollar_cumsum'])
-        _df_dollarbars = pd.DataFrame(columns=['datetime', 'datetime_from', 'id', 'id_from', 'open', 'high', 'low', 'close', 'amount', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum'])
-    
-        # これよりも大きなdollar_cumsumを持つ約定データだけ読み込む
-        _head_dollar_cumsum = 0
-
-        # これよりも小さいか等しいdollar_cumsumを持つ約定データだけ読み込む
-        _tail_dollar_cumsum = 0
-
         # 最新の約定情報を取得する
         _latest_trade = self._dbutil.get_latest_trade(exchange, symbol)
         if _latest_trade is None:
             print('There is no trade downloaded. Cannot calculate dollar bars')
             return
-        else:
-            _tail_dollar_cumsum = _latest_trade['dollar_cumsum']
+        _tail_dollar_cumsum = _latest_trade['dollar_cumsum']
 
         # 最古の約定情報を取得する
         _first_trade = self._dbutil.get_first_trade(exchange, symbol)
         if _first_trade is None:
             print('There is no trade downloaded. Cannot calculate dollar bars')
             return
-        else:
-            _head_dollar_cumsum = _first_trade['dollar_cumsum']
-            _head_id = _first_trade['id']
-            _head_datetime = _first_trade['datetime']
-
-        # 計算済みの最新のドルバーを取得する
-        _latest_dollarbar = self._dbutil.get_latest_dollarbar(exchange, symbol, interval)
-        if _latest_dollarbar is None:
-            print('There is no dollar bar calculated. Start from the beginning of downloaded trade data.')
-        else:
-            print(f'The latest dollar bar is as follows. Resume from the end of the dollar bar.')
-            print(_latest_dollarbar)
-            _head_dollar_cumsum = _latest_dollarbar['dollar_cumsum']
-            _head_id = _latest_dollarbar['id']
-            _head_datetime = _latest_dollarbar['datetime']
-
-        _total_cumsum = _tail_dollar_cumsum - _head_dollar_cumsum
-        _current_dollar_cumsum = _head_dollar_cumsum
-        _current_id = _head_id
-        _current_datetime = _head_datetime
+        
+        # バーの種類と大きさごとに、計算済みの最新のバーから再開する
+        _states = [self._init_dollarbar_state(exchange, symbol, _interval, _first_trade, _bar_type) for _bar_type, _interval in bars]
+        if server_side == True and hasattr(self._dbutil, 'insert_dollarbars'):
+            _states = [_state for _state in _states if _state['bar_type'] != 'dollar' or self._insert_dollarbars(exchange, symbol, _state, _tail_dollar_cumsum) == False]
+            if len(_states) <= 0:
+                return
+        self._scan_trades(exchange, symbol, _states, _tail_dollar_cumsum, fetch_size)
     
-        with tqdm(total = float(_total_cumsum), initial=0) as _pbar:
-            _trade_table_name = self._dbutil.get_trade_table_name(exchange, symbol)
-            self._dbutil.init_dollarbar_table(exchange, symbol, interval)
-            _dollarbar_table_name = self._dbutil.get_dollarbar_table_name(exchange, symbol, interval)
+    # DB上でドルバーを集計して書き込む。失敗した場合はFalseを返し、約定履歴を読み込んで集計する方法に任せる
+    def _insert_dollarbars(self, exchange, symbol, state, tail_dollar_cumsum):
+        try:
+            with self._metrics.timer('db_aggregation', table=state['table_name']):
+                _bars = self._dbutil.insert_dollarbars(exchange, symbol, state['interval'], from_dollar_cumsum=state['head_dollar_cumsum'], till_dollar_cumsum=tail_dollar_cumsum)
+        except Exception as e:
+            print(f'Server side dollar bar aggregation failed for interval {state["interval"]}. Fall back to client side aggregation : {e}')
+            return False
+        self._metrics.inc('bars_written', _bars, table=state['table_name'])
+        print(f'{_bars} dollar bars for interval {state["interval"]} were aggregated in DB.')
+        return True
+    
+    def subscribe_dollarbar(self, exchange=None, symbol=None, interval=None, callback=None, bar_queue=None, fetch_size=10000):
+        """
+        TradesDownloadUtilが約定のバッチを書き込むたびに、確定したドルバーをドルバーテーブルに書き込んで通知するように登録する関数
+        登録時に約定テーブルにあってまだドルバーになっていない約定を集計してから、以降のバッチを処理する。
+        パラメータ
+        ----------
+        exchange : str, 必須
+            取引所名。
+        symbol : str, 必須
+            シンボル名。
+        interval : int or list, 必須
+            ドルバーの金額。リストを渡すと全ての金額のドルバーを生成する。
+        callback : callable, default = None
+            callback(exchange, symbol, interval, df)の形で、ドルバーが確定するたびに呼ばれる。dfは確定したドルバーのデータフレームで数値列はDecimal。
+        bar_queue : queue.Queue, default = None
+            ドルバーが確定するたびに(exchange, symbol, interval, df)を入れるキュー。
+        fetch_size : int, default = 10000
+            登録時に約定履歴を読み込むときに1回にDBから受け取る行数。
 
-            while _head_dollar_cumsum < _tail_dollar_cumsum:
-                _sql = f'WITH time_filtered AS (SELECT * FROM \"{_trade_table_name}\" WHERE datetime >= \'{_current_datetime}\' ORDER BY datetime ASC LIMIT 10000) SELECT * from time_filtered WHERE dollar_cumsum > {_current_dollar_cumsum} AND id != \'{_current_id}\' ORDER BY dollar_cumsum ASC'
-                _df_new_trades = self._dbutil.read_sql_query(_sql, dtype={'price': str, 'amount': str, 'dollar': str, 'dollar_cumsum': str, 'buy_dollar_cumsum': str, 'sell_dollar_cumsum': str})
+        返り値
+        -------
+        listener : callable
+            unsubscribe_dollarbarに渡して登録を解除する。
+        """
+        _intervals = interval if isinstance(interval, (list, tuple)) else [interval]
+        
+        def _on_bars(state, df_bars):
+            if callback is not None:
+                callback(exchange, symbol, state['interval'], df_bars)
+            if bar_queue is not None:
+                bar_queue.put((exchange, symbol, state['interval'], df_bars))
+        
+        return self._subscribe(exchange, symbol, [('dollar', _interval) for _interval in _intervals], _on_bars, fetch_size)
+    
+    def subscribe_bars(self, exchange=None, symbol=None, bars=None, callback=None, bar_queue=None, fetch_size=10000):
+        """
+        subscribe_dollarbarと同じく、約定のバッチが書き込まれるたびに確定したバーを書き込んで通知するように登録する関数。ドルバー以外の種類のバーも扱う
+        パラメータ
+        ----------
+        exchange : str, 必須
+            取引所名。
+        symbol : str, 必須
+            シンボル名。
+        bars : list, 必須
+            (バーの種類, 大きさ)のリスト。generate_bars参照。
+        callback : callable, default = None
+            callback(exchange, symbol, bar_type, interval, df)の形で、バーが確定するたびに呼ばれる。
+        bar_queue : queue.Queue, default = None
+            バーが確定するたびに(exchange, symbol, bar_type, interval, df)を入れるキュー。
+        fetch_size : int, default = 10000
+            登録時に約定履歴を読み込むときに1回にDBから受け取る行数。
 
-                # もう読み込むデータがなければ終了
-                if len(_df_new_trades) <= 0:
+        返り値
+        -------
+        listener : callable
+            unsubscribe_dollarbarに渡して登録を解除する。
+        """
+        def _on_bars(state, df_bars):
+            if callback is not None:
+                callback(exchange, symbol, state['bar_type'], state['interval'], df_bars)
+            if bar_queue is not None:
+                bar_queue.put((exchange, symbol, state['bar_type'], state['interval'], df_bars))
+        
+        return self._subscribe(exchange, symbol, bars, _on_bars, fetch_size)
+    
+    def _subscribe(self, exchange, symbol, bars, on_bars, fetch_size):
+        if exchange not in self._exchange_list:
+            raise ValueError(f'対応していない取引所です : {exchange}')
+        
+        _lock = threading.Lock()
+        # 登録時の集計が終わるまでに書き込まれたバッチは、集計が終わってから処理する
+        _subscription = {'states': None, 'pending': []}
+        
+        def _on_bars(state, df_bars):
+            if len(df_bars) <= 0:
+                return
+            on_bars(state, df_bars)
+        
+        def _listener(listener_exchange, listener_symbol, df):
+            if listener_exchange != exchange or listener_symbol != symbol:
+                return
+            with _lock:
+                if _subscription['states'] is None:
+                    _subscription['pending'].append(df)
+                    return
+                self._update_dollarbar_states(_subscription['states'], df, _on_bars)
+        
+        self._tradesutil.add_trades_listener(_listener)
+        
+        _first_trade = self._dbutil.get_first_trade(exchange, symbol)
+        _states = [self._init_dollarbar_state(exchange, symbol, _interval, _first_trade, _bar_type) for _bar_type, _interval in bars]
+        _latest_trade = self._dbutil.get_latest_trade(exchange, symbol)
+        if _latest_trade is not None:
+            self._scan_trades(exchange, symbol, _states, _latest_trade['dollar_cumsum'], fetch_size, _on_bars)
+        
+        with _lock:
+            for _df in _subscription['pending']:
+                self._update_dollarbar_states(_states, _df, _on_bars)
+            _subscription['states'] = _states
+            _subscription['pending'] = []
+        return _listener
+    
+    def unsubscribe_dollarbar(self, listener=None):
+        """
+        subscribe_dollarbarとsubscribe_barsの登録を解除する関数
+        """
+        self._tradesutil.remove_trades_listener(listener)
+    
+    # ダウンロード直後の約定のバッチを全ての金額のドルバーに渡す
+    def _update_dollarbar_states(self, states, df, on_bars=None):
+        # 約定時刻の文字列をDBから読んだ約定と同じ型にそろえる
+        _df = df.copy()
+        _df['datetime'] = pd.to_datetime(_df['datetime'], utc=True)
+        for _state in states:
+            self._update_dollarbar_state(_state, _df, on_bars)
+    
+    # 約定履歴をdollar_cumsum順に1回だけ走査して、全ての金額のドルバーを生成する
+    def _scan_trades(self, exchange, symbol, states, tail_dollar_cumsum, fetch_size=10000, on_bars=None):
+        # 全ての金額のうち最も古い再開位置から約定履歴を読み込む
+        _head_state = min(states, key=lambda x: x['head_dollar_cumsum'] if x['head_dollar_cumsum'] is not None else Decimal(-1))
+        _head_dollar_cumsum = _head_state['head_dollar_cumsum']
+        _total_cumsum = tail_dollar_cumsum - (_head_dollar_cumsum if _head_dollar_cumsum is not None else Decimal(0))
+        _intervals = [f"{_state['bar_type']}:{_state['interval']}" for _state in states]
+    
+        with tqdm(total = float(_total_cumsum), initial=0) as _pbar:
+            # サーバーサイドカーソルでdollar_cumsum順に1回だけ走査する
+            _iterator = iter(self._dbutil.iter_trades(exchange, symbol, from_dollar_cumsum=_head_dollar_cumsum, from_id=_head_state['head_id'], fetch_size=fetch_size, fixedpoint=True))
+            while True:
+                # DBからの読み込みに掛かった時間を集計と分けて記録する
+                with self._metrics.timer('db_read', exchange=exchange, symbol=symbol):
+                    _df_new_trades = next(_iterator, None)
+                if _df_new_trades is None:
                     break
+                self._metrics.inc('rows_read', len(_df_new_trades), exchange=exchange, symbol=symbol)
+                
+                # 読み込んだ約定を全ての金額のドルバーに渡す
+                for _state in states:
+                    self._update_dollarbar_state(_state, _df_new_trades, on_bars)
 
-                _to_decimal = lambda x: Decimal(x)
-                _df_new_trades['price'] = _df_new_trades['price'].apply(_to_decimal)
-                _df_new_trades['amount'] = _df_new_trades['amount'].apply(_to_decimal)
-                _df_new_trades['dollar'] = _df_new_trades['dollar'].apply(_to_decimal)
-                _df_new_trades['dollar_cumsum'] = _df_new_trades['dollar_cumsum'].apply(_to_decimal)
-                _df_new_trades['buy_dollar_cumsum'] = _df_new_trades['buy_dollar_cumsum'].apply(_to_decimal)
-                _df_new_trades['sell_dollar_cumsum'] = _df_new_trades['sell_dollar_cumsum'].apply(_to_decimal)
-
-                # 処理中のデータフレームに結合させ、ドルバーIDを再計算
-                _df_trades = pd.concat([_df_trades, _df_new_trades]).sort_values('dollar_cumsum')
-                _df_trades['dollarbar_id'] = _df_trades['dollar_cumsum'] // interval
+                _current_dollar_cumsum = get_decimal_value(_df_new_trades, 'dollar_cumsum')
 
                 # プログレスバーを更新
-                _pbar.set_postfix_str(f"{exchange}, {symbol}, start: {_df_trades.iloc[0]['datetime']}, row_counts: {len(_df_trades)} current_dollar_cumsum {_current_dollar_cumsum}")
-                _pbar.n = float(_df_trades.iloc[0]['dollar_cumsum'] - _head_dollar_cumsum)
+                _pbar.set_postfix_str(f"{exchange}, {symbol}, start: {_df_new_trades.iloc[0]['datetime']}, intervals: {_intervals}, current_dollar_cumsum {_current_dollar_cumsum}")
+                _pbar.n = float(_current_dollar_cumsum - (_head_dollar_cumsum if _head_dollar_cumsum is not None else Decimal(0)))
                 _pbar.refresh()
-
-                # 現在の約定情報データフレームの最初と最後のドルバーIDが一致していたら、ドルバーを生成できないので次のデータフレームをDBから読み込む
-                if _df_trades.iloc[0]['dollarbar_id'] == _df_trades.iloc[-1]['dollarbar_id']:
-                    _current_dollar_cumsum = _df_trades.iloc[-1]['dollar_cumsum']
-                    _current_id = _df_trades.iloc[-1]['id']
-                    _current_datetime = _df_trades.iloc[-1]['datetime']
-                    continue
-
-                # ドルバー確定に十分な約定情報があるので、ドルバー作成用の約定情報を抽出する
-                _df_trades_new_dollarbars = _df_trades.loc[_df_trades['dollarbar_id'] < _df_trades.iloc[-1]['dollarbar_id']]
-
-                # グループを利用してドルバーを作成する
-                _group_new_dollarbars = _df_trades_new_dollarbars.groupby('dollarbar_id', as_index=False)
-                _df_aggregate = _group_new_dollarbars.apply(dollarbar_aggregate)
-                _df_aggregate.drop('dollarbar_id', axis=1, inplace=True)
-
-                self._dbutil.df_to_sql(df=_df_aggregate, schema=_dollarbar_table_name, if_exists = 'append')
-
-                # ドルバー生成に使った約定履歴を取り除く
-                _df_trades = _df_trades.loc[_df_trades['dollarbar_id'] >= _df_trades.iloc[-1]['dollarbar_id']]
-                _current_dollar_cumsum = _df_trades.iloc[-1]['dollar_cumsum']
-                _current_id = _df_trades.iloc[-1]['id']
-                _current_datetime = _df_trades.iloc[-1]['datetime']
-
-
+    
+    # バーの種類と大きさごとの処理状態を作る
+    def _init_dollarbar_state(self, exchange, symbol, interval, first_trade, bar_type='dollar'):
+        _sampler = create_bar_sampler(bar_type, interval)
+        self._dbutil.init_bar_table(exchange, symbol, bar_type, interval)
+        _state = {
+            'bar_type': bar_type,
+            'interval': interval,
+            'table_name': self._dbutil.get_bar_table_name(exchange, symbol, bar_type, interval),
+            'head_dollar_cumsum': first_trade['dollar_cumsum'] if first_trade is not None else None,
+            'head_id': first_trade['id'] if first_trade is not None else None,
+            'head_datetime': first_trade['datetime'] if first_trade is not None else None,
+            'accumulator': DollarbarAccumulator(sampler=_sampler),
+        }
+        
+        # 計算済みの最新のバーを取得し、その最後の約定の次から再開する
+        _latest_dollarbar = self._dbutil.get_latest_bar(exchange, symbol, bar_type, interval)
+        if _latest_dollarbar is None:
+            print(f'There is no {bar_type} bar calculated for interval {interval}. Start from the beginning of downloaded trade data.')
+        else:
+            print(f'The latest {bar_type} bar for interval {interval} is as follows. Resume from the end of the {bar_type} bar.')
+            print(_latest_dollarbar)
+            _state['head_dollar_cumsum'] = _latest_dollarbar['dollar_cumsum']
+            _state['head_id'] = _latest_dollarbar['id']
+            _state['head_datetime'] = _latest_dollarbar['datetime']
+        return _state
+    
+    # 新しく読み込んだ約定を処理状態に追加し、確定したドルバーを書き込む
+    def _update_dollarbar_state(self, state, df_new_trades, on_bars=None):
+        # このドルバーの再開位置よりも新しい約定だけを使う。約定テーブルが空の状態で始めた場合は全ての約定を使う
+        if state['head_dollar_cumsum'] is not None:
+            df_new_trades = df_new_trades.loc[greater_than(df_new_trades, 'dollar_cumsum', state['head_dollar_cumsum'])]
+        if len(df_new_trades) <= 0:
+            return
+        
+        with self._metrics.timer('aggregation', bar_type=state['bar_type'], interval=state['interval']):
+            _df_aggregate = state['accumulator'].update(df_new_trades)
+        with self._metrics.timer('db_insert', table=state['table_name']):
+            self._dbutil.df_to_sql(df=_df_aggregate, schema=state['table_name'], if_exists = 'append')
+        self._metrics.inc('bars_written', len(_df_aggregate), table=state['table_name'])
+        
+        # 同じ約定を2回集計しないように再開位置を進める
+        state['head_dollar_cumsum'] = get_decimal_value(df_new_trades, 'dollar_cumsum')
+        state['head_id'] = df_new_trades.iloc[-1]['id']
+        if on_bars is not None:
+            on_bars(state, _df_aggregate)
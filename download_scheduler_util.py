@@ -0,0 +1,134 @@
+import json
+import time
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone, datetime
+
+from trades_download_util import TradesDownloadUtil
+from window_controller_util import WindowDensityStore
+
+class TradesDownloadScheduler:
+    """
+    複数の取引所とシンボルの約定履歴を1つのプロセスでまとめてダウンロードするクラス
+    取引所ごとに1つのワーカースレッドでシンボルを順にダウンロードし、ccxtクライアント(load_marketsの結果)とレートリミッタはその取引所の全シンボルで共有する。
+    データベースへの書き込みは全ての取引所で同じdbutil(コネクションプール)を使う。
+    パラメータ
+    ----------
+    dbutil : TimeScaleDBUtil or ParquetStoreUtil, 必須
+        約定履歴の保存先。全てのワーカースレッドで共有する。
+    max_workers : int, default = None
+        同時にダウンロードする取引所の数。Noneの場合は全ての取引所を同時にダウンロードする。
+    concurrency : int, default = 1
+        シンボルごとのdownload_tradesのconcurrency。
+    since_datetime : datetime, default = 2019-03-05 00:00:00 UTC
+        約定履歴がまだない場合のダウンロード開始日時。
+    window_density_store : WindowDensityStore, default = None
+        学習した約定の頻度の保存先。全ての取引所で共有する。Noneの場合は既定のファイルに保存する。
+    ccxt_clients : dict, default = None
+        取引所名をキーにしたccxtクライアント。ない取引所のクライアントは最初に使うときに作る。
+    """
+    def __init__(self, dbutil = None, max_workers = None, concurrency = 1, since_datetime = datetime(2019, 3, 5, 0, 0, 0, tzinfo=timezone.utc), window_density_store = None, ccxt_clients = None):
+        if dbutil == None:
+            raise ValueError(f'約定履歴の保存先を指定してください')
+        if max_workers is not None and max_workers < 1:
+            raise ValueError(f'max_workersには1以上を指定してください : {max_workers}')
+
+        self._dbutil = dbutil
+        self._max_workers = max_workers
+        self._concurrency = concurrency
+        self._since_datetime = since_datetime
+        self._tradesutils = {}
+        # 全ての取引所が同じファイルに頻度を保存するので、ストアも1つだけ作って共有する
+        self._window_density_store = window_density_store if window_density_store is not None else WindowDensityStore()
+        self._ccxt_clients = ccxt_clients if ccxt_clients is not None else {}
+
+    @staticmethod
+    def load_jobs(path = None):
+        """
+        ジョブのリストをファイルから読み込む関数
+        JSONファイル([{"exchange": "binance", "symbol": "BTC/USDT"}, ...])か、1行に「取引所名 シンボル名」を書いたテキストファイルを読める。#以降はコメントとして無視する。
+        パラメータ
+        ----------
+        path : str, 必須
+            ジョブのリストのファイルパス。
+
+        返り値
+        -------
+        list
+            (exchange, symbol)のリスト。
+        """
+        with open(path, 'r') as _f:
+            _text = _f.read()
+
+        if _text.lstrip().startswith('['):
+            return [(_job['exchange'], _job['symbol']) for _job in json.loads(_text)]
+
+        _jobs = []
+        for _line in _text.splitlines():
+            _line = _line.split('#')[0].strip()
+            if len(_line) <= 0:
+                continue
+            _fields = _line.split()
+            if len(_fields) != 2:
+                raise ValueError(f'ジョブは「取引所名 シンボル名」の形式で指定してください : {_line}')
+            _jobs.append((_fields[0], _fields[1]))
+        return _jobs
+
+    def get_tradesutil(self, exchange):
+        """
+        取引所ごとに共有するTradesDownloadUtilを返す関数
+        """
+        if exchange not in self._tradesutils:
+            _ccxt_clients = {exchange: self._ccxt_clients[exchange]} if exchange in self._ccxt_clients else None
+            self._tradesutils[exchange] = TradesDownloadUtil(self._dbutil, ccxt_clients=_ccxt_clients, window_density_store=self._window_density_store)
+        return self._tradesutils[exchange]
+
+    def _run_exchange_jobs(self, exchange, symbols, tradesutil):
+        # 1つの取引所のシンボルを順にダウンロードする。失敗したシンボルがあっても残りのシンボルは続ける
+        _results = []
+        for _symbol in symbols:
+            _start = time.perf_counter()
+            try:
+                tradesutil.download_trades(exchange=exchange, symbol=_symbol, since_datetime=self._since_datetime, concurrency=self._concurrency)
+                _results.append({'exchange': exchange, 'symbol': _symbol, 'status': 'ok', 'elapsed': time.perf_counter() - _start})
+            except Exception as e:
+                print(f'Download failed ({exchange}, {_symbol}) : {traceback.format_exc()}')
+                _results.append({'exchange': exchange, 'symbol': _symbol, 'status': f'error: {e}', 'elapsed': time.perf_counter() - _start})
+        return _results
+
+    def run(self, jobs = None):
+        """
+        ジョブのリストの約定履歴をダウンロードする関数
+        パラメータ
+        ----------
+        jobs : list, 必須
+            (exchange, symbol)のリスト。
+
+        返り値
+        -------
+        list
+            ジョブごとの結果(exchange, symbol, status, elapsed)のdictのリスト。jobsと同じ順に並ぶ。
+        """
+        # 取引所ごとにシンボルをまとめる。サポートしていない取引所のジョブは結果にだけ記録する
+        _exchange_symbols = OrderedDict()
+        _results = []
+        for _exchange, _symbol in jobs:
+            if _exchange not in TradesDownloadUtil.trades_params:
+                print(f'{_exchange} is not supported')
+                _results.append({'exchange': _exchange, 'symbol': _symbol, 'status': 'error: not supported', 'elapsed': 0.0})
+                continue
+            _exchange_symbols.setdefault(_exchange, [])
+            if _symbol not in _exchange_symbols[_exchange]:
+                _exchange_symbols[_exchange].append(_symbol)
+
+        if len(_exchange_symbols) > 0:
+            _max_workers = len(_exchange_symbols) if self._max_workers is None else min(self._max_workers, len(_exchange_symbols))
+            with ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='download-job') as _executor:
+                _futures = [_executor.submit(self._run_exchange_jobs, _exchange, _symbols, self.get_tradesutil(_exchange)) for _exchange, _symbols in _exchange_symbols.items()]
+                for _future in _futures:
+                    _results.extend(_future.result())
+
+        _order = {_job: _index for _index, _job in enumerate(jobs)}
+        return sorted(_results, key=lambda x: _order[(x['exchange'], x['symbol'])])
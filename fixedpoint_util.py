@@ -0,0 +1,347 @@
+from decimal import Decimal, localcontext
+import functools
+import numpy as np
+import pandas as pd
+
+# 固定小数点列の情報をデータフレームのattrsに保存するときのキー
+FIXEDPOINT_ATTRS_KEY = 'fixedpoint'
+
+# float64を経由して正確に変換できる整数の上限 (有効桁数15桁)
+FLOAT_EXACT_MAX = 10**15
+
+# int64の累積和を安全に扱える上限
+INT64_SAFE_MAX = 2**62
+
+# Decimalで計算するときの有効桁数。既定の28桁ではscaleの大きい累積和が丸められてしまう
+DECIMAL_PRECISION = 60
+
+def _exact_decimal(func):
+    # 関数内のDecimalの計算をDECIMAL_PRECISION桁で行う
+    @functools.wraps(func)
+    def _wrapper(*args, **kwargs):
+        with localcontext() as _context:
+            _context.prec = DECIMAL_PRECISION
+            return func(*args, **kwargs)
+    return _wrapper
+
+def precision_to_scale(precision=None):
+    """
+    ccxtのマーケット情報のprecisionを小数点以下の桁数に変換する関数
+    パラメータ
+    ----------
+    precision : int or float, default = None
+        小数点以下の桁数(DECIMAL_PLACES)またはティックサイズ(TICK_SIZE)。
+
+    返り値
+    -------
+    小数点以下の桁数。precisionが不明な場合は0。
+    """
+    if precision is None:
+        return 0
+    if float(precision).is_integer() and float(precision) >= 1:
+        # DECIMAL_PLACESモードの桁数。ティックサイズ1と区別できないが、どちらも0桁として扱って問題ない
+        return int(precision) if float(precision) > 1 else 0
+    return max(0, -Decimal(str(precision)).normalize().as_tuple().exponent)
+
+def normalize_decimal_strings(values=None):
+    """
+    数値を表す文字列のSeriesから指数表記('1e-05'など)を取り除く関数
+    パラメータ
+    ----------
+    values : pandas.Series, 必須
+        数値を表す文字列のSeries。
+
+    返り値
+    -------
+    指数表記を含まない文字列のSeries。
+    """
+    values = values.astype(str).str.strip()
+    _exponent_mask = values.str.contains('[eE]', regex=True)
+    if _exponent_mask.any():
+        values = values.copy()
+        values[_exponent_mask] = values[_exponent_mask].apply(lambda x: format(Decimal(x), 'f'))
+    return values
+
+def _infer_float_scale(values=None, min_scale=0):
+    # 有効桁数15桁以内の10進数はfloat64を経由しても一意に復元できるので、
+    # 10**scale倍して丸めた整数が元のfloat64に戻る最小のscaleを探す
+    for _scale in range(min_scale, 16):
+        _scaled = np.rint(values * 10.0**_scale)
+        if np.abs(_scaled).max(initial=0) >= FLOAT_EXACT_MAX:
+            return None
+        if np.array_equal(_scaled / 10.0**_scale, values):
+            return _scale
+    return None
+
+def _parse_scaled_int_str(values=None, min_scale=0):
+    # 文字列操作で10**scale倍した整数を作る。有効桁数が多い値でも正確に変換できる
+    values = normalize_decimal_strings(values)
+    _parts = values.str.partition('.')
+    _integer = _parts[0]
+    _fraction = _parts[2].str.rstrip('0')
+    _scale = max(min_scale, int(_fraction.str.len().max()))
+
+    # 符号は整数部の先頭に残したまま、小数部を右側0埋めして連結すれば10**scale倍の整数文字列になる
+    _digits = _integer.where(_integer.str.len() > 0, '0').str.replace('^-$', '-0', regex=True) + _fraction.str.ljust(_scale, '0')
+    if _digits.str.lstrip('-').str.len().max() > 18:
+        raise OverflowError('int64で表現できない値が含まれています')
+    return _digits.astype(np.int64).to_numpy(), _scale
+
+def parse_scaled_int(values=None, min_scale=0):
+    """
+    数値を表す文字列のSeriesを、10**scale倍したint64の配列に正確に変換する関数
+    パラメータ
+    ----------
+    values : pandas.Series, 必須
+        数値を表す文字列のSeries。
+    min_scale : int, default = 0
+        小数点以下の最小桁数。マーケット情報のprecisionを渡すと、バッチごとに桁数が変わりにくくなる。
+
+    返り値
+    -------
+    (numpy.ndarray (int64), int)
+        10**scale倍された整数値とscale。int64で表せない場合はOverflowErrorを送出する。
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), min_scale
+
+    values = values.astype(str)
+
+    # 16文字以内(符号と小数点を除いて有効桁数15桁以内)であればfloat64を経由して高速に変換できる
+    if values.str.len().max() <= 16:
+        _floats = pd.to_numeric(values).to_numpy(dtype=np.float64)
+        _scale = _infer_float_scale(_floats, min_scale)
+        if _scale is not None:
+            return np.rint(_floats * 10.0**_scale).astype(np.int64), _scale
+
+    return _parse_scaled_int_str(values, min_scale)
+
+@_exact_decimal
+def scaled_int_to_decimal(value=None, scale=0, offset=Decimal(0)):
+    """
+    10**scale倍された整数をDecimalに正確に変換する関数
+    """
+    return Decimal(int(value)).scaleb(-scale) + Decimal(offset)
+
+def compute_dollar_cumsums(df=None, dollar_cumsum_offset=Decimal(0), buy_dollar_cumsum_offset=Decimal(0), sell_dollar_cumsum_offset=Decimal(0), price_scale=0, amount_scale=0):
+    """
+    約定データフレームのdollarと3つの累積和を固定小数点の整数演算で計算する関数
+    パラメータ
+    ----------
+    df : pandas.DataFrame, 必須
+        price, amount, side列を持つデータフレーム。price, amountは数値を表す文字列。dollar列を持つ場合はprice*amountの代わりにその値を使う。
+    dollar_cumsum_offset : Decimal, default = Decimal(0)
+        dollar_cumsumの開始値。
+    buy_dollar_cumsum_offset : Decimal, default = Decimal(0)
+        buy_dollar_cumsumの開始値。
+    sell_dollar_cumsum_offset : Decimal, default = Decimal(0)
+        sell_dollar_cumsumの開始値。
+    price_scale : int, default = 0
+        マーケット情報から得たpriceの小数点以下の桁数。
+    amount_scale : int, default = 0
+        マーケット情報から得たamountの小数点以下の桁数。
+
+    返り値
+    -------
+    df : pandas.DataFrame
+        price, amount, dollar, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum列を10**scale倍したint64で置き換えたデータフレーム。
+        累積和の列はオフセットを含まないバッチ内の累積和で、各列のscaleとオフセットはdf.attrs['fixedpoint']に保存される。
+        int64で計算できない場合はOverflowErrorを送出する。
+    """
+    df = df.copy()
+    _price, _price_scale = parse_scaled_int(df['price'], price_scale)
+    _amount, _amount_scale = parse_scaled_int(df['amount'], amount_scale)
+
+    if 'dollar' in df.columns:
+        _dollar, _dollar_scale = parse_scaled_int(df['dollar'])
+    else:
+        _dollar_scale = _price_scale + _amount_scale
+        if len(df) > 0 and int(np.abs(_price).max()) * int(np.abs(_amount).max()) >= INT64_SAFE_MAX:
+            raise OverflowError('price*amountがint64で表現できません')
+        _dollar = _price * _amount
+
+    # バッチ内の累積和がint64に収まることを確認する
+    if len(df) > 0 and float(np.abs(_dollar).astype(np.float64).sum()) >= INT64_SAFE_MAX:
+        raise OverflowError('dollarの累積和がint64で表現できません')
+
+    _side = df['side'].to_numpy()
+    df['price'] = _price
+    df['amount'] = _amount
+    df['dollar'] = _dollar
+    df['dollar_cumsum'] = np.cumsum(_dollar)
+    df['buy_dollar_cumsum'] = np.cumsum(np.where(_side == 'buy', _dollar, 0))
+    df['sell_dollar_cumsum'] = np.cumsum(np.where(_side == 'sell', _dollar, 0))
+
+    df.attrs[FIXEDPOINT_ATTRS_KEY] = {
+        'scales': {
+            'price': _price_scale,
+            'amount': _amount_scale,
+            'dollar': _dollar_scale,
+            'dollar_cumsum': _dollar_scale,
+            'buy_dollar_cumsum': _dollar_scale,
+            'sell_dollar_cumsum': _dollar_scale,
+        },
+        'offsets': {
+            'dollar_cumsum': Decimal(dollar_cumsum_offset),
+            'buy_dollar_cumsum': Decimal(buy_dollar_cumsum_offset),
+            'sell_dollar_cumsum': Decimal(sell_dollar_cumsum_offset),
+        },
+    }
+    return df
+
+@_exact_decimal
+def compute_dollar_cumsums_decimal(df=None, dollar_cumsum_offset=Decimal(0), buy_dollar_cumsum_offset=Decimal(0), sell_dollar_cumsum_offset=Decimal(0)):
+    """
+    compute_dollar_cumsumsと同じ計算をDecimalで行う関数。int64で表現できない場合のフォールバックとして使う
+    """
+    df = df.copy()
+    # floatはparse_scaled_intと同じく最短の10進表記の値として扱う
+    _to_decimal = lambda x: Decimal(str(x))
+    df['price'] = df['price'].apply(_to_decimal)
+    df['amount'] = df['amount'].apply(_to_decimal)
+    if 'dollar' in df.columns:
+        df['dollar'] = df['dollar'].apply(_to_decimal)
+    else:
+        df['dollar'] = df['price'] * df['amount']
+
+    df['dollar_cumsum'] = df['dollar'].cumsum() + Decimal(dollar_cumsum_offset)
+    df['buy_dollar_cumsum'] = df['dollar'].where(df['side'] == 'buy', Decimal(0)).cumsum() + Decimal(buy_dollar_cumsum_offset)
+    df['sell_dollar_cumsum'] = df['dollar'].where(df['side'] == 'sell', Decimal(0)).cumsum() + Decimal(sell_dollar_cumsum_offset)
+    return df
+
+def get_fixedpoint_attrs(df=None):
+    """
+    データフレームが固定小数点列を持つ場合、その列のscaleとオフセットを返す関数。持たない場合はNone
+    """
+    return df.attrs.get(FIXEDPOINT_ATTRS_KEY)
+
+@_exact_decimal
+def get_decimal_value(df=None, column=None, row=-1):
+    """
+    データフレームの指定された行と列の値をDecimalで返す関数。固定小数点列の場合はscaleとオフセットを反映する
+    """
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is None or column not in _fixedpoint['scales']:
+        return Decimal(df.iloc[row][column])
+    return scaled_int_to_decimal(df.iloc[row][column], _fixedpoint['scales'][column], _fixedpoint['offsets'].get(column, Decimal(0)))
+
+@_exact_decimal
+def fixedpoint_to_decimal(df=None):
+    """
+    固定小数点列を持つデータフレームを、Decimal列を持つデータフレームに変換する関数
+    """
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is None:
+        return df
+
+    df = df.copy()
+    for _column, _scale in _fixedpoint['scales'].items():
+        if _column not in df.columns:
+            continue
+        _offset = _fixedpoint['offsets'].get(_column, Decimal(0))
+        df[_column] = [scaled_int_to_decimal(_value, _scale, _offset) for _value in df[_column].tolist()]
+    df.attrs.pop(FIXEDPOINT_ATTRS_KEY)
+    return df
+
+@_exact_decimal
+def concat_fixedpoint(dfs=None):
+    """
+    固定小数点列を持つデータフレームのリストを、固定小数点列のまま1つのデータフレームにつなげる関数
+    scaleが異なる列は最大のscaleに、累積和のオフセットは最初のデータフレームのオフセットにそろえる。
+    Decimal列のデータフレームを含む場合や、int64に収まらない場合はDecimal列でつなげる。
+    パラメータ
+    ----------
+    dfs : list, 必須
+        同じ列を持つデータフレームのリスト。
+
+    返り値
+    -------
+    df : pandas.DataFrame
+        つなげたデータフレーム。
+    """
+    dfs = [_df for _df in dfs if _df is not None and len(_df) > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    if len(dfs) == 1:
+        return dfs[0]
+
+    _attrs = [get_fixedpoint_attrs(_df) for _df in dfs]
+    if any([_fixedpoint is None or _attrs[0] is None or _fixedpoint['scales'].keys() != _attrs[0]['scales'].keys() for _fixedpoint in _attrs]):
+        return pd.concat([fixedpoint_to_decimal(_df) for _df in dfs], ignore_index=True)
+
+    _scales = {_column: max([_fixedpoint['scales'][_column] for _fixedpoint in _attrs]) for _column in _attrs[0]['scales']}
+    _offsets = dict(_attrs[0]['offsets'])
+    _converted = []
+    try:
+        for _df, _fixedpoint in zip(dfs, _attrs):
+            _df = _df.copy()
+            for _column, _scale in _scales.items():
+                _values = _df[_column].to_numpy(dtype=np.int64)
+                _multiplier = 10 ** (_scale - _fixedpoint['scales'][_column])
+                # オフセットの差をこのデータフレームの値に足し込む。差が整数で表せない場合はDecimalでつなげる
+                _delta = (_fixedpoint['offsets'].get(_column, Decimal(0)) - _offsets.get(_column, Decimal(0))).scaleb(_scale)
+                if _delta != _delta.to_integral_value():
+                    raise OverflowError(f'{_column}のオフセットの差がscale {_scale}で表現できません')
+                if int(np.abs(_values).max()) * _multiplier + abs(int(_delta)) >= INT64_SAFE_MAX:
+                    raise OverflowError(f'{_column}がint64で表現できません')
+                _df[_column] = _values * _multiplier + int(_delta)
+            _converted.append(_df)
+    except OverflowError:
+        return pd.concat([fixedpoint_to_decimal(_df) for _df in dfs], ignore_index=True)
+
+    _df = pd.concat(_converted, ignore_index=True)
+    _df.attrs[FIXEDPOINT_ATTRS_KEY] = {'scales': _scales, 'offsets': _offsets}
+    return _df
+
+@_exact_decimal
+def floor_divide(df=None, column=None, divisor=None):
+    """
+    データフレームの列の値をdivisorで割った商(切り捨て)をint64の配列で返す関数
+    固定小数点列の場合はオフセットを含めた値の商を、int64の範囲で正確に計算する。
+    パラメータ
+    ----------
+    df : pandas.DataFrame, 必須
+        対象のデータフレーム。
+    column : str, 必須
+        割られる列名。値は0以上である必要がある。
+    divisor : int or Decimal, 必須
+        割る数。
+
+    返り値
+    -------
+    numpy.ndarray (int64)
+    """
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is None or column not in _fixedpoint['scales']:
+        return np.array([int(Decimal(_value) // Decimal(divisor)) for _value in df[column].tolist()], dtype=np.int64)
+
+    # 値 = オフセット + 整数 * 10**-scale なので、オフセットの商と余りを先に求めておけば残りはint64の割り算になる
+    _scale = _fixedpoint['scales'][column]
+    _offset = Decimal(_fixedpoint['offsets'].get(column, Decimal(0)))
+    _divisor = Decimal(divisor)
+    _offset_quotient = int(_offset // _divisor)
+    _offset_remainder = int((_offset - _offset_quotient * _divisor).scaleb(_scale) // 1)
+    _scaled_divisor = _divisor.scaleb(_scale)
+    if _scaled_divisor != _scaled_divisor.to_integral_value():
+        raise ValueError(f'divisor {divisor} は小数点以下{_scale}桁で表せません')
+    return _offset_quotient + (df[column].to_numpy(dtype=np.int64) + _offset_remainder) // int(_scaled_divisor)
+
+@_exact_decimal
+def greater_than(df=None, column=None, value=None):
+    """
+    データフレームの列の値がvalueより大きいかどうかのbool配列を返す関数。固定小数点列の場合はscaleとオフセットを反映して比較する
+    """
+    _fixedpoint = get_fixedpoint_attrs(df)
+    if _fixedpoint is None or column not in _fixedpoint['scales']:
+        return (df[column] > Decimal(value)).to_numpy()
+
+    # 整数xについて x * 10**-scale + offset > value は x > floor((value - offset) * 10**scale) と同値
+    _scale = _fixedpoint['scales'][column]
+    _offset = Decimal(_fixedpoint['offsets'].get(column, Decimal(0)))
+    _threshold = int(((Decimal(value) - _offset).scaleb(_scale)) // 1)
+    _values = df[column].to_numpy(dtype=np.int64)
+    if _threshold >= INT64_SAFE_MAX:
+        return np.zeros(len(_values), dtype=bool)
+    if _threshold <= -INT64_SAFE_MAX:
+        return np.ones(len(_values), dtype=bool)
+    return _values > _threshold
@@ -0,0 +1,226 @@
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    """
+    処理段階ごとの所要時間とカウンタを集計するクラス。複数スレッドから共有できる
+    所要時間は回数・合計秒数・最大秒数を、カウンタは合計値を、名前とラベルの組ごとに保持する。
+    パラメータ
+    ----------
+    prefix : str, default = 'crypto_trades'
+        Prometheus形式で出力するときのメトリクス名の接頭辞。
+    """
+    def __init__(self, prefix = 'crypto_trades'):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted([(_label, str(_value)) for _label, _value in labels.items()])))
+
+    def inc(self, name = None, value = 1, **labels):
+        """
+        カウンタを増やす関数
+        パラメータ
+        ----------
+        name : str, 必須
+            カウンタ名。例: requests
+        value : int, default = 1
+            増やす値。
+        labels : str
+            カウンタを区別するラベル。例: exchange='binance'
+        """
+        _key = self._key(name, labels)
+        with self._lock:
+            self._counters[_key] = self._counters.get(_key, 0) + value
+
+    def observe(self, name = None, seconds = 0.0, **labels):
+        """
+        処理段階の所要時間を1回分記録する関数
+        """
+        _key = self._key(name, labels)
+        with self._lock:
+            _timer = self._timers.get(_key)
+            if _timer is None:
+                _timer = {'count': 0, 'sum': 0.0, 'max': 0.0}
+                self._timers[_key] = _timer
+            _timer['count'] += 1
+            _timer['sum'] += seconds
+            _timer['max'] = max(_timer['max'], seconds)
+
+    @contextmanager
+    def timer(self, name = None, **labels):
+        """
+        withブロックの所要時間をobserveで記録するコンテキストマネージャ。例外で抜けた場合も記録する
+
+        使用例
+        -------
+        with metrics.timer('http_fetch', exchange='binance'):
+            ccxt_client.fetch_trades(symbol)
+        """
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - _start, **labels)
+
+    def reset(self):
+        """
+        集計した値を全て消す関数
+        """
+        with self._lock:
+            self._counters = {}
+            self._timers = {}
+
+    def snapshot(self):
+        """
+        集計した値をJSONに変換できるdictで返す関数
+
+        返り値
+        -------
+        dict
+            counters(name, labels, value)とtimers(name, labels, count, sum, max)のリストを持つdict。
+        """
+        with self._lock:
+            return {
+                'counters': [{'name': _name, 'labels': dict(_labels), 'value': _value} for (_name, _labels), _value in sorted(self._counters.items())],
+                'timers': [{'name': _name, 'labels': dict(_labels), **_timer} for (_name, _labels), _timer in sorted(self._timers.items())],
+            }
+
+    def to_prometheus(self):
+        """
+        集計した値をPrometheusのテキスト形式で返す関数
+        カウンタは<prefix>_<name>_total、所要時間は<prefix>_<name>_seconds_count / _sum / _maxとして出力する。
+        """
+        _snapshot = self.snapshot()
+        _lines = []
+        _types = set()
+        for _counter in _snapshot['counters']:
+            # カウンタは名前順に並んでいるので、同じ名前の行は続けて出力される
+            _metric = f"{self._prefix}_{_counter['name']}_total"
+            if _metric not in _types:
+                _lines.append(f'# TYPE {_metric} counter')
+                _types.add(_metric)
+            _lines.append(f"{_metric}{self._format_labels(_counter['labels'])} {_counter['value']}")
+        # 同じメトリクスの行はまとめて出力する必要があるので、最大秒数は名前ごとに別のgaugeとして続けて出力する
+        _names = sorted(set([_timer['name'] for _timer in _snapshot['timers']]))
+        for _name in _names:
+            _metric = f'{self._prefix}_{_name}_seconds'
+            _timers = [_timer for _timer in _snapshot['timers'] if _timer['name'] == _name]
+            _lines.append(f'# TYPE {_metric} summary')
+            for _timer in _timers:
+                _labels = self._format_labels(_timer['labels'])
+                _lines.append(f"{_metric}_count{_labels} {_timer['count']}")
+                _lines.append(f"{_metric}_sum{_labels} {_timer['sum']:.6f}")
+            _lines.append(f'# TYPE {_metric}_max gauge')
+            for _timer in _timers:
+                _lines.append(f"{_metric}_max{self._format_labels(_timer['labels'])} {_timer['max']:.6f}")
+        return '\n'.join(_lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels):
+        if len(labels) <= 0:
+            return ''
+        _values = [f'{_label}="{_value}"'.replace('\n', ' ') for _label, _value in labels.items()]
+        return '{' + ','.join(_values) + '}'
+
+    def log_json(self, file = None):
+        """
+        集計した値を1行のJSONとして書き出す関数
+        パラメータ
+        ----------
+        file : file object, default = None
+            書き出し先。Noneの場合は標準エラー出力。
+        """
+        _file = file if file is not None else sys.stderr
+        _record = {'timestamp': time.time(), **self.snapshot()}
+        _file.write(json.dumps(_record) + '\n')
+        _file.flush()
+
+    def start_json_log(self, interval = 60.0, file = None):
+        """
+        interval秒ごとにlog_jsonを呼ぶデーモンスレッドを開始する関数
+
+        返り値
+        -------
+        stop_event : threading.Event
+            setするとスレッドを終了する。
+        """
+        _stop_event = threading.Event()
+
+        def _run():
+            while _stop_event.wait(interval) == False:
+                self.log_json(file)
+
+        threading.Thread(target=_run, name='metrics-json-log', daemon=True).start()
+        return _stop_event
+
+    def start_http_server(self, port = 9100, host = '0.0.0.0'):
+        """
+        /metricsでPrometheus形式、/metrics.jsonでJSON形式の集計値を返すHTTPサーバーをデーモンスレッドで開始する関数
+
+        返り値
+        -------
+        server : http.server.ThreadingHTTPServer
+            shutdown()で停止する。
+        """
+        _metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    _body = _metrics.to_prometheus().encode()
+                    _content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    _body = json.dumps(_metrics.snapshot()).encode()
+                    _content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', _content_type)
+                self.send_header('Content-Length', str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, format, *args):
+                # スクレイプのたびにアクセスログを出さない
+                pass
+
+        _server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+        return _server
+
+@contextmanager
+def profile(path = None, sort = 'cumulative', limit = 30):
+    """
+    withブロックをcProfileで計測するコンテキストマネージャ
+    py-spyで計測する場合はこの関数を使わずに外部からアタッチすればよい。各スレッドには処理内容がわかる名前を付けてある。
+    パラメータ
+    ----------
+    path : str, default = None
+        計測結果を書き出すファイル。snakevizなどで読める。Noneの場合は上位limit件を標準エラー出力に表示する。
+    sort : str, default = 'cumulative'
+        表示するときの並び順。
+    limit : int, default = 30
+        表示する関数の数。
+    """
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    try:
+        yield _profiler
+    finally:
+        _profiler.disable()
+        if path is not None:
+            _profiler.dump_stats(path)
+        else:
+            pstats.Stats(_profiler, stream=sys.stderr).sort_stats(sort).print_stats(limit)
@@ -0,0 +1,571 @@
+import json
+import os
+import glob
+import shutil
+import time
+import uuid
+
+from decimal import Decimal, localcontext
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from bulk_load_util import LOAD_TRADE_COLUMNS, LOAD_BAR_COLUMNS, DEFAULT_BAR_COLUMNS, get_load_type, check_load_params, empty_load_table, load_with_cache
+from fixedpoint_util import FIXEDPOINT_ATTRS_KEY, INT64_SAFE_MAX, DECIMAL_PRECISION, get_fixedpoint_attrs
+
+# 数値列はNUMERICの代わりに小数点以下18桁の128bit固定小数点で保存する。どのファイルも同じ型になるのでArrowのデータセットとしてまとめて読める
+DECIMAL_TYPE = pa.decimal128(38, 18)
+
+TRADE_COLUMNS = ['datetime', 'id', 'side', 'liquidation', 'price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+TRADE_NUMERIC_COLUMNS = ['price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+TRADE_CUMSUM_COLUMNS = ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+DOLLARBAR_COLUMNS = ['datetime', 'datetime_from', 'id', 'id_from', 'open', 'high', 'low', 'close', 'amount', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+DOLLARBAR_NUMERIC_COLUMNS = DOLLARBAR_COLUMNS[4:]
+
+# テーブルの種類ごとの列の型と、パーティション内の並び順
+_TABLE_SCHEMAS = {
+    'trade': {
+        'schema': pa.schema([('datetime', pa.timestamp('ns', tz='UTC')), ('id', pa.string()), ('side', pa.string()), ('liquidation', pa.bool_())] + [(_column, DECIMAL_TYPE) for _column in TRADE_NUMERIC_COLUMNS]),
+        'sort_keys': [('dollar_cumsum', 'ascending'), ('id', 'ascending')],
+    },
+    'dollarbar': {
+        'schema': pa.schema([('datetime', pa.timestamp('ns', tz='UTC')), ('datetime_from', pa.timestamp('ns', tz='UTC')), ('id', pa.string()), ('id_from', pa.string())] + [(_column, DECIMAL_TYPE) for _column in DOLLARBAR_NUMERIC_COLUMNS]),
+        'sort_keys': [('datetime', 'ascending'), ('id', 'ascending')],
+    },
+}
+
+_UINT64_MASK = 2**64 - 1
+
+def _int128_limbs(array):
+    # decimal128配列のデータバッファを、下位64bit(uint64)と上位64bit(int64)の配列として読む
+    _words = np.frombuffer(array.buffers()[1], dtype=np.int64)[array.offset * 2:(array.offset + len(array)) * 2].reshape(-1, 2)
+    return _words[:, 0].view(np.uint64), _words[:, 1]
+
+def scaled_int_to_arrow_decimal(values=None, scale=0, offset=Decimal(0)):
+    """
+    10**scale倍されたint64の配列にオフセットを足した値を、DECIMAL_TYPEのArrow配列に正確に変換する関数
+    パラメータ
+    ----------
+    values : numpy.ndarray (int64), 必須
+        10**scale倍された整数値。
+    scale : int, default = 0
+        小数点以下の桁数。
+    offset : Decimal, default = Decimal(0)
+        各値に足すオフセット。
+
+    返り値
+    -------
+    pyarrow.Array (decimal128(38, 18))
+        オフセットが小数点以下scale桁で表せない場合はOverflowErrorを送出する。
+        scaleが18より大きい場合、値とオフセットの19桁目以降が全て0であれば18桁にそろえ、そうでなければ値を丸めずに保存できないのでValueErrorを送出する。
+    """
+    values = np.ascontiguousarray(values, dtype=np.int64)
+    with localcontext() as _context:
+        _context.prec = DECIMAL_PRECISION
+        if scale > DECIMAL_TYPE.scale:
+            # 例えばpriceとamountが10桁ずつのdollarは20桁になる。余分な桁が0であれば値を変えずに18桁にできる
+            _divisor = 10 ** (scale - DECIMAL_TYPE.scale)
+            _remainders = values % _divisor if _divisor <= np.iinfo(np.int64).max else values
+            _offset = Decimal(offset).scaleb(DECIMAL_TYPE.scale)
+            if np.any(_remainders != 0) or _offset != _offset.to_integral_value():
+                raise ValueError(f'小数点以下{scale}桁の値は、丸めずに小数点以下{DECIMAL_TYPE.scale}桁の{DECIMAL_TYPE}で保存できません')
+            values = values // _divisor if _divisor <= np.iinfo(np.int64).max else np.zeros(len(values), dtype=np.int64)
+            scale = DECIMAL_TYPE.scale
+        _offset = Decimal(offset).scaleb(scale)
+    if _offset != _offset.to_integral_value() or abs(_offset) >= 10**37:
+        raise OverflowError(f'オフセット {offset} は小数点以下{scale}桁の128bit整数で表せません')
+    _offset = int(_offset)
+
+    # 128bit整数として値 + オフセットを計算する。下位64bitの桁上がりを上位64bitに足す
+    _values_lo = values.view(np.uint64)
+    _lo = _values_lo + np.uint64(_offset & _UINT64_MASK)
+    _carry = (_lo < _values_lo).astype(np.int64)
+    _hi = np.where(values < 0, np.int64(-1), np.int64(0)) + np.int64(_offset >> 64) + _carry
+
+    _words = np.empty((len(values), 2), dtype=np.int64)
+    _words[:, 0] = _lo.view(np.int64)
+    _words[:, 1] = _hi
+    _array = pa.Array.from_buffers(pa.decimal128(38, scale), len(values), [None, pa.py_buffer(_words)])
+    return pc.cast(_array, DECIMAL_TYPE)
+
+def arrow_decimal_to_scaled_int(array=None, scale=0, offset=Decimal(0)):
+    """
+    decimal128のArrow配列からオフセットを引き、10**scale倍したint64の配列に正確に変換する関数
+    パラメータ
+    ----------
+    array : pyarrow.Array or pyarrow.ChunkedArray, 必須
+        decimal128の配列。
+    scale : int, default = 0
+        小数点以下の桁数。値はこの桁数で表せる必要がある。
+    offset : Decimal, default = Decimal(0)
+        各値から引くオフセット。
+
+    返り値
+    -------
+    numpy.ndarray (int64)
+        int64で表せない値が含まれる場合はOverflowErrorを送出する。
+    """
+    _array = pc.cast(array, pa.decimal128(38, scale))
+    if isinstance(_array, pa.ChunkedArray):
+        _array = _array.combine_chunks()
+    if len(_array) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    _offset = int(Decimal(offset).scaleb(scale))
+    _lo, _hi = _int128_limbs(_array)
+    _offset_lo = np.uint64(_offset & _UINT64_MASK)
+    _result = _lo - _offset_lo
+    _hi = _hi - np.int64(_offset >> 64) - (_lo < _offset_lo).astype(np.int64)
+
+    # 上位64bitが下位64bitの符号拡張になっていればint64で表せる
+    _result = _result.view(np.int64)
+    if np.any(_hi != (_result >> 63)) or np.abs(_result).max() >= INT64_SAFE_MAX:
+        raise OverflowError('int64で表現できない値が含まれています')
+    return _result
+
+def get_arrow_decimal_scale(array=None):
+    """
+    decimal128のArrow配列の値を全て表せる最小の小数点以下の桁数を返す関数
+    """
+    for _scale in range(0, array.type.scale):
+        try:
+            pc.cast(array, pa.decimal128(38, _scale))
+            return _scale
+        except pa.ArrowInvalid:
+            continue
+    return array.type.scale
+
+class ParquetStoreUtil:
+    """
+    約定履歴とドルバー情報を日付ごとに分割したParquetファイルに保存、読み込むユーティリティクラス
+    TimeScaleDBUtilと同じメソッドを持つので、TradesDownloadUtilとDollarbarGenerateUtilの保存先として使える。
+    ファイルは<root_dir>/<exchange>/<symbol>/date=YYYY-MM-DD/part.parquetに保存し、ドルバーは<symbol>_dollarbar_<interval>ディレクトリ(他の種類のバーは<symbol>_<bar_type>bar_<interval>)に保存する。
+    パラメータ
+    ----------
+    root_dir : str, 必須
+        Parquetファイルを保存するディレクトリ。
+    """
+    def __init__(self, root_dir = None):
+        if root_dir == None:
+            raise ValueError(f'Parquetファイルを保存するディレクトリを指定してください')
+
+        self._root_dir = os.path.expanduser(root_dir)
+        self._tables = {}
+        self._written_partitions = {}
+        os.makedirs(self._root_dir, exist_ok=True)
+
+    def _get_symbol_dir(self, exchange, symbol):
+        return os.path.join(self._root_dir, exchange.lower(), symbol.replace('/', '-').replace(':', '-'))
+
+    def _register_table(self, table_name, table_dir, kind):
+        self._tables[table_name] = {'dir': table_dir, 'kind': kind}
+        return table_name
+
+    def _get_table(self, table_name):
+        if table_name not in self._tables:
+            raise ValueError(f'テーブル {table_name} はget_trade_table_nameまたはget_bar_table_nameで作成されていません')
+        return self._tables[table_name]
+
+    def table_exists(self, table_name = None):
+        """
+        指定されたテーブルに書き込まれたパーティションが存在するかを返す関数
+        """
+        if table_name not in self._tables:
+            return False
+        return len(self._list_partitions(self._tables[table_name]['dir'])) > 0
+
+    def get_dataset(self, table_name = None):
+        """
+        指定されたテーブルの全てのパーティションをArrowのデータセットとして返す関数
+        列の選択や行の絞り込みはスキャン時にファイル単位で行われ、必要な部分だけが読み込まれる。date列にはパーティションの日付が入る。
+        パラメータ
+        ----------
+        table_name : str, 必須
+            読み込むテーブル名。
+
+        返り値
+        -------
+        pyarrow.dataset.Dataset
+        """
+        _table = self._get_table(table_name)
+        return ds.dataset(_table['dir'], format='parquet', partitioning='hive')
+
+    def _list_partitions(self, table_dir):
+        # date=YYYY-MM-DDディレクトリを日付順に並べ、それぞれのParquetファイルのリストを返す
+        _partitions = []
+        for _partition_dir in sorted(glob.glob(os.path.join(table_dir, 'date=*'))):
+            _files = sorted(glob.glob(os.path.join(_partition_dir, '*.parquet')))
+            if len(_files) > 0:
+                _partitions.append((os.path.basename(_partition_dir)[len('date='):], _files))
+        return _partitions
+
+    def _df_to_arrow(self, df, kind):
+        # データフレームをテーブルの種類ごとのスキーマのArrowテーブルに変換する。固定小数点列は整数のまま変換する
+        _schema = _TABLE_SCHEMAS[kind]['schema']
+        _fixedpoint = get_fixedpoint_attrs(df)
+        _arrays = []
+        for _field in _schema:
+            _values = df[_field.name]
+            if pa.types.is_timestamp(_field.type):
+                _arrays.append(pa.array(pd.to_datetime(_values, utc=True), type=_field.type))
+            elif pa.types.is_boolean(_field.type):
+                _arrays.append(pa.array(_values.to_numpy() if _values.dtype == bool else _values.astype(str).str.lower().to_numpy() == 'true', type=_field.type))
+            elif pa.types.is_string(_field.type):
+                _arrays.append(pa.array([None if pd.isna(_value) else str(_value) for _value in _values.tolist()], type=_field.type))
+            elif _fixedpoint is not None and _field.name in _fixedpoint['scales']:
+                _arrays.append(scaled_int_to_arrow_decimal(_values.to_numpy(dtype=np.int64), _fixedpoint['scales'][_field.name], _fixedpoint['offsets'].get(_field.name, Decimal(0))))
+            else:
+                try:
+                    _arrays.append(pa.array([_value if isinstance(_value, Decimal) else Decimal(str(_value)) for _value in _values.tolist()], type=_field.type))
+                except pa.ArrowInvalid as e:
+                    # 小数点以下18桁より細かい値や38桁を超える値は、丸めずに保存できない
+                    raise ValueError(f'{_field.name}列に{_field.type}で正確に保存できない値が含まれています : {e}')
+        return pa.Table.from_arrays(_arrays, schema=_schema)
+
+    def _write_table(self, table, table_dir):
+        # 日付ごとのディレクトリに新しいpartファイルとして書き込む。書き込み途中のファイルは読まれないように最後に名前を変える
+        _dates = pc.strftime(table['datetime'], format='%Y-%m-%d').to_numpy(zero_copy_only=False)
+        for _date in np.unique(_dates):
+            _partition_dir = os.path.join(table_dir, f'date={_date}')
+            os.makedirs(_partition_dir, exist_ok=True)
+            _path = os.path.join(_partition_dir, f'part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet')
+            pq.write_table(table.filter(pa.array(_dates == _date)), f'{_path}.tmp')
+            os.replace(f'{_path}.tmp', _path)
+        return np.unique(_dates).tolist()
+
+    def _read_partition(self, files, kind):
+        # パーティション内のpartファイルをメモリマップで読み、重複を除いて並べ替える
+        _tables = [pq.read_table(_file, memory_map=True) for _file in files]
+        _table = pa.concat_tables(_tables) if len(_tables) > 1 else _tables[0]
+        if len(_tables) > 1:
+            # DBのUNIQUE(datetime, id)と同じく、同じ約定が複数のpartファイルに書かれていれば1つだけ残す
+            _keys = pd.DataFrame({'datetime': _table['datetime'].to_numpy(), 'id': _table['id'].to_numpy(zero_copy_only=False)})
+            _table = _table.filter(pa.array(~_keys.duplicated().to_numpy()))
+        return _table.sort_by(_TABLE_SCHEMAS[kind]['sort_keys'])
+
+    def _compact_partition(self, partition_dir, kind):
+        # パーティション内のpartファイルを1つのpart.parquetにまとめる
+        _files = sorted(glob.glob(os.path.join(partition_dir, '*.parquet')))
+        if len(_files) <= 1 and all([os.path.basename(_file) == 'part.parquet' for _file in _files]):
+            return
+        _path = os.path.join(partition_dir, 'part.parquet')
+        pq.write_table(self._read_partition(_files, kind), f'{_path}.tmp')
+        os.replace(f'{_path}.tmp', _path)
+        for _file in _files:
+            if _file != _path:
+                os.remove(_file)
+
+    def compact_partitions(self, table_name = None):
+        """
+        複数のpartファイルに分かれたパーティションを1つのpart.parquetにまとめる関数
+        パラメータ
+        ----------
+        table_name : str, default = None
+            まとめるテーブル名。Noneの場合はこのインスタンスで書き込んだ全てのパーティションをまとめる。
+        """
+        _table_names = list(self._tables.keys()) if table_name == None else [table_name]
+        for _table_name in _table_names:
+            _table = self._get_table(_table_name)
+            if table_name == None:
+                _dates = sorted(self._written_partitions.pop(_table['dir'], set()))
+            else:
+                _dates = [_date for _date, _ in self._list_partitions(_table['dir'])]
+            for _date in _dates:
+                self._compact_partition(os.path.join(_table['dir'], f'date={_date}'), _table['kind'])
+
+    def df_to_sql(self, df = None, schema = None, if_exists = 'fail', method = None, on_conflict_do_nothing = True, checkpoint = None):
+        """
+        データフレームを指定されたテーブルのパーティションに書き込む関数
+        パラメータ
+        ----------
+        df : pandas.DataFrame, 必須
+            書き込むデータフレーム。数値列はDecimalまたは固定小数点のint64。
+        schema : str, 必須
+            書き込み先のテーブル名。
+        if_exists : str, default = 'fail'
+            DataFrame.to_sqlと同じ意味を持つ。
+        method : str, default = None
+            TimeScaleDBUtil.df_to_sqlとの互換性のための引数。使わない。
+        on_conflict_do_nothing : bool, default = True
+            TimeScaleDBUtil.df_to_sqlとの互換性のための引数。重複した約定は読み込み時とパーティションをまとめる時に取り除く。
+        checkpoint : dict, default = None
+            約定を書き込んだ後に保存するチェックポイント(set_trade_checkpoint参照)。パーティションを書き込んでから保存するので、
+            途中で停止してもチェックポイントより後の約定は再ダウンロードされ、重複は読み込み時に取り除かれる。
+
+        返り値
+        -------
+        書き込んだ行数。
+        """
+        if df is None or df.empty or schema == None:
+            return
+        if if_exists not in ['fail', 'replace', 'append']:
+            raise ValueError(f'if_exists には fail, replace, append のいずれかを指定してください : {if_exists}')
+
+        _table = self._get_table(schema)
+        if self.table_exists(schema) and if_exists == 'fail':
+            raise ValueError(f'テーブル {schema} は既に存在します')
+        if if_exists == 'replace' and os.path.exists(_table['dir']):
+            shutil.rmtree(_table['dir'])
+
+        _dates = self._write_table(self._df_to_arrow(df, _table['kind']), _table['dir'])
+
+        # ダウンロードは日付順に進むので、今回書き込んだ日付より前のパーティションにはもう追記されない。まとめておく
+        _written = self._written_partitions.setdefault(_table['dir'], set())
+        for _date in sorted([_date for _date in _written if _date < _dates[0]]):
+            self._compact_partition(os.path.join(_table['dir'], f'date={_date}'), _table['kind'])
+            _written.discard(_date)
+        _written.update(_dates)
+
+        if checkpoint is not None:
+            self.set_trade_checkpoint(checkpoint)
+        return len(df)
+
+    def _read_edge_row(self, table_name, last):
+        # 最初(または最後)のパーティションの最初(または最後)の行をDecimalの数値列を持つSeriesで返す
+        _table = self._get_table(table_name)
+        _partitions = self._list_partitions(_table['dir'])
+        if len(_partitions) <= 0:
+            return None
+        _arrow_table = self._read_partition(_partitions[-1 if last else 0][1], _table['kind'])
+        if _arrow_table.num_rows <= 0:
+            return None
+        return self._arrow_to_df(_arrow_table.slice(_arrow_table.num_rows - 1 if last else 0, 1)).iloc[0]
+
+    def _arrow_to_df(self, table):
+        # 数値列は値を表せる最小の桁数のDecimalにしてからデータフレームに変換する
+        for _index, _field in enumerate(table.schema):
+            if pa.types.is_decimal(_field.type):
+                table = table.set_column(_index, _field.name, pc.cast(table[_field.name], pa.decimal128(38, get_arrow_decimal_scale(table[_field.name]))))
+        return table.to_pandas()
+
+    def _arrow_to_fixedpoint_df(self, table, numeric_columns, cumsum_columns):
+        # 数値列を固定小数点のint64に変換する。累積和は先頭行の値をオフセットにする
+        _columns = {}
+        _scales = {}
+        _offsets = {}
+        for _field in table.schema:
+            if _field.name not in numeric_columns:
+                continue
+            _scales[_field.name] = get_arrow_decimal_scale(table[_field.name])
+            _array = pc.cast(table[_field.name], pa.decimal128(38, _scales[_field.name]))
+            _offset = Decimal(0)
+            if _field.name in cumsum_columns:
+                _offset = _array[0].as_py()
+                _offsets[_field.name] = _offset
+            _columns[_field.name] = arrow_decimal_to_scaled_int(_array, _scales[_field.name], _offset)
+
+        _df = table.drop_columns(list(_columns.keys())).to_pandas()
+        for _column, _values in _columns.items():
+            _df[_column] = _values
+        _df = _df[table.column_names]
+        _df.attrs[FIXEDPOINT_ATTRS_KEY] = {'scales': _scales, 'offsets': _offsets}
+        return _df
+
+    def _get_partition_max(self, files, column):
+        # Parquetの統計情報から列の最大値を求める。統計情報がなければ列を読む
+        _max = None
+        for _file in files:
+            _metadata = pq.ParquetFile(_file).metadata
+            _index = _metadata.schema.to_arrow_schema().get_field_index(column)
+            for _row_group in range(_metadata.num_row_groups):
+                _statistics = _metadata.row_group(_row_group).column(_index).statistics
+                if _statistics is None or _statistics.has_min_max == False:
+                    _value = pc.max(pq.read_table(_file, columns=[column], memory_map=True)[column]).as_py()
+                else:
+                    _value = _statistics.max
+                if _value is not None and (_max is None or _value > _max):
+                    _max = _value
+        return _max
+
+    ### 約定履歴テーブル関係の処理
+    def get_trade_table_name(self, exchange, symbol):
+        return self._register_table((f'{exchange}_{symbol}_trade').lower(), self._get_symbol_dir(exchange, symbol), 'trade')
+
+    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False):
+        _table_dir = self._get_table(self.get_trade_table_name(exchange, symbol))['dir']
+        if force == True and os.path.exists(_table_dir):
+            shutil.rmtree(_table_dir)
+        if force == True and os.path.exists(self._get_checkpoint_path(exchange, symbol)):
+            os.remove(self._get_checkpoint_path(exchange, symbol))
+        os.makedirs(_table_dir, exist_ok=True)
+
+    def _get_checkpoint_path(self, exchange, symbol):
+        # データセットとして読むディレクトリの外に置く
+        return f'{self._get_symbol_dir(exchange, symbol)}.checkpoint.json'
+
+    def set_trade_checkpoint(self, checkpoint = None):
+        """
+        ダウンロードの再開位置をJSONファイルに保存する関数
+        パラメータ
+        ----------
+        checkpoint : dict, 必須
+            exchange, symbol, datetime, id, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum, bybit_file_dateをキーに持つdict。
+        """
+        _path = self._get_checkpoint_path(checkpoint['exchange'], checkpoint['symbol'])
+        _previous = self.get_trade_checkpoint(checkpoint['exchange'], checkpoint['symbol'])
+        if _previous is not None and _previous['dollar_cumsum'] > Decimal(checkpoint['dollar_cumsum']):
+            return
+
+        _bybit_file_date = checkpoint.get('bybit_file_date')
+        if _bybit_file_date is None and _previous is not None:
+            _bybit_file_date = _previous['bybit_file_date']
+        _values = {
+            'datetime': pd.Timestamp(checkpoint['datetime']).isoformat(),
+            'id': str(checkpoint['id']),
+            'dollar_cumsum': str(checkpoint['dollar_cumsum']),
+            'buy_dollar_cumsum': str(checkpoint['buy_dollar_cumsum']),
+            'sell_dollar_cumsum': str(checkpoint['sell_dollar_cumsum']),
+            'bybit_file_date': None if _bybit_file_date is None else pd.Timestamp(_bybit_file_date).strftime('%Y-%m-%d'),
+        }
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        with open(f'{_path}.tmp', 'w') as _f:
+            json.dump(_values, _f)
+        os.replace(f'{_path}.tmp', _path)
+
+    def get_trade_checkpoint(self, exchange='ftx', symbol='BTC-PERP'):
+        """
+        保存されているダウンロードの再開位置をpandas.Seriesで返す関数。ない場合はNone
+        """
+        _path = self._get_checkpoint_path(exchange, symbol)
+        if os.path.exists(_path) == False:
+            return None
+        with open(_path, 'r') as _f:
+            _values = json.load(_f)
+        return pd.Series({
+            'datetime': pd.Timestamp(_values['datetime']).tz_convert('UTC'),
+            'id': _values['id'],
+            'dollar_cumsum': Decimal(_values['dollar_cumsum']),
+            'buy_dollar_cumsum': Decimal(_values['buy_dollar_cumsum']),
+            'sell_dollar_cumsum': Decimal(_values['sell_dollar_cumsum']),
+            'bybit_file_date': None if _values['bybit_file_date'] is None else pd.Timestamp(_values['bybit_file_date'], tz='UTC'),
+        })
+
+    def get_latest_trade(self, exchange='ftx', symbol='BTC-PERP'):
+        return self._read_edge_row(self.get_trade_table_name(exchange, symbol), last=True)
+
+    def get_first_trade(self, exchange='ftx', symbol='BTC-PERP'):
+        return self._read_edge_row(self.get_trade_table_name(exchange, symbol), last=False)
+
+    def iter_trades(self, exchange='ftx', symbol='BTC-PERP', from_dollar_cumsum=None, from_id=None, fetch_size=10000, fixedpoint=False):
+        """
+        約定履歴をdollar_cumsum順にパーティションごとに読み出し、fetch_size件ずつのデータフレームを返すジェネレータ
+        引数と返り値はTimeScaleDBUtil.iter_tradesと同じ。パーティション(1日分)はメモリマップで読み込む。
+        """
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        _table = self._get_table(_table_name)
+        _partitions = self._list_partitions(_table['dir'])
+
+        # dollar_cumsumは日付順に増えるので、開始位置より後の約定を含む最初のパーティションから読む
+        if from_dollar_cumsum is not None:
+            from_dollar_cumsum = Decimal(from_dollar_cumsum)
+            while len(_partitions) > 0:
+                _max = self._get_partition_max(_partitions[0][1], 'dollar_cumsum')
+                if _max is not None and _max >= from_dollar_cumsum:
+                    break
+                _partitions.pop(0)
+
+        for _date, _files in _partitions:
+            _arrow_table = self._read_partition(_files, _table['kind'])
+
+            # 読み出し開始位置はキーセット(dollar_cumsum, id)で指定する
+            if from_dollar_cumsum is not None:
+                _dollar_cumsum = _arrow_table['dollar_cumsum']
+                _from = pa.scalar(from_dollar_cumsum, type=pa.decimal128(38, max(DECIMAL_TYPE.scale, -from_dollar_cumsum.as_tuple().exponent)))
+                _dollar_cumsum = pc.cast(_dollar_cumsum, _from.type)
+                _mask = pc.greater(_dollar_cumsum, _from)
+                if from_id is not None:
+                    _mask = pc.or_(_mask, pc.and_(pc.equal(_dollar_cumsum, _from), pc.greater(_arrow_table['id'], pa.scalar(str(from_id)))))
+                _arrow_table = _arrow_table.filter(_mask)
+                if _arrow_table.num_rows > 0:
+                    from_dollar_cumsum = None
+
+            for _offset in range(0, _arrow_table.num_rows, fetch_size):
+                _chunk = _arrow_table.slice(_offset, fetch_size)
+                if fixedpoint == True:
+                    try:
+                        yield self._arrow_to_fixedpoint_df(_chunk, TRADE_NUMERIC_COLUMNS, TRADE_CUMSUM_COLUMNS)
+                        continue
+                    except OverflowError:
+                        pass
+                yield self._arrow_to_df(_chunk)
+
+    ### ドルバーテーブル関係の処理
+    # ティックバーなど他の種類のバーもドルバーと同じ列を持つ<symbol>_<bar_type>bar_<interval>ディレクトリに保存する
+    def get_bar_table_name(self, exchange, symbol, bar_type, interval):
+        _symbol_dir = self._get_symbol_dir(exchange, symbol)
+        return self._register_table((f'{exchange}_{symbol}_{bar_type}bar_{interval}').lower(), f'{_symbol_dir}_{bar_type}bar_{interval}', 'dollarbar')
+
+    def get_dollarbar_table_name(self, exchange, symbol, interval):
+        return self.get_bar_table_name(exchange, symbol, 'dollar', interval)
+
+    def init_bar_table(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=10_000_000, force=False):
+        _table_dir = self._get_table(self.get_bar_table_name(exchange, symbol, bar_type, interval))['dir']
+        if force == True and os.path.exists(_table_dir):
+            shutil.rmtree(_table_dir)
+        os.makedirs(_table_dir, exist_ok=True)
+
+    def init_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000, force=False):
+        self.init_bar_table(exchange, symbol, 'dollar', interval, force)
+
+    def get_latest_bar(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=5_000_000):
+        return self._read_edge_row(self.get_bar_table_name(exchange, symbol, bar_type, interval), last=True)
+
+    def get_latest_dollarbar(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000):
+        return self.get_latest_bar(exchange, symbol, 'dollar', interval)
+
+    def load_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        return self.load_bars(exchange, symbol, 'dollar', interval, from_str, to_str, columns, output, cache_dir, refresh)
+
+    def _load_arrow(self, table_name, columns, from_str, to_str, sort_keys):
+        # 期間に含まれる日付のパーティションだけを読み、必要な列だけをload_trades / load_barsの型に変換する
+        _table = self._get_table(table_name)
+        _from = None if from_str is None else pd.Timestamp(from_str)
+        _to = None if to_str is None else pd.Timestamp(to_str)
+        _from = None if _from is None else (_from.tz_localize('UTC') if _from.tzinfo is None else _from.tz_convert('UTC'))
+        _to = None if _to is None else (_to.tz_localize('UTC') if _to.tzinfo is None else _to.tz_convert('UTC'))
+
+        _tables = []
+        for _date, _files in self._list_partitions(_table['dir']):
+            if (_from is not None and _date < _from.strftime('%Y-%m-%d')) or (_to is not None and _date > _to.strftime('%Y-%m-%d')):
+                continue
+            _arrow_table = self._read_partition(_files, _table['kind'])
+            _type = _arrow_table.schema.field('datetime').type
+            if _from is not None:
+                _arrow_table = _arrow_table.filter(pc.greater_equal(_arrow_table['datetime'], pa.scalar(_from, type=_type)))
+            if _to is not None:
+                _arrow_table = _arrow_table.filter(pc.less(_arrow_table['datetime'], pa.scalar(_to, type=_type)))
+            _tables.append(_arrow_table.select(list(set(columns) | set([_key for _key, _ in sort_keys]))))
+
+        if len(_tables) <= 0:
+            return empty_load_table(columns)
+        # パーティションは日付順なので、並べ替えは日をまたいで同じ値がある場合のためだけに行う
+        _arrow_table = pa.concat_tables(_tables).sort_by(sort_keys)
+        _arrays = []
+        for _column in columns:
+            _array = _arrow_table[_column]
+            if pa.types.is_timestamp(_array.type):
+                # ナノ秒の時刻はDBに保存した場合と同じくマイクロ秒に丸める
+                _array = pc.round_temporal(_array, unit='microsecond')
+            _arrays.append(_array.cast(get_load_type(_column)))
+        return pa.Table.from_arrays(_arrays, names=columns)
+
+    def load_trades(self, exchange='ftx', symbol='BTC-PERP', from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        """
+        約定履歴を期間で絞り込んで一括して読み出す関数。引数と返り値はTimeScaleDBUtil.load_tradesと同じ
+        """
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        _columns = check_load_params(LOAD_TRADE_COLUMNS if columns is None else columns, LOAD_TRADE_COLUMNS, output)
+        return load_with_cache(cache_dir, _table_name, _columns, from_str, to_str, output, refresh,
+                               lambda: self._load_arrow(_table_name, _columns, from_str, to_str, _TABLE_SCHEMAS['trade']['sort_keys']))
+
+    def load_bars(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=5_000_000, from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        """
+        バーを期間で絞り込んで一括して読み出す関数。引数と返り値はTimeScaleDBUtil.load_barsと同じ
+        """
+        _table_name = self.get_bar_table_name(exchange, symbol, bar_type, interval)
+        _columns = check_load_params(DEFAULT_BAR_COLUMNS if columns is None else columns, LOAD_BAR_COLUMNS, output)
+        return load_with_cache(cache_dir, _table_name, _columns, from_str, to_str, output, refresh,
+                               lambda: self._load_arrow(_table_name, _columns, from_str, to_str, [('dollar_cumsum', 'ascending')]))
@@ -0,0 +1,60 @@
+import threading
+import time
+
+class TokenBucketRateLimiter:
+    """
+    複数スレッドから共有できるトークンバケット方式のレートリミッタ
+    パラメータ
+    ----------
+    rate : float, 必須
+        1秒あたりに補充されるトークン数 (= 1秒あたりのリクエスト数の上限)。
+    capacity : float, default = 1
+        バケットに貯められるトークン数の上限。バースト時に連続して発行できるリクエスト数。
+    """
+    def __init__(self, rate = None, capacity = 1):
+        if rate == None or rate <= 0:
+            raise ValueError(f'トークンの補充レートには正の値を指定してください : {rate}')
+        if capacity < 1:
+            raise ValueError(f'バケットの容量には1以上の値を指定してください : {capacity}')
+
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_ccxt_client(cls, ccxt_client = None, ratelimit_multiplier = 1.0, capacity = 1):
+        """
+        ccxtクライアントのrateLimit(ミリ秒)からレートリミッタを作る関数
+        """
+        _interval_sec = ccxt_client.rateLimit * ratelimit_multiplier / 1000
+        return cls(rate = 1 / _interval_sec, capacity = capacity)
+
+    def acquire(self, tokens = 1):
+        """
+        トークンを取得できるまで待つ関数
+        パラメータ
+        ----------
+        tokens : float, default = 1
+            消費するトークン数。
+
+        返り値
+        -------
+        トークン取得までに待った秒数。
+        """
+        _waited = 0.0
+        while True:
+            with self._lock:
+                _now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (_now - self._last_refill) * self._rate)
+                self._last_refill = _now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return _waited
+
+                _wait = (tokens - self._tokens) / self._rate
+
+            time.sleep(_wait)
+            _waited += _wait
@@ -0,0 +1,58 @@
+import os
+import sys
+
+# モジュールはリポジトリ直下に置かれているので、テストからimportできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class ArchiveServer:
+    """
+    public.bybit.comの代わりに、filesに登録したパスのファイルを返すローカルのHTTPサーバー
+    登録していないパスは404を返す。failuresに登録したパスは、その回数だけ500を返してから本来の応答を返す。
+    """
+    def __init__(self):
+        self.files = {}
+        self.failures = {}
+        self.requests = []
+        _server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                _server.requests.append(self.path)
+                if _server.failures.get(self.path, 0) > 0:
+                    _server.failures[self.path] -= 1
+                    self.send_error(500)
+                    return
+                if self.path not in _server.files:
+                    self.send_error(404)
+                    return
+                _body = _server.files[self.path]
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}/trading'
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def count(self, path):
+        return self.requests.count(path)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+@pytest.fixture
+def archive_server():
+    _server = ArchiveServer()
+    yield _server
+    _server.close()
@@ -0,0 +1,53 @@
+import gzip
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from bybit_archive_util import BybitArchivePrefetcher
+
+_DATE = datetime(2021, 1, 2, tzinfo=timezone.utc)
+_PATH = '/trading/BTCUSD/BTCUSD2021-01-02.csv.gz'
+
+@pytest.fixture
+def prefetcher(archive_server, tmp_path):
+    return BybitArchivePrefetcher(cache_dir=str(tmp_path), base_url=archive_server.url, max_workers=2, retry=2, retry_wait=0.01)
+
+def test_fetch_uses_cache_until_checksum_mismatch(archive_server, prefetcher):
+    _body = gzip.compress(b'timestamp,side\n1609545600.0,Buy\n')
+    archive_server.files[_PATH] = _body
+
+    _path = prefetcher.fetch('BTCUSD', _DATE)
+    assert open(_path, 'rb').read() == _body
+    assert prefetcher.is_cached('BTCUSD', _DATE)
+
+    # チェックサムが一致するキャッシュはダウンロードし直さない
+    assert prefetcher.fetch('BTCUSD', _DATE) == _path
+    assert archive_server.count(_PATH) == 1
+
+    # 壊れたキャッシュはチェックサムが一致しないのでダウンロードし直す
+    with open(_path, 'wb') as _f:
+        _f.write(_body[:5])
+    assert prefetcher.is_cached('BTCUSD', _DATE) == False
+    assert open(prefetcher.fetch('BTCUSD', _DATE), 'rb').read() == _body
+    assert archive_server.count(_PATH) == 2
+
+def test_fetch_retries_server_errors(archive_server, prefetcher):
+    archive_server.files[_PATH] = gzip.compress(b'timestamp,side\n')
+    archive_server.failures[_PATH] = 2
+    assert prefetcher.fetch('BTCUSD', _DATE) is not None
+    assert archive_server.count(_PATH) == 3
+
+    # 再試行の回数を超えて失敗した場合は例外を送出し、書きかけのファイルを残さない
+    _date = datetime(2021, 1, 3, tzinfo=timezone.utc)
+    _path = '/trading/BTCUSD/BTCUSD2021-01-03.csv.gz'
+    archive_server.files[_path] = gzip.compress(b'timestamp,side\n')
+    archive_server.failures[_path] = 3
+    with pytest.raises(IOError):
+        prefetcher.fetch('BTCUSD', _date)
+    assert sorted(os.listdir(os.path.dirname(prefetcher.get_cache_path('BTCUSD', _date)))) == ['BTCUSD2021-01-02.csv.gz', 'BTCUSD2021-01-02.csv.gz.sha256']
+
+def test_fetch_returns_none_for_missing_file_without_retry(archive_server, prefetcher):
+    assert prefetcher.fetch('BTCUSD', _DATE) is None
+    assert archive_server.count(_PATH) == 1
+    assert prefetcher.is_cached('BTCUSD', _DATE) == False
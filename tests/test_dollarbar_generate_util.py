@@ -0,0 +1,82 @@
+import inspect
+import random
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+
+from benchmark import generate_synthetic_trades
+from dollarbar_generate_util import DollarbarAccumulator, DollarbarGenerateUtil, create_bar_sampler
+from fixedpoint_util import compute_dollar_cumsums
+from metrics_util import Metrics
+from parquet_store_util import ParquetStoreUtil
+from trades_download_util import TradesDownloadUtil
+
+_BARS = [('dollar', 50_000), ('tick', 37), ('volume', Decimal('5.5')), ('time', 60), ('dollar_imbalance', 10_000)]
+
+def test_server_side_aggregation_is_opt_in():
+    for _function in [DollarbarGenerateUtil.generate_dollarbar, DollarbarGenerateUtil.generate_bars]:
+        assert inspect.signature(_function).parameters['server_side'].default is False
+
+def _trades(rows=3_000):
+    # 0.7秒ごとの約定。数値列は固定小数点
+    _df = generate_synthetic_trades(rows, seed=1)
+    _start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    _df['datetime'] = [_start + timedelta(milliseconds=700 * _i) for _i in range(rows)]
+    _df['id'] = [f'{_i:08d}' for _i in range(rows)]
+    return compute_dollar_cumsums(_df[['datetime', 'id', 'side', 'liquidation', 'price', 'amount']], price_scale=1, amount_scale=3)
+
+def _accumulate(bar_type, interval, df, bounds):
+    _accumulator = DollarbarAccumulator(sampler=create_bar_sampler(bar_type, interval))
+    _bars = [_accumulator.update(df.iloc[_start:_end]) for _start, _end in zip(bounds[:-1], bounds[1:])]
+    _bars = pd.concat([_bar for _bar in _bars if len(_bar) > 0], ignore_index=True)
+    return _bars, _accumulator.get_open_bar()
+
+@pytest.mark.parametrize('bar_type, interval', _BARS)
+def test_bars_do_not_depend_on_chunking(bar_type, interval):
+    _df = _trades()
+    _expected_bars, _expected_open_bar = _accumulate(bar_type, interval, _df, [0, len(_df)])
+    assert len(_expected_bars) > 10
+
+    # 1約定ずつ、決まった大きさ、ランダムな大きさのチャンクに分けて渡しても同じバーになる
+    _rng = random.Random(7)
+    for _bounds in [list(range(0, 201)) + [len(_df)], list(range(0, len(_df), 97)) + [len(_df)], sorted(set([0, len(_df)] + [_rng.randint(1, len(_df) - 1) for _ in range(60)]))]:
+        _bars, _open_bar = _accumulate(bar_type, interval, _df, _bounds)
+        pd.testing.assert_frame_equal(_bars, _expected_bars)
+        pd.testing.assert_series_equal(_open_bar, _expected_open_bar)
+
+class _NoDownloadTradesUtil:
+    # 約定はテストで書き込むので、ダウンロードはしない
+    trades_params = TradesDownloadUtil.trades_params
+
+    def __init__(self):
+        self.metrics = Metrics()
+
+    def download_trades(self, exchange=None, symbol=None, since_datetime=None, concurrency=1):
+        pass
+
+def _generate(store, bars):
+    DollarbarGenerateUtil(store, tradesutil=_NoDownloadTradesUtil()).generate_bars('binance', 'BTC/USDT', bars)
+
+def test_generate_bars_resumes_from_the_latest_bar_of_each_type(tmp_path):
+    _df = _trades()
+    # 全ての約定から1回で生成したバー
+    _full_store = ParquetStoreUtil(str(tmp_path / 'full'))
+    _full_store.df_to_sql(df=_df, schema=_full_store.get_trade_table_name('binance', 'BTC/USDT'), if_exists='append')
+    _generate(_full_store, _BARS)
+
+    # 途中までの約定から生成した後、続きの約定を書き込んで最新のバーから再開する
+    _store = ParquetStoreUtil(str(tmp_path / 'resumed'))
+    _store.df_to_sql(df=_df.iloc[:1_234], schema=_store.get_trade_table_name('binance', 'BTC/USDT'), if_exists='append')
+    _generate(_store, _BARS)
+    for _bar_type, _interval in _BARS:
+        assert _store.get_latest_bar('binance', 'BTC/USDT', _bar_type, _interval) is not None
+    _store.df_to_sql(df=_df.iloc[1_234:], schema=_store.get_trade_table_name('binance', 'BTC/USDT'), if_exists='append')
+    _generate(_store, _BARS)
+
+    for _bar_type, _interval in _BARS:
+        _expected = _full_store.load_bars('binance', 'BTC/USDT', _bar_type, _interval)
+        _resumed = _store.load_bars('binance', 'BTC/USDT', _bar_type, _interval)
+        assert len(_expected) > 10
+        pd.testing.assert_frame_equal(_resumed.reset_index(drop=True), _expected.reset_index(drop=True))
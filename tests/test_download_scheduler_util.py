@@ -0,0 +1,38 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from benchmark import FakeCcxtExchange, InMemoryTradeStore
+from download_scheduler_util import TradesDownloadScheduler
+from window_controller_util import WindowDensityStore
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _fake_bequant(rows, trades_per_second):
+    # bequantのパラメータ(from, till)をbinanceのパラメータに読み替える偽の取引所
+    _base = FakeCcxtExchange.create(rows, trades_per_second)
+
+    class _Exchange(_base):
+        id = 'bequant'
+
+        def fetch_trades(self, symbol, since=None, limit=None, params={}):
+            _from, _till = [datetime.strptime(params[_key], '%Y-%m-%d %H:%M:%S.%f%z') for _key in ['from', 'till']]
+            _params = {'startTime': (_from - _EPOCH) // timedelta(milliseconds=1), 'endTime': (_till - _EPOCH) // timedelta(milliseconds=1), 'limit': params['limit']}
+            return super().fetch_trades(symbol, since, limit, _params)
+
+    return _Exchange
+
+def test_scheduler_shares_window_density_store(tmp_path):
+    _binance = FakeCcxtExchange.create(3_000, 2)
+    _bequant = _fake_bequant(3_000, 5)
+    _path = str(tmp_path / 'window_density.json')
+    _store = InMemoryTradeStore()
+    _scheduler = TradesDownloadScheduler(_store, since_datetime=_binance.get_start_datetime(), window_density_store=WindowDensityStore(_path), ccxt_clients={'binance': _binance(), 'bequant': _bequant()})
+
+    _results = _scheduler.run([('binance', 'BTC/USDT'), ('bequant', 'BTC/USDT')])
+    assert [_result['status'] for _result in _results] == ['ok', 'ok']
+
+    # 並列に書き込んでも、両方の取引所で学習した頻度がファイルに残る
+    with open(_path, 'r') as _f:
+        _densities = json.load(_f)
+    assert sorted(_densities.keys()) == ['bequant/BTC/USDT', 'binance/BTC/USDT']
+    assert _scheduler.get_tradesutil('binance')._window_density_store is _scheduler.get_tradesutil('bequant')._window_density_store
@@ -0,0 +1,123 @@
+import random
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fixedpoint_util import compute_dollar_cumsums, compute_dollar_cumsums_decimal, concat_fixedpoint, floor_divide, greater_than, fixedpoint_to_decimal, get_decimal_value, INT64_SAFE_MAX
+
+_VALUE_COLUMNS = ['price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+_CUMSUM_COLUMNS = ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+
+def _random_decimal_str(rng, max_integer_digits, max_fraction_digits):
+    # 末尾の0、整数部のない'.5'、指数表記も混ぜる
+    _integer = ''.join(rng.choice('0123456789') for _ in range(rng.randint(1, max_integer_digits))).lstrip('0') or '0'
+    _fraction = ''.join(rng.choice('0123456789') for _ in range(rng.randint(0, max_fraction_digits)))
+    _value = _integer if len(_fraction) == 0 else f'{_integer}.{_fraction}'
+    if _value.strip('0.') == '':
+        _value = '1'
+    _style = rng.random()
+    if _style < 0.1:
+        return format(Decimal(_value).normalize(), 'E')
+    if _style < 0.2 and _integer == '0' and len(_fraction) > 0:
+        return _value[1:]
+    return _value
+
+def _random_trades(rng, kind):
+    _length = rng.randint(1, 40)
+    if kind == 'float':
+        # ccxtの数値のようなfloat。有効桁数の多い値は文字列にすると17文字になる
+        _price = pd.Series([float(_random_decimal_str(rng, 6, 4)) if rng.random() < 0.8 else rng.random() * 10**rng.randint(0, 5) for _ in range(_length)], dtype='float64')
+        _amount = pd.Series([float(_random_decimal_str(rng, 3, 6)) for _ in range(_length)], dtype='float64')
+    elif kind == 'long':
+        # 16文字を超える文字列。大きい値はint64に収まらずDecimalにフォールバックする
+        _price = pd.Series([_random_decimal_str(rng, 12, 10) for _ in range(_length)], dtype=str)
+        _amount = pd.Series([_random_decimal_str(rng, 10, 10) for _ in range(_length)], dtype=str)
+    else:
+        _price = pd.Series([_random_decimal_str(rng, 6, 4) for _ in range(_length)], dtype=str)
+        _amount = pd.Series([_random_decimal_str(rng, 3, 6) for _ in range(_length)], dtype=str)
+
+    _df = pd.DataFrame({'side': [rng.choice(['buy', 'sell']) for _ in range(_length)], 'price': _price, 'amount': _amount})
+    if rng.random() < 0.3:
+        # Bybitのようにdollar列を持つ場合
+        _df['dollar'] = pd.Series([_random_decimal_str(rng, 8, 8) for _ in range(_length)], dtype=str)
+    return _df
+
+def _random_offsets(rng):
+    return [Decimal(0) if rng.random() < 0.3 else Decimal(_random_decimal_str(rng, 10, 6)) for _ in range(3)]
+
+def _compute(df, offsets, price_scale, amount_scale):
+    # trades_download_utilと同じく、int64で計算できない場合はDecimalで計算する
+    try:
+        return compute_dollar_cumsums(df, *offsets, price_scale, amount_scale), False
+    except OverflowError:
+        return compute_dollar_cumsums_decimal(df, *offsets), True
+
+def _assert_same_values(df, expected):
+    _df = fixedpoint_to_decimal(df)
+    for _column in _VALUE_COLUMNS:
+        assert _df[_column].tolist() == expected[_column].tolist(), _column
+
+def test_fixedpoint_matches_decimal_on_random_trades():
+    _rng = random.Random(20210101)
+    _overflows = 0
+    for _case in range(120):
+        _kind = ['string', 'float', 'long'][_case % 3]
+        _df = _random_trades(_rng, _kind)
+        _offsets = _random_offsets(_rng)
+        _price_scale, _amount_scale = _rng.randint(0, 8), _rng.randint(0, 8)
+        _expected = compute_dollar_cumsums_decimal(_df, *_offsets)
+
+        _result, _overflowed = _compute(_df, _offsets, _price_scale, _amount_scale)
+        _overflows += int(_overflowed)
+        if _overflowed == False:
+            _scales = _result.attrs['fixedpoint']['scales']
+            assert _scales['price'] >= _price_scale and _scales['amount'] >= _amount_scale
+            assert all(_result[_column].dtype == np.int64 for _column in _VALUE_COLUMNS)
+        _assert_same_values(_result, _expected)
+
+        # バッチに分けて前のバッチの最後の累積和をオフセットにし、つなげても1回で計算した結果と同じになる
+        _bounds = sorted(set([0, len(_df)] + [_rng.randint(0, len(_df)) for _ in range(_rng.randint(0, 3))]))
+        _chunks = []
+        _chunk_offsets = _offsets
+        for _start, _end in zip(_bounds[:-1], _bounds[1:]):
+            _chunk, _overflowed = _compute(_df.iloc[_start:_end].reset_index(drop=True), _chunk_offsets, _rng.randint(0, 8), _rng.randint(0, 8))
+            _overflows += int(_overflowed)
+            _chunk_offsets = [get_decimal_value(_chunk, _column) for _column in _CUMSUM_COLUMNS]
+            _chunks.append(_chunk)
+        _concat = concat_fixedpoint(_chunks)
+        _assert_same_values(_concat, _expected)
+
+        # 累積和をしきい値で割った商と、しきい値との比較もDecimalで計算した結果と一致する
+        _cumsums = _expected['dollar_cumsum'].tolist()
+        for _divisor in [Decimal(10) ** _rng.randint(0, 6), Decimal(_rng.randint(1, 10**6)), Decimal(_random_decimal_str(_rng, 4, 2))]:
+            _scale = (_concat.attrs.get('fixedpoint') or {'scales': {'dollar_cumsum': None}})['scales']['dollar_cumsum']
+            if _scale is not None and _divisor.scaleb(_scale) != _divisor.scaleb(_scale).to_integral_value():
+                with pytest.raises(ValueError):
+                    floor_divide(_concat, 'dollar_cumsum', _divisor)
+                continue
+            if max(_cumsums) // _divisor >= INT64_SAFE_MAX:
+                continue
+            assert floor_divide(_concat, 'dollar_cumsum', _divisor).tolist() == [int(_value // _divisor) for _value in _cumsums]
+
+        _values = [_rng.choice(_cumsums) + Decimal(_rng.choice([-1, 0, 1])).scaleb(-_rng.randint(0, 20)) for _ in range(5)] + [Decimal(-1), Decimal(10) ** 30]
+        for _value in _values:
+            assert greater_than(_concat, 'dollar_cumsum', _value).tolist() == [_cumsum > _value for _cumsum in _cumsums]
+
+    # 桁数の多い値ではint64を超えてDecimalで計算する場合も確認できている
+    assert _overflows > 0
+
+def test_float_inputs_use_shortest_representation():
+    _df = pd.DataFrame({'side': ['buy', 'sell'], 'price': [0.1, 0.30000000000000004], 'amount': [3.0, 2.0]})
+    _expected = compute_dollar_cumsums_decimal(_df)
+    assert _expected['dollar'].tolist() == [Decimal('0.3'), Decimal('0.60000000000000008')]
+    _assert_same_values(compute_dollar_cumsums(_df), _expected)
+
+def test_overflow_is_raised_instead_of_wrapping():
+    _df = pd.DataFrame({'side': ['buy', 'buy'], 'price': ['99999999999.99999999', '1'], 'amount': ['99999999.99999999', '1']})
+    with pytest.raises(OverflowError):
+        compute_dollar_cumsums(_df)
+    _df = pd.DataFrame({'side': ['buy'] * 3, 'price': ['3000000000'] * 3, 'amount': ['1000000000'] * 3})
+    with pytest.raises(OverflowError):
+        compute_dollar_cumsums(_df)
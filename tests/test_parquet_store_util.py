@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fixedpoint_util import compute_dollar_cumsums, fixedpoint_to_decimal
+from parquet_store_util import ParquetStoreUtil, scaled_int_to_arrow_decimal, DECIMAL_TYPE
+
+def test_scale_above_18_is_normalized_when_exact():
+    # 小数点以下20桁の値でも、19桁目以降が0であれば18桁で保存できる
+    _array = scaled_int_to_arrow_decimal(np.array([1500, -2500, 0], dtype=np.int64), 20, Decimal('1.25'))
+    assert _array.type == DECIMAL_TYPE
+    assert _array.to_pylist() == [Decimal('1.250000000000000015'), Decimal('1.249999999999999975'), Decimal('1.25')]
+
+    _array = scaled_int_to_arrow_decimal(np.array([0, 0], dtype=np.int64), 40, Decimal(0))
+    assert _array.to_pylist() == [Decimal(0), Decimal(0)]
+
+def test_scale_above_18_raises_when_digits_would_be_lost():
+    with pytest.raises(ValueError, match='丸めずに'):
+        scaled_int_to_arrow_decimal(np.array([100, 101], dtype=np.int64), 20, Decimal(0))
+    with pytest.raises(ValueError, match='丸めずに'):
+        scaled_int_to_arrow_decimal(np.array([100], dtype=np.int64), 20, Decimal('0.0000000000000000001'))
+    with pytest.raises(ValueError, match='丸めずに'):
+        scaled_int_to_arrow_decimal(np.array([1], dtype=np.int64), 40, Decimal(0))
+
+def _trades(prices, amounts):
+    return pd.DataFrame({
+        'datetime': pd.date_range('2021-01-01', periods=len(prices), freq='s', tz='UTC'),
+        'id': [str(_i) for _i in range(len(prices))],
+        'side': ['buy', 'sell'] * (len(prices) // 2) + ['buy'] * (len(prices) % 2),
+        'liquidation': [False] * len(prices),
+        'price': prices,
+        'amount': amounts,
+    })
+
+def test_write_trades_with_market_scale_above_18(tmp_path):
+    # 価格の小さいシンボルで、マーケット情報の桁数がpriceとamountで10桁ずつの場合、dollarは20桁になる
+    _store = ParquetStoreUtil(str(tmp_path))
+    _table_name = _store.get_trade_table_name('binance', 'BTC/USDT')
+    _df = compute_dollar_cumsums(_trades(['0.0025', '0.00251'], ['10.5', '2.25']), price_scale=10, amount_scale=10)
+    assert _df.attrs['fixedpoint']['scales']['dollar'] == 20
+    _store.df_to_sql(df=_df, schema=_table_name, if_exists='append')
+
+    _latest = _store.get_latest_trade('binance', 'BTC/USDT')
+    _expected = fixedpoint_to_decimal(_df).iloc[-1]
+    for _column in ['price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']:
+        assert _latest[_column] == _expected[_column]
+
+    # 18桁で表せない値は保存せずに例外を送出する
+    _df = compute_dollar_cumsums(_trades(['0.0000000001'], ['0.0000000001']))
+    with pytest.raises(ValueError):
+        _store.df_to_sql(df=_df, schema=_table_name, if_exists='append')
+    _df = fixedpoint_to_decimal(_df)
+    with pytest.raises(ValueError, match='dollar'):
+        _store.df_to_sql(df=_df, schema=_table_name, if_exists='append')
@@ -0,0 +1,675 @@
+import csv
+import inspect
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from timescaledb_util import TimeScaleDBUtil
+
+# 連続集計をSQLiteで再現する。watermarkより前の日は集計した時点の値を返し、以降の日は約定テーブルから集計する
+_TRADE_TABLE = 'binance_btc/usdt_trade'
+_VIEW = 'binance_btc/usdt_trade_dollar_cumsum_daily'
+_BUCKET = "substr(datetime, 1, 10) || ' 00:00:00+00:00'"
+
+class _FakeContinuousAggregate:
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute(f'CREATE TABLE "{_TRADE_TABLE}" (datetime TEXT, id TEXT, dollar_cumsum REAL)')
+        self.connection.execute('CREATE TABLE _materialized (time TEXT, dollar_cumsum_min REAL, dollar_cumsum REAL)')
+        self.connection.execute("CREATE TABLE _watermark (time TEXT)")
+        self.connection.execute("INSERT INTO _watermark VALUES ('0000')")
+        self.connection.execute(f'CREATE VIEW "{_VIEW}" AS SELECT time, dollar_cumsum_min, dollar_cumsum FROM _materialized'
+                                f' UNION ALL SELECT {_BUCKET} AS time, MIN(dollar_cumsum), MAX(dollar_cumsum) FROM "{_TRADE_TABLE}"'
+                                f' WHERE datetime >= (SELECT time FROM _watermark) GROUP BY time')
+
+    def write(self, day, first, last):
+        for _cumsum in range(first, last + 1):
+            self.connection.execute(f'INSERT INTO "{_TRADE_TABLE}" VALUES (?, ?, ?)', (f'2021-01-{day:02d} {_cumsum:02d}:00:00+00:00', f'{_cumsum:05d}', _cumsum))
+
+    def refresh(self, watermark_day):
+        # 更新ポリシーと同じく、watermarkより前の終わった日を全て集計済みにする
+        _watermark = f'2021-01-{watermark_day:02d} 00:00:00+00:00'
+        self.connection.execute('DELETE FROM _materialized')
+        self.connection.execute(f'INSERT INTO _materialized SELECT {_BUCKET} AS time, MIN(dollar_cumsum), MAX(dollar_cumsum) FROM "{_TRADE_TABLE}" WHERE datetime < ? GROUP BY time', (_watermark,))
+        self.connection.execute('UPDATE _watermark SET time = ?', (_watermark,))
+
+    def fetch_one(self, sql, params = []):
+        _cursor = self.connection.execute(re.sub(r'\$\d+', '?', sql), [float(_param) if isinstance(_param, Decimal) else _param for _param in params])
+        _row = _cursor.fetchone()
+        return None if _row is None else dict(zip([_column[0] for _column in _cursor.description], _row))
+
+    def trades(self):
+        return pd.read_sql_query(f'SELECT * FROM "{_TRADE_TABLE}"', self.connection)
+
+@pytest.fixture
+def aggregate():
+    return _FakeContinuousAggregate()
+
+@pytest.fixture
+def dbutil(aggregate):
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._row_cache = {}
+    _dbutil.table_exists = lambda table_name: table_name in [_TRADE_TABLE, _VIEW]
+    _dbutil._fetch_one = aggregate.fetch_one
+    return _dbutil
+
+def test_seek_includes_trades_written_after_the_day_was_materialized(aggregate, dbutil):
+    # 1日目は書き終わり、2日目の途中で更新ポリシーが実行された後に2日目と3日目の約定が追記される
+    aggregate.write(1, 1, 10)
+    aggregate.write(2, 11, 15)
+    aggregate.refresh(3)
+    aggregate.write(2, 16, 20)
+    aggregate.write(3, 21, 23)
+
+    _trades = aggregate.trades()
+    for _from in range(0, 24):
+        _datetime = dbutil.get_dollar_cumsum_datetime('binance', 'BTC/USDT', Decimal(_from))
+        _expected = _trades[_trades['dollar_cumsum'] > _from]
+        if _datetime is None:
+            # 絞り込まずに全ての約定を読む
+            continue
+        _seeked = _expected[pd.to_datetime(_expected['datetime'], utc=True) >= _datetime]
+        assert _seeked['id'].tolist() == _expected['id'].tolist(), f'from_dollar_cumsum = {_from}'
+    # 2日目の集計済みの最大値(15)より後の約定も2日目から読む
+    assert dbutil.get_dollar_cumsum_datetime('binance', 'BTC/USDT', Decimal(17)) == pd.Timestamp('2021-01-02', tz='UTC')
+
+def test_latest_trade_in_materialized_day_being_written(aggregate, dbutil):
+    aggregate.write(1, 1, 10)
+    aggregate.write(2, 11, 12)
+    aggregate.refresh(3)
+    aggregate.write(2, 13, 18)
+    assert dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00018'
+
+def test_latest_trade_in_day_missing_from_materialization(aggregate, dbutil):
+    # 集計した時点で約定がなかった日は集計済みの範囲に行がない
+    aggregate.write(1, 1, 10)
+    aggregate.refresh(3)
+    aggregate.write(2, 11, 14)
+    assert dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00014'
+
+class _FakeExecutor:
+    def __init__(self, version):
+        self.version = version
+        self.statements = []
+
+    def sql_execute(self, sql = None):
+        self.statements.append(sql)
+        if 'pg_extension' in sql:
+            return [(self.version,)]
+        if 'compression_enabled' in sql:
+            return [(False,)]
+        return []
+
+def _policy_dbutil(version):
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _executor = _FakeExecutor(version)
+    _dbutil.sql_execute = _executor.sql_execute
+    return _dbutil, _executor
+
+def test_new_trade_tables_are_not_compressed_by_default():
+    assert inspect.signature(TimeScaleDBUtil.__init__).parameters['compress_after'].default is None
+    _dbutil, _executor = _policy_dbutil('2.10.3')
+    _dbutil._set_trade_table_policies(_TRADE_TABLE, None, None)
+    assert not any(['compress' in _sql for _sql in _executor.statements])
+
+def test_compression_requires_timescaledb_2_11():
+    _dbutil, _executor = _policy_dbutil('2.10.3')
+    with pytest.raises(ValueError, match='2.11'):
+        _dbutil._set_trade_table_policies(_TRADE_TABLE, '7 days', None)
+    assert not any(['add_compression_policy' in _sql for _sql in _executor.statements])
+
+    _dbutil, _executor = _policy_dbutil('2.14.2')
+    _dbutil._set_trade_table_policies(_TRADE_TABLE, '7 days', None)
+    assert any(["add_compression_policy('\"binance_btc/usdt_trade\"', INTERVAL '7 days')" in _sql for _sql in _executor.statements])
+
+class _FakeCursor:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, params = None):
+        self.statements.append(sql)
+
+    def fetchmany(self, size):
+        return []
+
+    def close(self):
+        pass
+
+class _FakeConnection:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def cursor(self, name = None):
+        return _FakeCursor(self.statements)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class _FakeEngine:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def raw_connection(self):
+        return _FakeConnection(self.statements)
+
+def _index_statements(statements):
+    return [_sql for _sql in statements if 'dollar_cumsum_id_idx' in _sql]
+
+def test_trade_index_is_created_by_migration_not_by_reads():
+    _dbutil, _executor = _policy_dbutil('2.14.2')
+    _dbutil.table_exists = lambda table_name: True
+    _dbutil._engine = _FakeEngine(_executor.statements)
+
+    # 読み出すたびにDDLを実行しない
+    for _ in range(2):
+        assert list(_dbutil.iter_trades('binance', 'BTC/USDT')) == []
+    assert _index_statements(_executor.statements) == []
+
+    # 既存のテーブルには移行時に作成する
+    _dbutil._compress_after, _dbutil._drop_after = None, None
+    _dbutil.init_dollar_cumsum_daily = lambda exchange, symbol: None
+    _dbutil.refresh_dollar_cumsum_daily = lambda exchange, symbol: None
+    _dbutil._get_trade_table_report = lambda table_name, measure_scan: {}
+    _dbutil.migrate_trade_table('binance', 'BTC/USDT', chunk_time_interval='1 day', measure_scan=False)
+    assert _index_statements(_executor.statements) == [f'CREATE INDEX IF NOT EXISTS "{_TRADE_TABLE}_dollar_cumsum_id_idx" ON "{_TRADE_TABLE}" (dollar_cumsum, id)']
+
+def _to_sqlite_value(value):
+    # 文字列として比較しても数値の順になるように、Decimalは固定幅の文字列にする
+    return format(value, '031.20f') if isinstance(value, Decimal) else value
+
+class _SQLiteCursor:
+    def __init__(self, connection):
+        self._cursor = connection.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cursor.close()
+        return False
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, sql, params = None):
+        self._cursor.execute(re.sub(r'%\((\w+)\)s', r':\1', sql), {_key: _to_sqlite_value(_value) for _key, _value in (params or {}).items()})
+
+    def copy_expert(self, sql, buffer):
+        # COPY ... FROM STDINのCSVをそのままINSERTする
+        _table_name, _columns = re.match(r'COPY "([^"]+)" \(([^)]*)\) FROM STDIN', sql).groups()
+        _rows = list(csv.reader(buffer))
+        self._cursor.executemany(f'INSERT INTO "{_table_name}" ({_columns}) VALUES ({", ".join(["?"] * len(_rows[0]))})', _rows)
+
+class _SQLiteConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, name = None):
+        return _SQLiteCursor(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        pass
+
+class _EdgeAggregate:
+    # TimescaleDBのfirst(value, key)とlast(value, key)
+    def __init__(self, last):
+        self._last = last
+        self._key = None
+        self._value = None
+
+    def step(self, value, key):
+        _key = Decimal(key)
+        if self._key is None or (_key >= self._key if self._last else _key < self._key):
+            self._key, self._value = _key, value
+
+    def finalize(self):
+        return self._value
+
+def _sqlite_trade_db():
+    # PostgreSQLのdivと同じく、numericの商を丸めずに切り捨てる
+    _connection = sqlite3.connect(':memory:')
+    _connection.create_function('div', 2, lambda x, y: int(Decimal(x) // Decimal(y)))
+    _connection.create_aggregate('first', 2, lambda: _EdgeAggregate(last=False))
+    _connection.create_aggregate('last', 2, lambda: _EdgeAggregate(last=True))
+    return _connection
+
+def test_insert_dollarbars_groups_trades_like_aggregate_dollarbars():
+    from dollarbar_generate_util import DOLLARBAR_COLUMNS, aggregate_dollarbars
+
+    # バーの境界の直前・ちょうど・直後の累積和。境界の直前は商を20桁に丸めると次のバーに入る
+    _interval = 5_000_000
+    _cumsums = [Decimal(_value) for _value in ['1000000.5', '4999999.99999999999999999999', '5000000', '5000000.00000000000000000001', '7500000',
+                                                '9999999.99999999999999999999', '10000000.00000000000000000001', '14999999.99999999999999999998', '14999999.99999999999999999999', '15000000.25']]
+    _dollars = [_cumsums[0]] + [_cumsum - _previous for _previous, _cumsum in zip(_cumsums[:-1], _cumsums[1:])]
+    _df = pd.DataFrame({
+        'datetime': [f'2021-01-01 00:00:{_i:02d}+00:00' for _i in range(len(_cumsums))],
+        'id': [f'{_i:05d}' for _i in range(len(_cumsums))],
+        'side': ['buy' if _i % 2 == 0 else 'sell' for _i in range(len(_cumsums))],
+        'liquidation': [False] * len(_cumsums),
+        'price': [Decimal(100)] * len(_cumsums),
+        'amount': [_dollar / 100 for _dollar in _dollars],
+        'dollar': _dollars,
+        'dollar_cumsum': _cumsums,
+        'buy_dollar_cumsum': list(np.cumsum([_dollar if _i % 2 == 0 else Decimal(0) for _i, _dollar in enumerate(_dollars)])),
+        'sell_dollar_cumsum': list(np.cumsum([_dollar if _i % 2 == 1 else Decimal(0) for _i, _dollar in enumerate(_dollars)])),
+    })
+
+    _connection = _sqlite_trade_db()
+    _connection.execute(f'CREATE TABLE "{_TRADE_TABLE}" ({", ".join(_df.columns)})')
+    _connection.executemany(f'INSERT INTO "{_TRADE_TABLE}" VALUES ({", ".join(["?"] * len(_df.columns))})', [[_to_sqlite_value(_value) if not isinstance(_value, (bool, np.bool_)) else int(_value) for _value in _row] for _row in _df.itertuples(index=False)])
+    _bar_table = 'binance_btc/usdt_dollarbar_5000000'
+    _connection.execute(f'CREATE TABLE "{_bar_table}" ({", ".join(DOLLARBAR_COLUMNS)})')
+
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._row_cache = {}
+    _dbutil._thread_local = threading.local()
+    _dbutil._engine = type('_Engine', (), {'raw_connection': lambda self: _SQLiteConnection(_connection)})()
+    _rows = _dbutil.insert_dollarbars('binance', 'BTC/USDT', _interval, till_dollar_cumsum=_cumsums[-1])
+
+    # 最新の約定を含むバー以外は、Pythonで集計したバーと同じ約定の区切りになる
+    _expected = aggregate_dollarbars(_df, _interval).iloc[:-1]
+    _bars = pd.read_sql_query(f'SELECT datetime_from, datetime, id_from, id, dollar_cumsum FROM "{_bar_table}" ORDER BY rowid', _connection)
+    assert _rows == len(_expected) == 3
+    assert _bars['id_from'].tolist() == _expected['id_from'].tolist()
+    assert _bars['id'].tolist() == _expected['id'].tolist()
+    assert [Decimal(_value) for _value in _bars['dollar_cumsum']] == _expected['dollar_cumsum'].tolist()
+
+class _FakeDatabase:
+    # 約定テーブルとチェックポイントテーブルだけを持つDB。トランザクションがロールバックされると開始時点の状態に戻す
+    def __init__(self):
+        self.tables = {}
+        self.checkpoints = {}
+        self.statements = []
+        self.fail_checkpoint = False
+
+    def _snapshot(self):
+        return {_name: list(_rows) for _name, _rows in self.tables.items()}, dict(self.checkpoints)
+
+    def _restore(self, snapshot):
+        self.tables, self.checkpoints = snapshot
+
+    @contextmanager
+    def begin(self):
+        _snapshot = self._snapshot()
+        try:
+            yield _FakeTransactionConnection(self)
+        except:
+            self._restore(_snapshot)
+            raise
+
+    def raw_connection(self):
+        return _FakeDBAPIConnection(self, self._snapshot())
+
+    def execute(self, sql, params):
+        self.statements.append((sql, params))
+        if sql.startswith('INSERT INTO "trade_checkpoint"'):
+            if self.fail_checkpoint == True:
+                raise IOError('connection lost')
+            _key = (params['exchange'], params['symbol'])
+            if _key not in self.checkpoints or self.checkpoints[_key]['dollar_cumsum'] <= params['dollar_cumsum']:
+                self.checkpoints[_key] = dict(params)
+        elif sql.startswith('DELETE FROM "trade_checkpoint"'):
+            self.checkpoints.pop((params['exchange'], params['symbol']), None)
+
+    def to_sql(self, df, name, con = None, if_exists = 'fail', index = True):
+        self.tables.setdefault(name, []).extend(df.to_dict('records'))
+        return len(df)
+
+class _FakeDBAPICursor:
+    def __init__(self, database):
+        self._database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, sql, params = None):
+        self._database.execute(sql, params)
+
+class _FakeDBAPIConnection:
+    def __init__(self, database, snapshot = None):
+        self._database = database
+        self._snapshot = snapshot
+
+    def cursor(self, name = None):
+        return _FakeDBAPICursor(self._database)
+
+    def commit(self):
+        self._snapshot = None
+
+    def rollback(self):
+        if self._snapshot is not None:
+            self._database._restore(self._snapshot)
+
+    def close(self):
+        pass
+
+class _FakeTransactionConnection:
+    # transactionの中の接続。コミットとロールバックはbeginに任せる
+    def __init__(self, database):
+        self.connection = _FakeDBAPIConnection(database)
+
+def _checkpoint_dbutil(database, monkeypatch):
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', lambda self, name, con = None, if_exists = 'fail', index = True: database.to_sql(self, name, con, if_exists, index))
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._engine = database
+    _dbutil._thread_local = threading.local()
+    _dbutil._tables = None
+    _dbutil._row_cache = {}
+    _dbutil._compress_after, _dbutil._drop_after = None, None
+    _dbutil.table_exists = lambda table_name: table_name == TimeScaleDBUtil.CHECKPOINT_TABLE_NAME or table_name in database.tables
+    _dbutil._fetch_one = lambda sql, params: None if tuple(params) not in database.checkpoints else dict(database.checkpoints[tuple(params)])
+    _dbutil._create_table = lambda table_name, sql: database.tables.__setitem__(table_name, [])
+    _dbutil._set_trade_table_policies = lambda table_name, compress_after, drop_after: None
+    _dbutil.init_dollar_cumsum_daily = lambda exchange, symbol: None
+    return _dbutil
+
+def _trade_batch(first, last):
+    _ids = range(first, last + 1)
+    return pd.DataFrame({
+        'datetime': [pd.Timestamp(f'2021-01-01 00:00:{_id:02d}', tz='UTC') for _id in _ids],
+        'id': [f'{_id:05d}' for _id in _ids],
+        'dollar_cumsum': [Decimal(_id * 100) for _id in _ids],
+        'buy_dollar_cumsum': [Decimal(_id * 60) for _id in _ids],
+        'sell_dollar_cumsum': [Decimal(_id * 40) for _id in _ids],
+    })
+
+def _write_batch(dbutil, df):
+    _last = df.iloc[-1]
+    _checkpoint = {'exchange': 'binance', 'symbol': 'BTC/USDT', 'datetime': _last['datetime'], 'id': _last['id'], 'dollar_cumsum': _last['dollar_cumsum'], 'buy_dollar_cumsum': _last['buy_dollar_cumsum'], 'sell_dollar_cumsum': _last['sell_dollar_cumsum']}
+    return dbutil.df_to_sql(df=df, schema=_TRADE_TABLE, if_exists='append', method='insert', checkpoint=_checkpoint)
+
+def test_insert_path_writes_trades_and_checkpoint_atomically(monkeypatch):
+    _database = _FakeDatabase()
+    _dbutil = _checkpoint_dbutil(_database, monkeypatch)
+    _batches = [_trade_batch(1, 5), _trade_batch(6, 10)]
+    _write_batch(_dbutil, _batches[0])
+
+    # 約定を書き込んだ後、再開位置の更新で落ちると約定もロールバックされる
+    _database.fail_checkpoint = True
+    with pytest.raises(IOError):
+        _write_batch(_dbutil, _batches[1])
+    assert [_row['id'] for _row in _database.tables[_TRADE_TABLE]] == [f'{_id:05d}' for _id in range(1, 6)]
+
+    # 再実行すると再開位置の次の約定から書き込み、抜けも重複もない
+    _database.fail_checkpoint = False
+    _checkpoint = _dbutil.get_trade_checkpoint('binance', 'BTC/USDT')
+    assert _checkpoint['id'] == '00005'
+    _remaining = pd.concat(_batches)
+    _write_batch(_dbutil, _remaining[_remaining['dollar_cumsum'] > _checkpoint['dollar_cumsum']])
+    assert [_row['id'] for _row in _database.tables[_TRADE_TABLE]] == [f'{_id:05d}' for _id in range(1, 11)]
+    assert _dbutil.get_trade_checkpoint('binance', 'BTC/USDT')['id'] == '00010'
+
+    # テーブルを作り直すと再開位置も消える。値はSQLに埋め込まずにパラメータで渡す
+    _dbutil.init_trade_table('binance', 'BTC/USDT', force=True)
+    assert _dbutil.get_trade_checkpoint('binance', 'BTC/USDT') is None
+    _deletes = [(_sql, _params) for _sql, _params in _database.statements if _sql.startswith('DELETE')]
+    assert _deletes == [('DELETE FROM "trade_checkpoint" WHERE exchange = %(exchange)s AND symbol = %(symbol)s', {'exchange': 'binance', 'symbol': 'BTC/USDT'})]
+
+# COPY TO STDOUTでPostgreSQLが返すCSVの値。時刻はUNIX時間のマイクロ秒、真偽値はt/f
+_COPY_TRADES = pd.DataFrame({
+    'datetime': ['1609459200000001', '1609459200500000', '1609459201000000'],
+    'id': ['00001', '00002', '00003'],
+    'side': ['buy', 'sell', 'buy'],
+    'liquidation': ['f', 't', 'f'],
+    'price': ['29000.5', '28999.0', '29001.25'],
+    'amount': ['0.001', '2', '0.5'],
+    'dollar': ['29.0005', '57998', '14500.625'],
+    'dollar_cumsum': ['29.0005', '58027.0005', '72527.6255'],
+    'buy_dollar_cumsum': ['29.0005', '29.0005', '14529.6255'],
+    'sell_dollar_cumsum': ['0', '57998', '57998'],
+})
+
+class _CopyCursor:
+    def __init__(self, database):
+        self._database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def mogrify(self, sql, params = None):
+        for _key, _value in (params or {}).items():
+            sql = sql.replace(f'%({_key})s', f"'{_value}'")
+        return sql.encode()
+
+    def copy_expert(self, sql, buffer):
+        # SELECTした列だけを、その順番でCSVにする
+        self._database.copies.append(sql)
+        _select = sql[sql.index('SELECT '):sql.index(' FROM "')]
+        _positions = {_column: re.search(rf'(?:AS |SELECT |, ){_column}(?=,|$)', _select) for _column in self._database.rows.columns}
+        _columns = sorted([_column for _column, _match in _positions.items() if _match is not None], key=lambda x: _positions[x].start())
+        buffer.write(self._database.rows[_columns].to_csv(header=False, index=False).encode())
+
+class _CopyDatabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.copies = []
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self, name = None):
+        return _CopyCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def _copy_dbutil(rows):
+    _database = _CopyDatabase(rows)
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._engine = _database
+    _dbutil._thread_local = threading.local()
+    return _dbutil, _database
+
+def test_load_trades_converts_copy_csv_in_database_order():
+    _dbutil, _database = _copy_dbutil(_COPY_TRADES)
+    _ids = ['00001', '00002', '00003']
+    _datetimes = pd.to_datetime([1609459200000001, 1609459200500000, 1609459201000000], unit='us', utc=True)
+
+    _df = _dbutil.load_trades('binance', 'BTC/USDT', from_str='2021-01-01', to_str='2021-01-02')
+    assert str(_df['datetime'].dtype) == 'datetime64[us, UTC]'
+    assert _df['datetime'].tolist() == _datetimes.tolist()
+    assert _df['id'].tolist() == _ids
+    assert _df['liquidation'].dtype == bool and _df['liquidation'].tolist() == [False, True, False]
+    assert all([_df[_column].dtype == np.float64 for _column in ['price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']])
+    assert _df['dollar_cumsum'].tolist() == [29.0005, 58027.0005, 72527.6255]
+
+    # 絞り込みと並べ替えはDBで行い、返されたCSVの行の順番のまま返す
+    assert "WHERE datetime >= '2021-01-01' AND datetime < '2021-01-02' ORDER BY dollar_cumsum ASC, id ASC) TO STDOUT" in _database.copies[0]
+
+    _arrays = _dbutil.load_trades('binance', 'BTC/USDT', columns=['datetime', 'id', 'liquidation', 'price'], output='numpy')
+    assert list(_arrays.keys()) == ['datetime', 'id', 'liquidation', 'price']
+    assert _arrays['datetime'].dtype == np.dtype('datetime64[us]')
+    assert _arrays['datetime'].tolist() == [_datetime.to_pydatetime().replace(tzinfo=None) for _datetime in _datetimes]
+    assert _arrays['id'].tolist() == _ids
+    assert _arrays['liquidation'].dtype == bool
+    assert _arrays['price'].dtype == np.float64 and _arrays['price'].tolist() == [29000.5, 28999.0, 29001.25]
+
+    _table = _dbutil.load_trades('binance', 'BTC/USDT', columns=['datetime', 'id', 'liquidation', 'amount'], output='arrow')
+    assert _table.schema == pa.schema([('datetime', pa.timestamp('us', tz='UTC')), ('id', pa.string()), ('liquidation', pa.bool_()), ('amount', pa.float64())])
+    assert _table['id'].to_pylist() == _ids
+
+def test_load_bars_returns_empty_table_when_copy_returns_no_rows():
+    _dbutil, _ = _copy_dbutil(_COPY_TRADES.iloc[:0])
+    _df = _dbutil.load_bars('binance', 'BTC/USDT', 'tick', 100, columns=['datetime', 'close'])
+    assert len(_df) == 0 and list(_df.columns) == ['datetime', 'close']
+    assert str(_df['datetime'].dtype) == 'datetime64[us, UTC]' and _df['close'].dtype == np.float64
+
+def test_load_with_cache_reads_database_only_on_miss(tmp_path):
+    _dbutil, _database = _copy_dbutil(_COPY_TRADES)
+    _cache_dir = str(tmp_path / 'cache')
+    _expected = _dbutil.load_trades('binance', 'BTC/USDT', to_str='2021-01-02')
+    assert len(_database.copies) == 1
+
+    # 同じ条件はキャッシュから読み、DBには問い合わせない
+    _df = _dbutil.load_trades('binance', 'BTC/USDT', to_str='2021-01-02', cache_dir=_cache_dir)
+    assert len(_database.copies) == 2
+    for _output in ['pandas', 'numpy', 'arrow']:
+        _cached = _dbutil.load_trades('binance', 'BTC/USDT', to_str='2021-01-02', cache_dir=_cache_dir, output=_output)
+        assert len(_database.copies) == 2
+        if _output == 'pandas':
+            pd.testing.assert_frame_equal(_cached, _expected)
+    assert len(os.listdir(_cache_dir)) == 1
+    pd.testing.assert_frame_equal(_df, _expected)
+
+    # 条件が違う場合、refreshを指定した場合、to_strがNoneの場合はDBから読む
+    _dbutil.load_trades('binance', 'BTC/USDT', from_str='2021-01-01', to_str='2021-01-02', cache_dir=_cache_dir)
+    assert len(_database.copies) == 3
+    _dbutil.load_trades('binance', 'BTC/USDT', to_str='2021-01-02', cache_dir=_cache_dir, refresh=True)
+    assert len(_database.copies) == 4
+    _dbutil.load_trades('binance', 'BTC/USDT', cache_dir=_cache_dir)
+    _dbutil.load_trades('binance', 'BTC/USDT', cache_dir=_cache_dir)
+    assert len(_database.copies) == 6
+    assert len(os.listdir(_cache_dir)) == 2
+
+def test_transaction_shares_one_connection_per_thread(monkeypatch):
+    _dbutil = _checkpoint_dbutil(_FakeDatabase(), monkeypatch)
+    _other_thread = {}
+
+    def _run_other_thread():
+        with _dbutil._raw_connection() as _connection:
+            _other_thread['connection'] = _connection
+
+    with _dbutil.transaction() as _connection:
+        # 同じスレッドでは入れ子のtransactionもDBAPIの接続も同じトランザクションの接続を使う
+        with _dbutil.transaction() as _nested:
+            assert _nested is _connection
+        with _dbutil._raw_connection() as _raw:
+            assert _raw is _connection.connection
+        # 別のスレッドはトランザクションの接続を使わない
+        _thread = threading.Thread(target=_run_other_thread)
+        _thread.start()
+        _thread.join()
+        assert _other_thread['connection'] is not _connection.connection
+    assert _dbutil._thread_local.connection is None
+
+    with _dbutil.transaction() as _next:
+        assert _next is not _connection
+
+def test_transaction_rollback_clears_tables_and_row_cache(monkeypatch):
+    _database = _FakeDatabase()
+    _dbutil = _checkpoint_dbutil(_database, monkeypatch)
+    _dbutil._tables = set([_TRADE_TABLE])
+    _database.tables[_TRADE_TABLE] = []
+
+    with pytest.raises(IOError):
+        with _dbutil.transaction():
+            _dbutil.df_to_sql(df=_trade_batch(1, 3), schema='binance_eth/usdt_trade', if_exists='replace', method='insert')
+            _write_batch(_dbutil, _trade_batch(1, 3))
+            _dbutil._row_cache[(_TRADE_TABLE, 'latest')] = {'id': '00003'}
+            assert 'binance_eth/usdt_trade' in _dbutil._tables
+            raise IOError('connection lost')
+
+    # ロールバックされた書き込みとテーブルの作成はDBにもキャッシュにも残らない
+    assert _database.tables == {_TRADE_TABLE: []} and _database.checkpoints == {}
+    assert _dbutil._tables == set([_TRADE_TABLE])
+    assert _dbutil._row_cache == {}
+    assert _dbutil._thread_local.connection is None
+
+def test_get_pool_stats_reports_checked_out_connections():
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=2, max_overflow=1)
+    _connections = [_dbutil._engine.raw_connection() for _ in range(3)]
+    _stats = _dbutil.get_pool_stats()
+    assert (_stats['pool_size'], _stats['checked_out'], _stats['overflow']) == (2, 3, 1)
+    for _connection in _connections:
+        _connection.close()
+    _stats = _dbutil.get_pool_stats()
+    assert (_stats['checked_in'], _stats['checked_out']) == (2, 0)
+    assert isinstance(_stats['status'], str)
+
+def _cached_sqlite_dbutil(connection, monkeypatch):
+    # 最新の行をSQLiteから読み、to_sqlもSQLiteに書き込む。連続集計はない
+    _tables = [_row[0] for _row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    def _fetch_one(sql, params = None):
+        _cursor = connection.execute(sql)
+        _row = _cursor.fetchone()
+        return None if _row is None else dict(zip([_column[0] for _column in _cursor.description], _row))
+    def _to_sql(df, name, con = None, if_exists = 'fail', index = True):
+        connection.executemany(f'INSERT INTO "{name}" ({", ".join(df.columns)}) VALUES ({", ".join(["?"] * len(df.columns))})', [[_to_sqlite_value(_value) for _value in _row] for _row in df.itertuples(index=False)])
+        return len(df)
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', _to_sql)
+
+    _dbutil = TimeScaleDBUtil.__new__(TimeScaleDBUtil)
+    _dbutil._row_cache = {}
+    _dbutil._tables = None
+    _dbutil._thread_local = threading.local()
+    _dbutil._engine = type('_Engine', (), {'raw_connection': lambda self: _SQLiteConnection(connection)})()
+    _dbutil.table_exists = lambda table_name: table_name in _tables
+    _dbutil._fetch_one = _fetch_one
+    return _dbutil
+
+def _cached_trades(first, last):
+    # 1件100万ドルの約定
+    _ids = range(first, last + 1)
+    return pd.DataFrame({
+        'datetime': [f'2021-01-01 00:00:{_id:02d}+00:00' for _id in _ids],
+        'id': [f'{_id:05d}' for _id in _ids],
+        'side': ['buy'] * len(_ids),
+        'liquidation': [False] * len(_ids),
+        'price': [Decimal(100)] * len(_ids),
+        'amount': [Decimal(10_000)] * len(_ids),
+        'dollar': [Decimal(1_000_000)] * len(_ids),
+        'dollar_cumsum': [Decimal(_id * 1_000_000) for _id in _ids],
+        'buy_dollar_cumsum': [Decimal(_id * 1_000_000) for _id in _ids],
+        'sell_dollar_cumsum': [Decimal(0)] * len(_ids),
+    })
+
+def test_writes_invalidate_the_cached_latest_row(monkeypatch):
+    from dollarbar_generate_util import DOLLARBAR_COLUMNS
+
+    _bar_table = 'binance_btc/usdt_dollarbar_2000000'
+    _connection = _sqlite_trade_db()
+    for _table_name, _columns in [(_TRADE_TABLE, _cached_trades(1, 1).columns), (_bar_table, DOLLARBAR_COLUMNS)]:
+        _connection.execute(f'CREATE TABLE "{_table_name}" ({", ".join([_column if _column in ["datetime", "datetime_from", "id", "id_from", "side"] else f"{_column} NUMERIC" for _column in _columns])})')
+    _dbutil = _cached_sqlite_dbutil(_connection, monkeypatch)
+
+    _dbutil.df_to_sql(df=_cached_trades(1, 3), schema=_TRADE_TABLE, if_exists='append', method='insert')
+    assert _dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00003'
+    # DBを直接書き換えても、キャッシュした最新の行を返す
+    _connection.execute(f'''INSERT INTO "{_TRADE_TABLE}" (datetime, id, dollar_cumsum) VALUES ('2021-01-01 00:00:04+00:00', '00004', 4000000)''')
+    assert _dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00003'
+
+    # COPYとto_sqlで書き込むと、次は書き込んだ約定を読み直す
+    _dbutil.copy_df_to_table(df=_cached_trades(5, 6), table_name=_TRADE_TABLE, on_conflict_do_nothing=False)
+    assert _dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00006'
+    _dbutil.df_to_sql(df=_cached_trades(7, 8), schema=_TRADE_TABLE, if_exists='append', method='insert')
+    assert _dbutil.get_latest_trade('binance', 'BTC/USDT')['id'] == '00008'
+
+    # DB上で集計したドルバーも、書き込むたびに最新のバーを読み直す
+    _dbutil.insert_dollarbars('binance', 'BTC/USDT', 2_000_000, till_dollar_cumsum=Decimal(4_000_000))
+    _latest_bar = _dbutil.get_latest_bar('binance', 'BTC/USDT', 'dollar', 2_000_000)
+    assert _latest_bar['id'] == '00003'
+    _dbutil.insert_dollarbars('binance', 'BTC/USDT', 2_000_000, from_dollar_cumsum=Decimal(_latest_bar['dollar_cumsum']), till_dollar_cumsum=Decimal(8_000_000))
+    assert _dbutil.get_latest_bar('binance', 'BTC/USDT', 'dollar', 2_000_000)['id'] == '00007'
@@ -0,0 +1,262 @@
+import gzip
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from bybit_archive_util import BybitArchivePrefetcher
+from benchmark import FakeCcxtExchange, FakeTradeWebSocketServer, InMemoryTradeStore, _create_fake_tradesutil
+from trade_stream_util import BinanceWebSocketTradeStream
+from fixedpoint_util import compute_dollar_cumsums
+from trades_download_util import TradesDownloadUtil
+
+class _FakeDBUtil:
+    def __init__(self):
+        self.written = []
+        self.checkpoints = []
+
+    def df_to_sql(self, df = None, schema = None, if_exists = None, checkpoint = None):
+        self.written.append(df)
+        self.checkpoints.append(checkpoint)
+
+def _trades(first, last):
+    _ids = list(range(first, last + 1))
+    _df = pd.DataFrame({
+        'datetime': [f'2021-01-01T00:00:{_id:02d}.000Z' for _id in _ids],
+        'id': [str(_id) for _id in _ids],
+        'side': ['buy' if _id % 2 == 0 else 'sell' for _id in _ids],
+        'liquidation': [False] * len(_ids),
+        'price': ['100.5'] * len(_ids),
+        'amount': ['0.01'] * len(_ids),
+    })
+    return compute_dollar_cumsums(_df)
+
+def test_failing_listener_does_not_stop_ingestion():
+    _dbutil = _FakeDBUtil()
+    _tradesutil = TradesDownloadUtil(dbutil=_dbutil, write_behind_rows=1, write_behind_delay=0.01)
+    _received = []
+
+    def _failing_listener(exchange, symbol, df):
+        raise RuntimeError('listener failed')
+
+    _tradesutil.add_trades_listener(_failing_listener)
+    _tradesutil.add_trades_listener(lambda exchange, symbol, df: _received.append(df['id'].tolist()))
+
+    _key = ('binance', 'BTC/USDT', 'binance_btc/usdt_trade')
+    with _tradesutil._create_trades_writer() as _writer:
+        for _first in [1, 4, 7]:
+            _writer.put(_key, _trades(_first, _first + 2), None)
+
+    # 全てのバッチが書き込まれ、例外を送出しない関数には全てのバッチが渡される
+    assert sum([len(_df) for _df in _dbutil.written]) == 9
+    assert _dbutil.checkpoints[-1]['id'] == '9'
+    assert sum(_received, []) == [str(_id) for _id in range(1, 10)]
+
+    # 例外を送出した関数は1回だけ記録されて登録を解除される
+    assert len(_tradesutil.listener_errors) == 1
+    _exchange, _symbol, _listener, _error = _tradesutil.listener_errors[0]
+    assert (_exchange, _symbol, _listener) == ('binance', 'BTC/USDT', _failing_listener)
+    assert isinstance(_error, RuntimeError)
+    assert {'name': 'listener_errors', 'labels': {'exchange': 'binance', 'symbol': 'BTC/USDT'}, 'value': 1} in _tradesutil.metrics.snapshot()['counters']
+
+def _fake_binance(rows, trades_per_second, fail_after_ms=None):
+    # fail_after_msより後の開始時刻のリクエストで例外を送出し、リクエストした終了時刻の最大値を記録する偽の取引所
+    _base = FakeCcxtExchange.create(rows, trades_per_second)
+
+    class _Exchange(_base):
+        fail_after_ms = None
+        max_end_time_ms = 0
+
+        def fetch_trades(self, symbol, since=None, limit=None, params={}):
+            with self._lock:
+                type(self).max_end_time_ms = max(type(self).max_end_time_ms, params['endTime'])
+            if self.fail_after_ms is not None and params['startTime'] > self.fail_after_ms:
+                raise RuntimeError('unexpected response')
+            # 実際の取引所と同じく、文字列として並べても約定順になるIDにする
+            return [dict(_trade, id=f"{int(_trade['id']):08d}") for _trade in super().fetch_trades(symbol, since, limit, params)]
+
+    if fail_after_ms is not None:
+        _Exchange.fail_after_ms = _base.start_timestamp_ms + fail_after_ms
+    return _Exchange
+
+def test_concurrent_download_stops_at_failed_shard_and_resumes(tmp_path):
+    # 約1時間ごとのシャード3つ分の約定で、2つ目のシャードの途中から例外を送出する
+    _exchange_class = _fake_binance(rows=20_000, trades_per_second=2, fail_after_ms=5_000_000)
+    _store = InMemoryTradeStore()
+    _tradesutil = _create_fake_tradesutil(_store, _exchange_class, str(tmp_path))
+    _table_name = _store.get_trade_table_name('binance', 'BTC/USDT')
+
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime(), concurrency=4)
+
+    # 失敗したシャードより前の約定だけが抜けなく書き込まれる
+    _ids = _store.read_table(_table_name)['id'].astype(int).tolist()
+    assert 0 < len(_ids) < 20_000
+    assert _ids == list(range(len(_ids)))
+    # 次回はチェックポイントから再開し、残りの約定を累積和をつなげて書き込む
+    _exchange_class.fail_after_ms = None
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime(), concurrency=4)
+    _finished_ms = int(time.time() * 1000)
+    _df = _store.read_table(_table_name)
+    assert _df['id'].astype(int).tolist() == list(range(20_000))
+    assert (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
+    # 最後のシャードは終了時刻より先をリクエストしない
+    assert _exchange_class.max_end_time_ms <= _finished_ms
+
+class _ThreadRecordingStore(InMemoryTradeStore):
+    # 書き込んだスレッドを記録する
+    def __init__(self, write_latency=0.0):
+        super().__init__(write_latency)
+        self.write_threads = set()
+
+    def df_to_sql(self, df=None, schema=None, if_exists='fail', method=None, on_conflict_do_nothing=True, checkpoint=None):
+        self.write_threads.add(threading.current_thread())
+        return super().df_to_sql(df, schema, if_exists, method, on_conflict_do_nothing, checkpoint)
+
+def test_stream_trades_across_reconnects(tmp_path):
+    # 1回の接続で30件配信して切断するサーバーから4秒間受け取る。切断中の約定は再接続時にRESTで取得する
+    _live_seconds = 4
+    _exchange_class = FakeCcxtExchange.create(2_000, 20, live_seconds=_live_seconds)
+    _store = _ThreadRecordingStore(write_latency=0.05)
+    _server = FakeTradeWebSocketServer(_exchange_class, disconnect_after=30)
+    _url = _server.start()
+    try:
+        _tradesutil = _create_fake_tradesutil(_store, _exchange_class, str(tmp_path))
+        _streamed = _tradesutil.stream_trades(exchange='binance', symbol='BTC/USDT', stream=BinanceWebSocketTradeStream('BTC/USDT', url=_url), since_datetime=_exchange_class.get_start_datetime(), batch_interval=0.2, reconnect_wait=0.1, duration=_live_seconds + 2)
+    finally:
+        _server.stop()
+
+    # 全ての約定が抜けも重複もなく書き込まれ、取引額の累積和が接続をまたいでつながっている
+    _df = _store.read_table(_store.get_trade_table_name('binance', 'BTC/USDT'))
+    assert sorted(_df['id'].astype(int).tolist()) == list(range(len(_exchange_class.timestamps_ms)))
+    assert (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
+    assert (_df['buy_dollar_cumsum'] + _df['sell_dollar_cumsum'] == _df['dollar_cumsum']).all()
+    assert _streamed > 0
+    assert _server.connection_count > 1
+    # DBへの書き込みはイベントループのスレッドでは行わない
+    assert threading.main_thread() not in _store.write_threads
+
+class _FakeBybit:
+    id = 'bybit'
+
+    def market(self, symbol):
+        return {'symbol': symbol, 'precision': {'price': 0.5, 'amount': 1}}
+
+def _bybit_archive(day, rows=5, order=None):
+    # BybitのCSVと同じ列を持つ、その日のrows件の約定のファイル。orderを指定するとその順に並べる
+    _start = datetime(2019, 10, day, tzinfo=timezone.utc).timestamp()
+    _lines = ['timestamp,symbol,side,size,price,tickDirection,trdMatchID,grossValue,homeNotional,foreignNotional']
+    for _i in (range(rows) if order is None else order):
+        _lines.append(f'{_start + _i * 600 + 0.25:.4f},BTCUSD,{"Buy" if _i % 2 == 0 else "Sell"},{10 + _i},8000.5,PlusTick,{day:02d}-{_i:04d},0,{0.00125 * (_i + 1):.5f},{10 + _i}')
+    return gzip.compress('\n'.join(_lines).encode())
+
+def test_bybit_download_stops_at_first_missing_day(archive_server, tmp_path):
+    # シンボルの最初のファイルは10月3日。10月5日のファイルはまだ公開されていない
+    for _day in [3, 4, 6]:
+        archive_server.files[f'/trading/BTCUSD/BTCUSD2019-10-{_day:02d}.csv.gz'] = _bybit_archive(_day)
+    _store = InMemoryTradeStore()
+    _prefetcher = BybitArchivePrefetcher(cache_dir=str(tmp_path), base_url=archive_server.url, max_workers=2, prefetch_days=2, retry_wait=0.01)
+    _tradesutil = TradesDownloadUtil(_store, bybit_prefetcher=_prefetcher, ccxt_clients={'bybit': _FakeBybit()}, write_behind_delay=0.01)
+    _table_name = _store.get_trade_table_name('bybit', 'BTC/USD')
+
+    # 最初のファイルより前の日付は読み飛ばし、書き込み後に欠けている日付で止まる
+    _tradesutil.download_bybit_trades(exchange='bybit', symbol='BTC/USD')
+    assert sorted(set(_store.read_table(_table_name)['id'].str[:2])) == ['03', '04']
+    assert _store.get_trade_checkpoint('bybit', 'BTC/USD')['bybit_file_date'].date().isoformat() == '2019-10-04'
+
+    # 公開された後に実行すると欠けていた日付から再開し、累積和をつなげて書き込む
+    archive_server.files['/trading/BTCUSD/BTCUSD2019-10-05.csv.gz'] = _bybit_archive(5)
+    _tradesutil.download_bybit_trades(exchange='bybit', symbol='BTC/USD')
+    _df = _store.read_table(_table_name)
+    assert _df['id'].tolist() == [f'{_day:02d}-{_i:04d}' for _day in [3, 4, 5, 6] for _i in range(5)]
+    assert (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
+    assert _store.get_trade_checkpoint('bybit', 'BTC/USD')['bybit_file_date'].date().isoformat() == '2019-10-06'
+
+# 6件目で並びが崩れるファイル。崩れる前までをファイルの順序のまま、残りをtimestamp順に返す
+_UNSORTED_ORDER = [0, 1, 2, 3, 4, 8, 5, 9, 6, 7]
+_UNSORTED_EXPECTED = [0, 1, 2, 3, 4, 8, 5, 6, 7, 9]
+
+def test_bybit_csv_chunks_check_order_while_streaming(tmp_path, monkeypatch):
+    _read_csv = pd.read_csv
+    _full_reads = []
+
+    def _recording_read_csv(*args, **kwargs):
+        if kwargs.get('chunksize') is None:
+            _full_reads.append(args[0])
+        return _read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(pd, 'read_csv', _recording_read_csv)
+    _sorted_path = tmp_path / 'sorted.csv.gz'
+    _sorted_path.write_bytes(_bybit_archive(3, rows=10))
+    _unsorted_path = tmp_path / 'unsorted.csv.gz'
+    _unsorted_path.write_bytes(_bybit_archive(3, rows=10, order=_UNSORTED_ORDER))
+
+    for _chunk_rows in [1, 3, 4, 200_000]:
+        _tradesutil = TradesDownloadUtil(InMemoryTradeStore(), bybit_chunk_rows=_chunk_rows)
+
+        # 並んでいるファイルは全体を読み込まずにチャンクの行数ずつ返す
+        _chunks = list(_tradesutil._iter_bybit_csv_chunks('bybit', str(_sorted_path)))
+        assert all(len(_chunk) <= _chunk_rows for _chunk in _chunks)
+        assert pd.concat(_chunks)['trdMatchID'].tolist() == [f'03-{_i:04d}' for _i in range(10)]
+        assert _full_reads == []
+
+        # 並んでいないファイルでは、チャンクの行数によらず同じ順序で返す
+        _chunks = list(_tradesutil._iter_bybit_csv_chunks('bybit', str(_unsorted_path)))
+        assert pd.concat(_chunks)['trdMatchID'].tolist() == [f'03-{_i:04d}' for _i in _UNSORTED_EXPECTED]
+        assert _full_reads == [str(_unsorted_path)]
+        _full_reads.clear()
+
+class _FailingStore(InMemoryTradeStore):
+    # fail_after回書き込んだ後の書き込みで例外を送出する
+    def __init__(self, fail_after=None):
+        super().__init__()
+        self.fail_after = fail_after
+
+    def df_to_sql(self, df=None, schema=None, if_exists='fail', method=None, on_conflict_do_nothing=True, checkpoint=None):
+        if self.fail_after is not None:
+            if self.fail_after <= 0:
+                raise IOError('write failed')
+            self.fail_after -= 1
+        return super().df_to_sql(df, schema, if_exists, method, on_conflict_do_nothing, checkpoint)
+
+def test_bybit_download_resumes_inside_unsorted_file(archive_server, tmp_path):
+    archive_server.files['/trading/BTCUSD/BTCUSD2019-10-03.csv.gz'] = _bybit_archive(3, rows=10, order=_UNSORTED_ORDER)
+    archive_server.files['/trading/BTCUSD/BTCUSD2019-10-04.csv.gz'] = _bybit_archive(4, rows=10)
+    _store = _FailingStore(fail_after=4)
+    _prefetcher = BybitArchivePrefetcher(cache_dir=str(tmp_path), base_url=archive_server.url, max_workers=1, prefetch_days=1, retry_wait=0.01)
+    _tradesutil = TradesDownloadUtil(_store, bybit_prefetcher=_prefetcher, ccxt_clients={'bybit': _FakeBybit()}, write_behind_rows=1, write_behind_delay=0.01, write_behind_queue_size=0, bybit_chunk_rows=2)
+    _table_name = _store.get_trade_table_name('bybit', 'BTC/USD')
+
+    # 並びが崩れた後の約定を書き込んでいる途中で止まる
+    with pytest.raises(IOError):
+        _tradesutil.download_bybit_trades(exchange='bybit', symbol='BTC/USD', since_datetime=datetime(2019, 10, 3, tzinfo=timezone.utc))
+    _checkpoint = _store.get_trade_checkpoint('bybit', 'BTC/USD')
+    assert _checkpoint['id'] == '03-0006' and _checkpoint.get('bybit_file_date') is None
+
+    # 再開しても、時刻が再開位置より後でも書き込み済みの約定は書き込まず、時刻が前でも未書き込みの約定は書き込む
+    _store.fail_after = None
+    _tradesutil.download_bybit_trades(exchange='bybit', symbol='BTC/USD')
+    _df = _store.read_table(_table_name)
+    assert _df['id'].tolist() == [f'03-{_i:04d}' for _i in _UNSORTED_EXPECTED] + [f'04-{_i:04d}' for _i in range(10)]
+    assert (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
+
+def test_download_resumes_from_checkpoint_after_crash_between_batches(tmp_path):
+    _exchange_class = _fake_binance(rows=3_000, trades_per_second=2)
+    _store = _FailingStore(fail_after=2)
+    _tradesutil = _create_fake_tradesutil(_store, _exchange_class, str(tmp_path), limit=500)
+    _tradesutil._write_behind_params = dict(_tradesutil._write_behind_params, max_rows=1, max_queue_size=0)
+    _table_name = _store.get_trade_table_name('binance', 'BTC/USDT')
+
+    # 3回目の書き込みで落ちる。書き込めた2バッチ分だけが残り、再開位置はその最後の約定になる
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+    _ids = _store.read_table(_table_name)['id'].astype(int).tolist()
+    assert 0 < len(_ids) < 3_000 and _ids == list(range(len(_ids)))
+    assert int(_store.get_trade_checkpoint('binance', 'BTC/USDT')['id']) == _ids[-1]
+
+    # 再実行すると再開位置の次の約定から書き込み、累積和もつながる
+    _store.fail_after = None
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+    _df = _store.read_table(_table_name)
+    assert _df['id'].astype(int).tolist() == list(range(3_000))
+    assert (_df['dollar_cumsum'] == _df['dollar'].cumsum()).all()
@@ -0,0 +1,82 @@
+import json
+import multiprocessing
+import threading
+
+from benchmark import FakeCcxtExchange, InMemoryTradeStore, _create_fake_tradesutil
+from window_controller_util import WindowDensityStore
+
+def _set_densities(path, prefix, count):
+    _store = WindowDensityStore(path)
+    for _i in range(count):
+        _store.set(prefix, f'SYMBOL{_i}', float(_i + 1))
+
+def test_stores_on_the_same_path_keep_each_others_entries(tmp_path):
+    _path = str(tmp_path / 'window_density.json')
+    assert WindowDensityStore(_path)._lock is WindowDensityStore(str(tmp_path / '.' / 'window_density.json'))._lock
+
+    # 別々のプロセスと、別々のインスタンスのスレッドから同じファイルに書き込む。ロックを持ったスレッドごとforkしないように、プロセスを先に起動する
+    _processes = [multiprocessing.get_context('fork').Process(target=_set_densities, args=(_path, f'process{_i}', 20)) for _i in range(2)]
+    _threads = [threading.Thread(target=_set_densities, args=(_path, f'thread{_i}', 20)) for _i in range(4)]
+    for _worker in _processes + _threads:
+        _worker.start()
+    for _worker in _threads + _processes:
+        _worker.join()
+
+    with open(_path, 'r') as _f:
+        _densities = json.load(_f)
+    assert len(_densities) == 6 * 20
+    assert WindowDensityStore(_path).get('process1', 'SYMBOL19') == 20.0
+
+def _recording_binance(rows, trades_per_second):
+    # リクエストの期間と、返した約定の件数・最後の時刻を記録する偽の取引所
+    _base = FakeCcxtExchange.create(rows, trades_per_second)
+
+    class _Exchange(_base):
+        requests = []
+
+        def fetch_trades(self, symbol, since=None, limit=None, params={}):
+            # 実際の取引所と同じく、文字列として並べても約定順になるIDにする
+            _trades = [dict(_trade, id=f"{int(_trade['id']):08d}") for _trade in super().fetch_trades(symbol, since, limit, params)]
+            with self._lock:
+                type(self).requests.append((params['startTime'], params['endTime'], len(_trades), _trades[-1]['timestamp'] if len(_trades) > 0 else None))
+            return _trades
+
+    return _Exchange
+
+def test_full_page_is_kept_and_paging_continues_from_its_last_trade(tmp_path):
+    # 1ミリ秒に5件の約定があるので、上限件数に達したページの最後の時刻の約定は次のページにもまたがる
+    _exchange_class = _recording_binance(rows=2_000, trades_per_second=5_000)
+    _store = InMemoryTradeStore()
+    _tradesutil = _create_fake_tradesutil(_store, _exchange_class, str(tmp_path), limit=100)
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+
+    # 上限件数に達したページも捨てずに書き込み、抜けも重複もない
+    _ids = _store.read_table(_store.get_trade_table_name('binance', 'BTC/USDT'))['id'].astype(int).tolist()
+    assert _ids == list(range(2_000))
+    assert not any([_counter['name'] == 'discarded_full_pages' for _counter in _tradesutil.metrics.snapshot()['counters']])
+
+    # 上限件数に達したページの次は、そのページの最後の約定の時刻から取得する
+    _full_pages = 0
+    for _request, _next_request in zip(_exchange_class.requests[:-1], _exchange_class.requests[1:]):
+        if _request[2] >= 100:
+            _full_pages += 1
+            assert _next_request[0] == _request[3]
+    assert _full_pages >= 2_000 // 100 - 1
+
+def test_learned_density_is_persisted_and_reused(tmp_path):
+    _exchange_class = _recording_binance(rows=5_000, trades_per_second=2)
+    _tradesutil = _create_fake_tradesutil(InMemoryTradeStore(), _exchange_class, str(tmp_path))
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+
+    # 学習した頻度がファイルに保存され、別のインスタンスからも読める
+    _trades_per_second = WindowDensityStore(str(tmp_path / 'window_density.json')).get('binance', 'BTC/USDT')
+    assert _trades_per_second is not None and 1.0 < _trades_per_second < 4.0
+
+    # 次の実行の最初のリクエストは、既定の30分ではなく保存した頻度から予測した期間になる
+    _exchange_class.requests = []
+    _tradesutil = _create_fake_tradesutil(InMemoryTradeStore(), _exchange_class, str(tmp_path))
+    _tradesutil.download_trades(exchange='binance', symbol='BTC/USDT', since_datetime=_exchange_class.get_start_datetime())
+    _expected = _tradesutil._create_window_controller('binance', _trades_per_second).next_interval()
+    _start_time, _end_time = _exchange_class.requests[0][:2]
+    assert _end_time - _start_time == int(_expected / 1_000_000)
+    assert _end_time - _start_time != 30 * 60 * 1000
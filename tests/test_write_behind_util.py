@@ -0,0 +1,25 @@
+import pandas as pd
+
+from write_behind_util import WriteBehindWriter
+
+def _df(first, last):
+    return pd.DataFrame({'id': list(range(first, last + 1))})
+
+def test_merged_batch_keeps_last_non_none_context():
+    _writes = []
+    with WriteBehindWriter(lambda key, df, context: _writes.append((key, df['id'].tolist(), context)), max_rows=100, max_delay=1.0) as _writer:
+        # 1日目のファイルの最後のチャンクの後に、2日目のファイルの途中のチャンクが続く
+        _writer.put('trade', _df(1, 2), None)
+        _writer.put('trade', _df(3, 4), '2021-01-01')
+        _writer.put('trade', _df(5, 6), None)
+
+    assert _writes == [('trade', [1, 2, 3, 4, 5, 6], '2021-01-01')]
+
+def test_latest_context_wins_and_keys_are_not_merged():
+    _writes = []
+    with WriteBehindWriter(lambda key, df, context: _writes.append((key, df['id'].tolist(), context)), max_rows=100, max_delay=1.0) as _writer:
+        _writer.put('a', _df(1, 1), '2021-01-01')
+        _writer.put('a', _df(2, 2), '2021-01-02')
+        _writer.put('b', _df(3, 3), None)
+
+    assert _writes == [('a', [1, 2], '2021-01-02'), ('b', [3], None)]
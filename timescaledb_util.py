@@ -1,8 +1,22 @@
+import hashlib
+import io
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
 import pandas as pd
 from decimal import Decimal
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from bulk_load_util import LOAD_TRADE_COLUMNS, LOAD_BAR_COLUMNS, DEFAULT_BAR_COLUMNS, LOAD_TIMESTAMP_TYPE, get_load_type, check_load_params, empty_load_table, load_with_cache
+from fixedpoint_util import FIXEDPOINT_ATTRS_KEY, get_fixedpoint_attrs, fixedpoint_to_decimal, parse_scaled_int
+
 class TimeScaleDBUtil:
     """
     TimeScaleDBを使って約定履歴とドルバー情報を保存、読み込むユーティリティクラス    
@@ -18,8 +32,51 @@ class TimeScaleDBUtil:
         TimeScaleDBのポート番号。
     database : str, 必須
         TimeScaleDBのデータベース名。
+    pool_size : int, default = 5
+        コネクションプールで保持する接続数。
+    max_overflow : int, default = 10
+        pool_sizeを超えて一時的に作成できる接続数。
+    pool_timeout : float, default = 30
+        プールから接続を取得できるまで待つ秒数。
+    pool_recycle : int, default = 1800
+        この秒数より古い接続は作り直す。-1の場合は作り直さない。
+    pool_pre_ping : bool, default = True
+        プールから取得した接続が使えるかを確認してから使う。
+    executemany_mode : str, default = 'values_plus_batch'
+        psycopg2のexecutemanyの実行方式。DataFrame.to_sqlでの書き込みに使われる。
+    statement_timeout : int, default = None
+        SQL文1つあたりの最大実行時間(ミリ秒)。Noneの場合はサーバーの設定に従う。
+    application_name : str, default = 'crypto_trades_downloader'
+        pg_stat_activityに表示される接続元の名前。
+    compress_after : str, default = None
+        新しく作る約定テーブルのチャンクを圧縮するまでの期間。Noneの場合は圧縮しない。
+        これより古い約定を書き込むと圧縮済みのチャンクへのON CONFLICT付きの書き込みになる。TimescaleDB 2.11より前では失敗し、2.11以降でも遅いので、
+        過去の約定を書き込んでいる間は指定せず、書き込み終えてからmigrate_trade_tableで設定する。TimescaleDB 2.11以降が必要。
+    drop_after : str, default = None
+        約定テーブルのチャンクを削除するまでの期間。Noneの場合は削除しない。
     """
-    def __init__(self, user = None, password = None, host = None, port = None, database = None):
+    # ダウンロードの再開位置を保存するテーブル
+    CHECKPOINT_TABLE_NAME = 'trade_checkpoint'
+    
+    # 取引所ごとの約定テーブルのチャンクの期間。1チャンクの約定が数百万件程度になるように、約定の多い取引所ほど短くする
+    chunk_time_intervals = {
+        'binance': '1 day',
+        'bybit': '1 day',
+        'ftx': '1 day',
+        'bequant': '7 days',
+        'bitfinex2': '7 days',
+        'kraken': '7 days',
+        'poloniex': '7 days',
+    }
+    DEFAULT_CHUNK_TIME_INTERVAL = '7 days'
+    # 圧縮したチャンクはdollar_cumsum順に並べ、generate_dollarbarのdollar_cumsumでの範囲指定で不要な部分を読まないようにする
+    TRADE_COMPRESS_ORDERBY = 'dollar_cumsum ASC, id ASC'
+    # 約定テーブルの日ごとの累積取引額を集計する連続集計の時間幅。dollar_cumsumから約定のある日を引く粗いインデックスとして使う
+    DOLLAR_CUMSUM_BUCKET = '1 day'
+    # 圧縮済みのチャンクにINSERT ... ON CONFLICTで書き込めるTimescaleDBの最小バージョン
+    COMPRESSION_MIN_VERSION = (2, 11)
+    
+    def __init__(self, user = None, password = None, host = None, port = None, database = None, pool_size = 5, max_overflow = 10, pool_timeout = 30, pool_recycle = 1800, pool_pre_ping = True, executemany_mode = 'values_plus_batch', statement_timeout = None, application_name = 'crypto_trades_downloader', compress_after = None, drop_after = None):
         if user == None:
             raise ValueError(f'TimeScaleDBのユーザー名を指定してください')
         if password == None:
@@ -32,13 +89,185 @@ class TimeScaleDBUtil:
             raise ValueError(f'TimeScaleDBのデータベース名を指定してください')
         
         _sqlalchemy_config = f'postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'
-        self._engine = create_engine(_sqlalchemy_config)
+        _connect_args = {'application_name': application_name}
+        if statement_timeout is not None:
+            _connect_args['options'] = f'-c statement_timeout={int(statement_timeout)}'
+        self._engine = create_engine(_sqlalchemy_config, pool_size = pool_size, max_overflow = max_overflow, pool_timeout = pool_timeout, pool_recycle = pool_recycle, pool_pre_ping = pool_pre_ping, executemany_mode = executemany_mode, connect_args = _connect_args)
+        
+        self._compress_after = compress_after
+        self._drop_after = drop_after
+        
+        # transactionの中では、同じスレッドの全ての読み書きがそのトランザクションの接続を使う
+        self._thread_local = threading.local()
+        
+        # テーブルの存在と最新・最古の行はメモリ上にキャッシュし、書き込み時に無効にする
+        self._metadata_lock = threading.Lock()
+        self._metadata_connection = None
+        self._prepared_statements = set()
+        self._tables = None
+        self._row_cache = {}
         
         # enum_side型がデータベース上に存在することを確認し、ない場合は作成する
-        _df = self.read_sql_query("SELECT * from pg_type WHERE typname='enum_side'")
-        if _df.empty == True:
+        if self._fetch_one('SELECT 1 FROM pg_type WHERE typname = $1', ['enum_side']) is None:
             self.sql_execute("CREATE TYPE enum_side AS ENUM ('buy', 'sell')")
 
+    @contextmanager
+    def transaction(self):
+        """
+        ブロック内の読み書きを1つの接続と1つのトランザクションで行うコンテキストマネージャ
+        ブロックを正常に抜けるとコミットし、例外で抜けるとロールバックする。入れ子にした場合は外側のトランザクションを使う。
+
+        使用例
+        -------
+        with dbutil.transaction():
+            dbutil.df_to_sql(df=df1, schema=table_name, if_exists='append')
+            dbutil.df_to_sql(df=df2, schema=table_name, if_exists='append')
+        """
+        _current = getattr(self._thread_local, 'connection', None)
+        if _current is not None:
+            yield _current
+            return
+        
+        _tables = set() if self._tables is None else set(self._tables)
+        try:
+            with self._engine.begin() as _connection:
+                self._thread_local.connection = _connection
+                try:
+                    yield _connection
+                finally:
+                    self._thread_local.connection = None
+        except:
+            # ロールバックされたテーブルの作成と書き込みをキャッシュに残さない
+            if self._tables is not None:
+                self._tables = _tables
+            self._row_cache = {}
+            raise
+    
+    @contextmanager
+    def _raw_connection(self):
+        # DBAPIの接続を返す。transactionの中ではその接続を使い、コミットはtransactionに任せる
+        _current = getattr(self._thread_local, 'connection', None)
+        if _current is not None:
+            yield _current.connection
+            return
+        
+        _connection = self._engine.raw_connection()
+        try:
+            yield _connection
+            _connection.commit()
+        except:
+            _connection.rollback()
+            raise
+        finally:
+            _connection.close()
+    
+    def get_pool_stats(self):
+        """
+        コネクションプールの状態を監視用にdictで返す関数
+        
+        返り値
+        -------
+        dict
+            pool_size(保持する接続数), checked_in(待機中の接続数), checked_out(使用中の接続数), overflow(pool_sizeを超えて作成した接続数), status(SQLAlchemyの状態文字列)。
+        """
+        _pool = self._engine.pool
+        return {
+            'pool_size': _pool.size(),
+            'checked_in': _pool.checkedin(),
+            'checked_out': _pool.checkedout(),
+            'overflow': _pool.overflow(),
+            'status': _pool.status(),
+        }
+    
+    def _get_metadata_connection(self):
+        # PREPAREした文は接続ごとに有効なので、メタデータの参照には1本の接続をプールから切り離して使い続ける
+        if self._metadata_connection is None:
+            _connection = self._engine.raw_connection()
+            _connection.detach()
+            _connection.connection.autocommit = True
+            self._metadata_connection = _connection
+            self._prepared_statements = set()
+        return self._metadata_connection
+    
+    def _reset_metadata_connection(self):
+        # テーブルを作り直した場合など、PREPAREした文が使えなくなったときに接続ごと破棄する
+        with self._metadata_lock:
+            if self._metadata_connection is not None:
+                try:
+                    self._metadata_connection.close()
+                except self._engine.dialect.dbapi.Error:
+                    pass
+            self._metadata_connection = None
+            self._prepared_statements = set()
+    
+    def _fetch_one(self, sql = None, params = []):
+        """
+        1行だけを返すSQLをPREPAREして実行し、結果をdictで返す関数。pandasを経由しない
+        パラメータ
+        ----------
+        sql : str, 必須
+            実行するSQL文。パラメータは$1, $2, ...で指定する。
+        params : list, default = []
+            SQL文のパラメータ。
+
+        返り値
+        -------
+        列名をキーとするdict。結果が0行の場合はNone。
+        """
+        if sql == None:
+            raise ValueError(f'実行するSQL文を指定してください')
+        
+        _statement_name = f'stmt_{hashlib.md5(sql.encode()).hexdigest()[:16]}'
+        _dbapi = self._engine.dialect.dbapi
+        with self._metadata_lock:
+            for _attempt in range(2):
+                _connection = self._get_metadata_connection()
+                try:
+                    with _connection.cursor() as _cursor:
+                        if _statement_name not in self._prepared_statements:
+                            _cursor.execute(f'PREPARE {_statement_name} AS {sql}')
+                            self._prepared_statements.add(_statement_name)
+                        if len(params) > 0:
+                            _cursor.execute(f'EXECUTE {_statement_name} ({", ".join(["%s"] * len(params))})', list(params))
+                        else:
+                            _cursor.execute(f'EXECUTE {_statement_name}')
+                        _row = _cursor.fetchone()
+                        if _row is None:
+                            return None
+                        return dict(zip([_column[0] for _column in _cursor.description], _row))
+                except (_dbapi.OperationalError, _dbapi.InterfaceError):
+                    # 接続が切れていた場合は作り直して1回だけ再試行する
+                    self._metadata_connection = None
+                    self._prepared_statements = set()
+                    if _attempt > 0:
+                        raise
+    
+    def _fetch_row_cached(self, table_name, key, sql):
+        # テーブルごとの最新・最古の行をキャッシュから返す。ない場合はDBから読み、行があればキャッシュする
+        _cache_key = (table_name, key)
+        if _cache_key in self._row_cache:
+            return self._row_cache[_cache_key]
+        if self.table_exists(table_name) == False:
+            return None
+        
+        _row = self._fetch_one(sql)
+        if _row is None:
+            return None
+        
+        # 約定時刻はDBからpandasで読んだ場合と同じくUTCのpandas.Timestampにそろえる
+        for _column in ['datetime', 'datetime_from']:
+            if _column in _row:
+                _row[_column] = pd.Timestamp(_row[_column]).tz_convert('UTC')
+        _series = pd.Series(_row)
+        self._row_cache[_cache_key] = _series
+        return _series
+    
+    def _invalidate_cache(self, table_name, drop = False):
+        # 書き込んだテーブルの最新の行のキャッシュを無効にする。テーブルを作り直した場合は最古の行も無効にする
+        self._row_cache.pop((table_name, 'latest'), None)
+        if drop == True:
+            self._row_cache.pop((table_name, 'first'), None)
+    
     def read_sql_query(self, sql = None, index_column = '', dtype={}):
         """
         指定されたSQLを実行し、結果をデータフレームで返す関数
@@ -60,7 +289,8 @@ class TimeScaleDBUtil:
         if hasattr(self, '_engine') == False:
             raise UnboundLocalError('SQLAlchemyが初期化されていません')
         
-        df = pd.read_sql_query(sql, self._engine, dtype=dtype)
+        _connection = getattr(self._thread_local, 'connection', None)
+        df = pd.read_sql_query(sql, _connection if _connection is not None else self._engine, dtype=dtype)
         if len(index_column) > 0:
             df = df.set_index(index_column)
         return df
@@ -75,134 +305,706 @@ class TimeScaleDBUtil:
 
         返り値
         -------
-        SQLクエリ結果を含んだdict。
+        結果の行のlist。行を返さないSQLの場合はNone。
         """
         if sql == None:
             raise ValueError(f'実行するSQL文を指定してください')
         if hasattr(self, '_engine') == False:
             raise UnboundLocalError('SQLAlchemyが初期化されていません')
         
-        return self._engine.execute(sql)
+        # SQL文は%をパラメータとして解釈させずにそのまま実行する
+        _current = getattr(self._thread_local, 'connection', None)
+        if _current is not None:
+            _result = _current.execution_options(no_parameters=True).exec_driver_sql(sql)
+            return _result.fetchall() if _result.returns_rows else None
+        
+        with self._engine.begin() as _connection:
+            _result = _connection.execution_options(no_parameters=True).exec_driver_sql(sql)
+            return _result.fetchall() if _result.returns_rows else None
     
-    def df_to_sql(self, df = None, schema = None, if_exists = 'fail'):
+    def df_to_sql(self, df = None, schema = None, if_exists = 'fail', method = 'copy', on_conflict_do_nothing = True, checkpoint = None):
+        """
+        データフレームを指定されたテーブルに書き込む関数
+        パラメータ
+        ----------
+        df : pandas.DataFrame, 必須
+            書き込むデータフレーム。列名はテーブルの列名と一致している必要がある。
+        schema : str, 必須
+            書き込み先のテーブル名。
+        if_exists : str, default = 'fail'
+            DataFrame.to_sqlと同じ意味を持つ。
+        method : str, default = 'copy'
+            'copy'の場合、既存テーブルへの追記はCOPY FROM STDINで行う。'insert'の場合は従来通りDataFrame.to_sqlを使う。
+        on_conflict_do_nothing : bool, default = True
+            COPYで書き込む際に一時テーブルを経由し、UNIQUE制約に違反する行を無視する。
+        checkpoint : dict, default = None
+            書き込みと同じトランザクションで更新するダウンロードの再開位置(set_trade_checkpoint参照)。
+
+        返り値
+        -------
+        書き込んだ行数。
+        """
         if df.empty or schema == None:
-            return  
-        return df.to_sql(schema, con = self._engine, if_exists = if_exists, index = False)
+            return
+        if method not in ['copy', 'insert']:
+            raise ValueError(f'method には copy か insert を指定してください : {method}')
+
+        # COPYは既存テーブルへの追記のみ対応する。テーブルの作成や置き換えはto_sqlに任せる
+        if method == 'copy' and if_exists == 'append' and self.table_exists(schema):
+            return self.copy_df_to_table(df = df, table_name = schema, on_conflict_do_nothing = on_conflict_do_nothing, checkpoint = checkpoint)
+
+        try:
+            # 再開位置を指定した場合は、約定と再開位置を同じトランザクションで書き込む
+            with self.transaction() if checkpoint is not None else nullcontext():
+                _connection = getattr(self._thread_local, 'connection', None)
+                _rows = fixedpoint_to_decimal(df).to_sql(schema, con = _connection if _connection is not None else self._engine, if_exists = if_exists, index = False)
+                if checkpoint is not None:
+                    self.set_trade_checkpoint(checkpoint)
+            return _rows
+        finally:
+            self._invalidate_cache(schema, drop = if_exists == 'replace')
+            if self._tables is not None:
+                self._tables.add(schema)
+
+    def copy_df_to_table(self, df = None, table_name = None, on_conflict_do_nothing = True, checkpoint = None):
+        """
+        データフレームをCSVとしてメモリ上に書き出し、COPY FROM STDINで既存テーブルに書き込む関数
+        パラメータ
+        ----------
+        df : pandas.DataFrame, 必須
+            書き込むデータフレーム。
+        table_name : str, 必須
+            書き込み先のテーブル名。
+        on_conflict_do_nothing : bool, default = True
+            Trueの場合、一時テーブルにCOPYしてからINSERT ... ON CONFLICT DO NOTHINGで本テーブルに移す。
+            固定小数点列(fixedpoint_util.compute_dollar_cumsumsの結果)を含む場合は、一時テーブル上の整数をNUMERICに戻してから移す。
+        checkpoint : dict, default = None
+            指定した場合、同じトランザクションでダウンロードの再開位置を更新する。クラッシュしても書き込んだ約定と再開位置が食い違わない。
+
+        返り値
+        -------
+        書き込んだ行数。
+        """
+        if df is None or table_name == None:
+            raise ValueError(f'書き込むデータフレームとテーブル名を指定してください')
+        if hasattr(self, '_engine') == False:
+            raise UnboundLocalError('SQLAlchemyが初期化されていません')
+        if df.empty:
+            return 0
+
+        _buffer = io.StringIO()
+        df.to_csv(_buffer, index = False, header = False)
+        _buffer.seek(0)
+
+        _columns = ', '.join([f'"{_column}"' for _column in df.columns])
+
+        # 固定小数点列は10**scale倍された整数として一時テーブルにCOPYし、NUMERICのままscaleとオフセットを戻す
+        _fixedpoint = get_fixedpoint_attrs(df)
+        _select_columns = _columns
+        if _fixedpoint is not None:
+            _select_columns = ', '.join([self._get_fixedpoint_select_expression(_column, _fixedpoint) for _column in df.columns])
+
+        if checkpoint is not None:
+            self._init_checkpoint_table()
+
+        try:
+            with self._raw_connection() as _connection, _connection.cursor() as _cursor:
+                if on_conflict_do_nothing == True or _fixedpoint is not None:
+                    _on_conflict = ' ON CONFLICT DO NOTHING' if on_conflict_do_nothing == True else ''
+                    _staging_table_name = f'{table_name}_staging_{uuid.uuid4().hex[:8]}'
+                    _cursor.execute(f'CREATE TEMP TABLE "{_staging_table_name}" (LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+                    _cursor.copy_expert(f'COPY "{_staging_table_name}" ({_columns}) FROM STDIN WITH (FORMAT csv)', _buffer)
+                    _cursor.execute(f'INSERT INTO "{table_name}" ({_columns}) SELECT {_select_columns} FROM "{_staging_table_name}"{_on_conflict}')
+                else:
+                    _cursor.copy_expert(f'COPY "{table_name}" ({_columns}) FROM STDIN WITH (FORMAT csv)', _buffer)
+                if checkpoint is not None:
+                    self._upsert_checkpoint(_cursor, checkpoint)
+        finally:
+            self._invalidate_cache(table_name)
+
+        return len(df)
+
+    def _get_fixedpoint_select_expression(self, column, fixedpoint):
+        # 10**scale倍された整数列をNUMERICの値に戻すSQL式を作る。NUMERIC同士の乗算と加算なので誤差は出ない
+        if column not in fixedpoint['scales']:
+            return f'"{column}"'
+        
+        _expression = f'"{column}"'
+        _scale = fixedpoint['scales'][column]
+        if _scale > 0:
+            _expression = f"{_expression} * {format(Decimal(1).scaleb(-_scale), 'f')}"
+        _offset = fixedpoint['offsets'].get(column, Decimal(0))
+        if _offset != 0:
+            _expression = f"{_expression} + {format(Decimal(_offset), 'f')}"
+        return f'{_expression} AS "{column}"'
+
+    def table_exists(self, table_name = None):
+        """
+        指定されたテーブルがデータベース上に存在するかを返す関数
+        パラメータ
+        ----------
+        table_name : str, 必須
+            確認するテーブル名。
+
+        返り値
+        -------
+        テーブルが存在すればTrue。
+        """
+        # テーブル名の一覧は最初の1回だけ読み込む。一覧にないテーブルは他のプロセスが作成した可能性があるので確認する
+        if self._tables is None:
+            with self._metadata_lock:
+                _connection = self._get_metadata_connection()
+                with _connection.cursor() as _cursor:
+                    _cursor.execute('SELECT table_name FROM information_schema.tables')
+                    self._tables = set([_row[0] for _row in _cursor.fetchall()])
+        if table_name in self._tables:
+            return True
+        
+        if self._fetch_one('SELECT 1 FROM information_schema.tables WHERE table_name = $1', [table_name]) is None:
+            return False
+        self._tables.add(table_name)
+        return True
+    
+    def _create_table(self, table_name, sql):
+        # テーブルを作成するSQLを実行し、テーブルの一覧に追加する。作り直したテーブルのキャッシュとPREPAREした文は破棄する
+        self.sql_execute(sql)
+        self._invalidate_cache(table_name, drop = True)
+        self._reset_metadata_connection()
+        self.table_exists(table_name)
+        self._tables.add(table_name)
     
     ### 約定履歴テーブル関係の処理
     def get_trade_table_name(self, exchange, symbol):
         return (f'{exchange}_{symbol}_trade').lower()
     
-    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False):    
+    def _init_checkpoint_table(self):
+        # 取引所とシンボルごとに1行のチェックポイントテーブルを作成する
+        if self.table_exists(self.CHECKPOINT_TABLE_NAME) == True:
+            return
+        self._create_table(self.CHECKPOINT_TABLE_NAME, f'CREATE TABLE IF NOT EXISTS "{self.CHECKPOINT_TABLE_NAME}" (exchange text NOT NULL, symbol text NOT NULL, datetime TIMESTAMP WITH TIME ZONE NOT NULL, id text, dollar_cumsum NUMERIC NOT NULL, buy_dollar_cumsum NUMERIC NOT NULL, sell_dollar_cumsum NUMERIC NOT NULL, bybit_file_date DATE, updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(), PRIMARY KEY (exchange, symbol))')
+    
+    def _upsert_checkpoint(self, cursor, checkpoint):
+        # 再開位置を更新する。並列に書き込まれた古いバッチで再開位置が戻らないように、累積取引額が増える場合だけ更新する
+        _params = {
+            'exchange': checkpoint['exchange'],
+            'symbol': checkpoint['symbol'],
+            'datetime': str(checkpoint['datetime']),
+            'id': str(checkpoint['id']),
+            'dollar_cumsum': Decimal(checkpoint['dollar_cumsum']),
+            'buy_dollar_cumsum': Decimal(checkpoint['buy_dollar_cumsum']),
+            'sell_dollar_cumsum': Decimal(checkpoint['sell_dollar_cumsum']),
+            'bybit_file_date': None if checkpoint.get('bybit_file_date') is None else pd.Timestamp(checkpoint['bybit_file_date']).strftime('%Y-%m-%d'),
+        }
+        cursor.execute(f'INSERT INTO "{self.CHECKPOINT_TABLE_NAME}" (exchange, symbol, datetime, id, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum, bybit_file_date, updated_at)'
+                       ' VALUES (%(exchange)s, %(symbol)s, %(datetime)s, %(id)s, %(dollar_cumsum)s, %(buy_dollar_cumsum)s, %(sell_dollar_cumsum)s, %(bybit_file_date)s, now())'
+                       ' ON CONFLICT (exchange, symbol) DO UPDATE SET datetime = EXCLUDED.datetime, id = EXCLUDED.id, dollar_cumsum = EXCLUDED.dollar_cumsum, buy_dollar_cumsum = EXCLUDED.buy_dollar_cumsum, sell_dollar_cumsum = EXCLUDED.sell_dollar_cumsum,'
+                       f' bybit_file_date = COALESCE(EXCLUDED.bybit_file_date, "{self.CHECKPOINT_TABLE_NAME}".bybit_file_date), updated_at = now()'
+                       f' WHERE "{self.CHECKPOINT_TABLE_NAME}".dollar_cumsum <= EXCLUDED.dollar_cumsum', _params)
+    
+    def set_trade_checkpoint(self, checkpoint = None):
+        """
+        ダウンロードの再開位置を保存する関数。transactionの外では約定の書き込みとは別のトランザクションで保存する
+        パラメータ
+        ----------
+        checkpoint : dict, 必須
+            exchange, symbol, datetime, id, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum, bybit_file_date(Bybitのみ)をキーに持つdict。
+        """
+        self._init_checkpoint_table()
+        with self._raw_connection() as _connection, _connection.cursor() as _cursor:
+            self._upsert_checkpoint(_cursor, checkpoint)
+    
+    def get_trade_checkpoint(self, exchange='ftx', symbol='BTC-PERP'):
+        """
+        保存されているダウンロードの再開位置をpandas.Seriesで返す関数。ない場合はNone
+        """
+        if self.table_exists(self.CHECKPOINT_TABLE_NAME) == False:
+            return None
+        _row = self._fetch_one(f'SELECT datetime, id, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum, bybit_file_date FROM "{self.CHECKPOINT_TABLE_NAME}" WHERE exchange = $1 AND symbol = $2', [exchange, symbol])
+        if _row is None:
+            return None
+        _row['datetime'] = pd.Timestamp(_row['datetime']).tz_convert('UTC')
+        if _row['bybit_file_date'] is not None:
+            _row['bybit_file_date'] = pd.Timestamp(_row['bybit_file_date'], tz='UTC')
+        return pd.Series(_row)
+    
+    def get_chunk_time_interval(self, exchange):
+        return self.chunk_time_intervals.get(exchange, self.DEFAULT_CHUNK_TIME_INTERVAL)
+    
+    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False, chunk_time_interval=None):    
         _table_name = self.get_trade_table_name(exchange, symbol)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == False and force == False:
+        if self.table_exists(_table_name) == True and force == False:
             return
+        _chunk_time_interval = chunk_time_interval if chunk_time_interval is not None else self.get_chunk_time_interval(exchange)
         
         # トレード記録テーブルを作成
         _sql = (f'DROP TABLE IF EXISTS "{_table_name}" CASCADE;'
                 f' CREATE TABLE IF NOT EXISTS "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, id text, side enum_side NOT NULL, liquidation BOOL NOT NULL, price NUMERIC NOT NULL, amount NUMERIC NOT NULL, dollar NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, buy_dollar_cumsum NUMERIC NOT NULL, sell_dollar_cumsum NUMERIC NOT NULL, UNIQUE(datetime, id));'
                 f' CREATE INDEX ON "{_table_name}" (datetime DESC);'
                 f' CREATE INDEX ON "{_table_name}" (datetime DESC, dollar_cumsum);'
-                f" SELECT create_hypertable ('{_table_name}', 'datetime');")
-        self.sql_execute(_sql)
+                f' CREATE INDEX IF NOT EXISTS "{_table_name}_dollar_cumsum_id_idx" ON "{_table_name}" (dollar_cumsum, id);'
+                f" SELECT create_hypertable ('\"{_table_name}\"', 'datetime', chunk_time_interval => INTERVAL '{_chunk_time_interval}');")
+        self._create_table(_table_name, _sql)
+        self._set_trade_table_policies(_table_name, self._compress_after, self._drop_after)
         
-        # 累積出来高記録用Maerialized viewを作成
-        _sql = (f'DROP MATERIALIZED VIEW IF EXISTS "{_table_name}_dollar_cumsum_daily" CASCADE;'
-                f'CREATE MATERIALIZED VIEW "{_table_name}_dollar_cumsum_daily" WITH (timescaledb.continuous) AS SELECT time_bucket(INTERVAL "1 day", datetime) AS time, MAX(dollar_cumsum) AS dollar_cumsum, MAX(buy_dollar_cumsum) AS buy_dollar_cumsum, MAX(sell_dollar_cumsum) AS sell_dollar_cumsum, LAST(price, datetime) AS close FROM "{_table_mane}" GROUP BY time WITH NO DATA')
-        self.sql_execute(_sql)
+        # 作り直したテーブルの再開位置を消す
+        if self.table_exists(self.CHECKPOINT_TABLE_NAME) == True:
+            with self._raw_connection() as _connection, _connection.cursor() as _cursor:
+                _cursor.execute(f'DELETE FROM "{self.CHECKPOINT_TABLE_NAME}" WHERE exchange = %(exchange)s AND symbol = %(symbol)s', {'exchange': exchange, 'symbol': symbol})
         
-    def get_latest_trade(self, exchange='ftx', symbol='BTC-PERP'):
+        # 連続集計はテーブルと一緒に削除されている
+        if self._tables is not None:
+            self._tables.discard(self.get_dollar_cumsum_daily_name(exchange, symbol))
+        self.init_dollar_cumsum_daily(exchange, symbol)
+    
+    def get_dollar_cumsum_daily_name(self, exchange, symbol):
+        return f'{self.get_trade_table_name(exchange, symbol)}_dollar_cumsum_daily'
+    
+    def init_dollar_cumsum_daily(self, exchange='binance', symbol='BTC/USDT'):
+        """
+        約定テーブルの日ごとの累積取引額の連続集計(<約定テーブル名>_dollar_cumsum_daily)を作成し、更新ポリシーを設定する関数
+        集計済みでない期間は約定テーブルから集計するので、更新ポリシーの実行前でも最新の約定まで反映される。
+        既存のテーブルに作成する場合は、全期間を約定テーブルから集計しないようにmigrate_trade_tableで作成してすぐに更新する。
+        パラメータ
+        ----------
+        exchange : str, default = 'binance'
+            取引所名。
+        symbol : str, default = 'BTC/USDT'
+            シンボル名。
+        """
         _table_name = self.get_trade_table_name(exchange, symbol)
-        
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
+        _view_name = self.get_dollar_cumsum_daily_name(exchange, symbol)
+        _sql = (f'CREATE MATERIALIZED VIEW IF NOT EXISTS "{_view_name}" WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS'
+                f" SELECT time_bucket(INTERVAL '{self.DOLLAR_CUMSUM_BUCKET}', datetime) AS time, MIN(dollar_cumsum) AS dollar_cumsum_min, MAX(dollar_cumsum) AS dollar_cumsum,"
+                f' MAX(buy_dollar_cumsum) AS buy_dollar_cumsum, MAX(sell_dollar_cumsum) AS sell_dollar_cumsum, LAST(price, datetime) AS close'
+                f' FROM "{_table_name}" GROUP BY time WITH NO DATA')
+        self._create_table(_view_name, _sql)
+        # 過去の日の集計は1時間ごとに更新する。集計中の日は集計済みでない期間として約定テーブルから読む
+        self.sql_execute(f"SELECT add_continuous_aggregate_policy('\"{_view_name}\"', start_offset => NULL, end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '1 hour', if_not_exists => true)")
+    
+    def refresh_dollar_cumsum_daily(self, exchange='binance', symbol='BTC/USDT'):
+        """
+        日ごとの累積取引額の連続集計を、更新ポリシーの実行を待たずに全期間について更新する関数
+        """
+        _view_name = self.get_dollar_cumsum_daily_name(exchange, symbol)
+        _connection = self._engine.raw_connection()
+        try:
+            # refresh_continuous_aggregateはトランザクションの中では実行できない
+            _connection.driver_connection.autocommit = True
+            with _connection.cursor() as _cursor:
+                _cursor.execute(f"CALL refresh_continuous_aggregate('\"{_view_name}\"', NULL, NULL)")
+        finally:
+            _connection.driver_connection.autocommit = False
+            _connection.close()
+    
+    def get_dollar_cumsum_datetime(self, exchange='binance', symbol='BTC/USDT', dollar_cumsum=None):
+        """
+        dollar_cumsumがこの値以上の約定を全て含む最初の日の0時(UTC)を、日ごとの累積取引額の連続集計から返す関数
+        dollar_cumsumがこの値より小さい約定がある最後の日を返す。約定は時刻順に累積和が増えるように書き込まれるので、それより前の日の約定は全てこの値より小さい。
+        その日の最小値は後から約定が追記されても変わらないので、書き込み中の日が集計済みになっていても前の日を返すことはない。
+        パラメータ
+        ----------
+        exchange : str, default = 'binance'
+            取引所名。
+        symbol : str, default = 'BTC/USDT'
+            シンボル名。
+        dollar_cumsum : Decimal, 必須
+            探す累積取引額。
+
+        返り値
+        -------
+        pandas.Timestamp
+            連続集計がない場合と、この値より小さい約定がない場合はNone。
+        """
+        if dollar_cumsum is None:
+            raise ValueError(f'累積取引額を指定してください')
+        _view_name = self.get_dollar_cumsum_daily_name(exchange, symbol)
+        if self.table_exists(_view_name) == False:
             return None
+        _row = self._fetch_one(f'SELECT time FROM "{_view_name}" WHERE dollar_cumsum_min < $1 ORDER BY time DESC LIMIT 1', [Decimal(dollar_cumsum)])
+        if _row is None:
+            return None
+        return pd.Timestamp(_row['time']).tz_convert('UTC')
+    
+    def get_timescaledb_version(self):
+        """
+        TimescaleDB拡張のバージョンを(2, 11, 0)のようなintのタプルで返す関数
+        """
+        _rows = self.sql_execute("SELECT extversion FROM pg_extension WHERE extname = 'timescaledb'")
+        if _rows is None or len(_rows) <= 0:
+            raise ValueError(f'TimescaleDB拡張がインストールされていません')
+        return tuple([int(_part) for _part in re.findall(r'\d+', _rows[0][0])[:3]])
+    
+    def _set_trade_table_policies(self, table_name, compress_after, drop_after):
+        # 圧縮の設定と圧縮・削除のポリシーを設定する。既存のポリシーは置き換える
+        if compress_after is not None:
+            # 2.11より前は圧縮済みのチャンクへのON CONFLICT付きの書き込みが失敗し、再開時の重複する約定を書き込めなくなる
+            _version = self.get_timescaledb_version()
+            if _version[:2] < self.COMPRESSION_MIN_VERSION:
+                raise ValueError(f"約定テーブルの圧縮にはTimescaleDB {'.'.join(map(str, self.COMPRESSION_MIN_VERSION))}以降が必要です : {'.'.join(map(str, _version))}")
+            # 圧縮済みのチャンクがあると圧縮の設定は変更できないので、まだ圧縮が有効でない場合だけ設定する
+            _rows = self.sql_execute(f"SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = '{table_name}'")
+            if _rows is None or len(_rows) <= 0 or _rows[0][0] != True:
+                self.sql_execute(f"ALTER TABLE \"{table_name}\" SET (timescaledb.compress, timescaledb.compress_orderby = '{self.TRADE_COMPRESS_ORDERBY}')")
+            self.sql_execute(f"SELECT remove_compression_policy('\"{table_name}\"', if_exists => true)")
+            self.sql_execute(f"SELECT add_compression_policy('\"{table_name}\"', INTERVAL '{compress_after}')")
+        self.sql_execute(f"SELECT remove_retention_policy('\"{table_name}\"', if_exists => true)")
+        if drop_after is not None:
+            self.sql_execute(f"SELECT add_retention_policy('\"{table_name}\"', INTERVAL '{drop_after}')")
+    
+    def _get_trade_table_report(self, table_name, measure_scan):
+        # テーブルのサイズと、全ての約定をdollar_cumsumで集計するスキャンの所要時間を返す
+        _report = {'total_bytes': self.sql_execute(f"SELECT hypertable_size('\"{table_name}\"')")[0][0]}
+        _rows = self.sql_execute(f"SELECT count(*), count(*) FILTER (WHERE is_compressed) FROM timescaledb_information.chunks WHERE hypertable_name = '{table_name}'")
+        _report['chunks'], _report['compressed_chunks'] = _rows[0]
+        if measure_scan == True:
+            _start = time.perf_counter()
+            self.sql_execute(f'SELECT count(*), max(dollar_cumsum) FROM "{table_name}"')
+            _report['scan_seconds'] = time.perf_counter() - _start
+        return _report
+    
+    def migrate_trade_table(self, exchange='binance', symbol='BTC/USDT', chunk_time_interval=None, compress_after=None, drop_after=None, compress_now=True, measure_scan=True):
+        """
+        既存の約定テーブルにチャンクの期間、圧縮と圧縮・削除のポリシー、(dollar_cumsum, id)のインデックスを設定し、日ごとの累積取引額の連続集計を作成・更新する関数
+        チャンクの期間はこれから作られるチャンクにだけ反映される。
+        パラメータ
+        ----------
+        exchange : str, default = 'binance'
+            取引所名。
+        symbol : str, default = 'BTC/USDT'
+            シンボル名。
+        chunk_time_interval : str, default = None
+            チャンクの期間。例: '1 day'。Noneの場合は取引所ごとの既定値。
+        compress_after : str, default = None
+            チャンクを圧縮するまでの期間。Noneの場合はコンストラクタで指定した値で、どちらもNoneの場合は圧縮の設定を変更しない。
+            TimescaleDB 2.11以降が必要。過去の約定を書き込み終えてから設定する。
+        drop_after : str, default = None
+            チャンクを削除するまでの期間。Noneの場合はコンストラクタで指定した値。
+        compress_now : bool, default = True
+            compress_afterより古いチャンクをポリシーの実行を待たずにすぐ圧縮する。
+        measure_scan : bool, default = True
+            移行の前後で全ての約定を読むスキャンの所要時間を計る。
+
+        返り値
+        -------
+        dict
+            table, before, afterをキーに持つdict。before, afterはtotal_bytes, chunks, compressed_chunks, scan_seconds(measure_scanがTrueの場合)を持つ。
+        """
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        if self.table_exists(_table_name) == False:
+            raise ValueError(f'約定テーブル {_table_name} が存在しません')
+        _chunk_time_interval = chunk_time_interval if chunk_time_interval is not None else self.get_chunk_time_interval(exchange)
+        _compress_after = compress_after if compress_after is not None else self._compress_after
+        _drop_after = drop_after if drop_after is not None else self._drop_after
         
-        _df = self.read_sql_query(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime DESC LIMIT 1000) SELECT * FROM time_filtered ORDER BY dollar_cumsum DESC LIMIT 1', dtype={'price': str, 'amount': str, 'dollar': str, 'dollar_cumsum': str, 'buy_dollar_cumsum': str, 'sell_dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['price'] = _df['price'].apply(_to_decimal)
-            _df['amount'] = _df['amount'].apply(_to_decimal)
-            _df['dollar'] = _df['dollar'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['buy_dollar_cumsum'] = _df['buy_dollar_cumsum'].apply(_to_decimal)
-            _df['sell_dollar_cumsum'] = _df['sell_dollar_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
+        _report = {'table': _table_name, 'before': self._get_trade_table_report(_table_name, measure_scan)}
+        self.sql_execute(f"SELECT set_chunk_time_interval('\"{_table_name}\"', INTERVAL '{_chunk_time_interval}')")
+        # iter_tradesが(dollar_cumsum, id)の順に読むためのインデックス。init_trade_tableより前に作られたテーブルにも作成する
+        self.sql_execute(f'CREATE INDEX IF NOT EXISTS "{_table_name}_dollar_cumsum_id_idx" ON "{_table_name}" (dollar_cumsum, id)')
+        self._set_trade_table_policies(_table_name, _compress_after, _drop_after)
+        if compress_now == True and _compress_after is not None:
+            self.sql_execute(f"SELECT compress_chunk(_chunk, if_not_compressed => true) FROM show_chunks('\"{_table_name}\"', older_than => INTERVAL '{_compress_after}') AS _chunk")
+        self.init_dollar_cumsum_daily(exchange, symbol)
+        self.refresh_dollar_cumsum_daily(exchange, symbol)
+        _report['after'] = self._get_trade_table_report(_table_name, measure_scan)
+        return _report
+    
+    def _fetch_edge_trade(self, exchange, symbol, last):
+        # 連続集計から最新(最初)の日を求め、その日以降(以前)のチャンクだけを読んで最新(最古)の約定を返す
+        # 書き込み中の日は集計済みの最大値が古いことや、まだ集計にないことがあるので、最新の約定は日の範囲で上限を付けずに探す
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        _view_name = self.get_dollar_cumsum_daily_name(exchange, symbol)
+        if last == True:
+            _key, _order = 'latest', 'DESC'
+            _where = 'datetime >= (SELECT time FROM _bucket)'
+        else:
+            _key, _order = 'first', 'ASC'
+            _where = f"datetime < (SELECT time FROM _bucket) + INTERVAL '{self.DOLLAR_CUMSUM_BUCKET}'"
+        if self.table_exists(_view_name) == True:
+            _row = self._fetch_row_cached(_table_name, _key, f'WITH _bucket AS (SELECT time FROM "{_view_name}" ORDER BY time {_order} LIMIT 1)'
+                                                             f' SELECT * FROM "{_table_name}" WHERE {_where} ORDER BY dollar_cumsum {_order}, id {_order} LIMIT 1')
+            if _row is not None:
+                return _row
+        # 連続集計がない場合は直近(最初)の約定の中から探す
+        return self._fetch_row_cached(_table_name, _key, f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime {_order} LIMIT 1000) SELECT * FROM time_filtered ORDER BY dollar_cumsum {_order} LIMIT 1')
+    
+    def get_latest_trade(self, exchange='ftx', symbol='BTC-PERP'):
+        return self._fetch_edge_trade(exchange, symbol, last=True)
     
     def get_first_trade(self, exchange='ftx', symbol='BTC-PERP'):
+        return self._fetch_edge_trade(exchange, symbol, last=False)
+    
+    def iter_trades(self, exchange='ftx', symbol='BTC-PERP', from_dollar_cumsum=None, from_id=None, fetch_size=10000, fixedpoint=False):
+        """
+        約定履歴をdollar_cumsum順にサーバーサイドカーソルで読み出し、fetch_size件ずつのデータフレームを返すジェネレータ
+        (dollar_cumsum, id)のインデックスを使う。init_trade_tableより前に作られたテーブルはmigrate_trade_tableで作成しておく。
+        パラメータ
+        ----------
+        exchange : str, default = 'ftx'
+            取引所名。
+        symbol : str, default = 'BTC-PERP'
+            シンボル名。
+        from_dollar_cumsum : Decimal, default = None
+            この値より後の約定から読み出す。Noneの場合は最初の約定から読み出す。
+        from_id : str, default = None
+            from_dollar_cumsumと同じdollar_cumsumを持つ約定のうち、このidより後の約定から読み出す。Noneの場合はfrom_dollar_cumsumと同じ約定は読み出さない。
+        fetch_size : int, default = 10000
+            1回にDBから受け取る行数。クライアントが保持するのは最大この行数になる。
+        fixedpoint : bool, default = False
+            Trueの場合、数値列を固定小数点のint64で返す(fixedpoint_util参照)。int64で表せないチャンクはDecimalで返す。
+
+        返り値
+        -------
+        df : pandas.DataFrame
+            約定テーブルと同じ列を持つ、dollar_cumsum, idの昇順に並んだデータフレーム。
+        """
         _table_name = self.get_trade_table_name(exchange, symbol)
+        if self.table_exists(_table_name) == False:
+            return
+
+        _columns = ['datetime', 'id', 'side', 'liquidation', 'price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+        _numeric_columns = ['price', 'amount', 'dollar', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+        _cumsum_columns = ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']
+        _params = {}
+
+        # 読み出し開始位置はキーセット(dollar_cumsum, id)で指定する
+        _where = ''
+        if from_dollar_cumsum is not None and from_id is not None:
+            _where = 'WHERE (dollar_cumsum, id) > (%(from_dollar_cumsum)s, %(from_id)s)'
+            _params['from_dollar_cumsum'] = Decimal(from_dollar_cumsum)
+            _params['from_id'] = str(from_id)
+        elif from_dollar_cumsum is not None:
+            _where = 'WHERE dollar_cumsum > %(from_dollar_cumsum)s'
+            _params['from_dollar_cumsum'] = Decimal(from_dollar_cumsum)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
-            return None
-        
-        _df = self.read_sql_query(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime ASC LIMIT 1000) SELECT * FROM time_filtered ORDER BY dollar_cumsum ASC LIMIT 1', dtype={'price': str, 'amount': str, 'dollar': str, 'dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['price'] = _df['price'].apply(_to_decimal)
-            _df['amount'] = _df['amount'].apply(_to_decimal)
-            _df['dollar'] = _df['dollar'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['buy_dollar_cumsum'] = _df['buy_dollar_cumsum'].apply(_to_decimal)
-            _df['sell_dollar_cumsum'] = _df['sell_dollar_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
-    
+        # 開始位置より前の日のチャンクは読まないように、連続集計から求めた時刻でも絞り込む
+        if from_dollar_cumsum is not None:
+            _from_datetime = self.get_dollar_cumsum_datetime(exchange, symbol, from_dollar_cumsum)
+            if _from_datetime is not None:
+                _where = f'{_where} AND datetime >= %(from_datetime)s'
+                _params['from_datetime'] = _from_datetime.to_pydatetime()
+
+        # 固定小数点で返す場合、累積和は開始位置の値を引いた差分をDB側で計算し、int64に収まりやすくする
+        _offsets = {_column: Decimal(0) for _column in _cumsum_columns}
+        if fixedpoint == True and from_dollar_cumsum is not None:
+            _df = self.read_sql_query(f'SELECT dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum FROM "{_table_name}" WHERE dollar_cumsum <= {Decimal(from_dollar_cumsum)} ORDER BY dollar_cumsum DESC LIMIT 1', dtype={_column: str for _column in _cumsum_columns})
+            if len(_df) > 0:
+                _offsets = {_column: Decimal(_df.iloc[0][_column]) for _column in _cumsum_columns}
+
+        _select_columns = []
+        for _column in _columns:
+            if _column in _cumsum_columns:
+                _select_columns.append(f'({_column} - {_offsets[_column]})::text AS {_column}')
+            elif _column in _numeric_columns and fixedpoint == True:
+                _select_columns.append(f'{_column}::text AS {_column}')
+            else:
+                _select_columns.append(_column)
+        _sql = f'SELECT {", ".join(_select_columns)} FROM "{_table_name}" {_where} ORDER BY dollar_cumsum ASC, id ASC'
+
+        _connection = self._engine.raw_connection()
+        try:
+            # 名前付きカーソルはサーバー側で1回だけ計画・実行され、fetchmanyのたびに続きを受け取る
+            _cursor = _connection.cursor(name=f'iter_trades_{uuid.uuid4().hex[:8]}')
+            _cursor.itersize = fetch_size
+            _cursor.execute(_sql, _params)
+            while True:
+                _rows = _cursor.fetchmany(fetch_size)
+                if len(_rows) <= 0:
+                    break
+
+                _df = pd.DataFrame.from_records(_rows, columns=_columns)
+                yield self._convert_trade_chunk(_df, _numeric_columns, _cumsum_columns, _offsets, fixedpoint)
+            _cursor.close()
+        finally:
+            _connection.rollback()
+            _connection.close()
+
+    def _convert_trade_chunk(self, df, numeric_columns, cumsum_columns, offsets, fixedpoint):
+        # iter_tradesで読み出した文字列の数値列を、固定小数点のint64かDecimalに変換する
+        if fixedpoint == True:
+            try:
+                _df = df.copy()
+                _scales = {}
+                for _column in numeric_columns:
+                    _df[_column], _scales[_column] = parse_scaled_int(df[_column])
+                _df.attrs[FIXEDPOINT_ATTRS_KEY] = {'scales': _scales, 'offsets': dict(offsets)}
+                return _df
+            except OverflowError:
+                pass
+
+        _to_decimal = lambda x: Decimal(x)
+        for _column in numeric_columns:
+            df[_column] = df[_column].apply(_to_decimal)
+        for _column in cumsum_columns:
+            df[_column] = df[_column] + offsets[_column]
+        return df
+
     ### ドルバーテーブル関係の処理
+    # ティックバーなど他の種類のバーもドルバーと同じ列を持つ<bar_type>barテーブルに保存する
+    def get_bar_table_name(self, exchange, symbol, bar_type, interval):
+        return (f'{exchange}_{symbol}_{bar_type}bar_{interval}').lower()
+    
     def get_dollarbar_table_name(self, exchange, symbol, interval):
-        return (f'{exchange}_{symbol}_dollarbar_{interval}').lower()
+        return self.get_bar_table_name(exchange, symbol, 'dollar', interval)
     
-    def init_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000, force=False):    
-        _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
+    def init_bar_table(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=10_000_000, force=False):
+        _table_name = self.get_bar_table_name(exchange, symbol, bar_type, interval)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == False and force == False:
+        if self.table_exists(_table_name) == True and force == False:
             return
         
-        # ドルバー記録テーブルを作成
+        # バー記録テーブルを作成
         _sql = (f'DROP TABLE IF EXISTS "{_table_name}" CASCADE;'
                 f' CREATE TABLE IF NOT EXISTS "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, datetime_from TIMESTAMP WITH TIME ZONE NOT NULL, id text, id_from text, open NUMERIC NOT NULL, high NUMERIC NOT NULL, low NUMERIC NOT NULL, close NUMERIC NOT NULL, amount NUMERIC NOT NULL, dollar_volume NUMERIC NOT NULL, dollar_buy_volume NUMERIC NOT NULL, dollar_sell_volume NUMERIC NOT NULL, dollar_liquidation_buy_volume NUMERIC NOT NULL, dollar_liquidation_sell_volume NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, buy_dollar_cumsum NUMERIC NOT NULL, sell_dollar_cumsum NUMERIC NOT NULL, UNIQUE(datetime, id));'
                 f' CREATE INDEX ON "{_table_name}" (datetime DESC);'
                 f' CREATE INDEX ON "{_table_name}" (datetime DESC, dollar_cumsum);'
-                f" SELECT create_hypertable ('{_table_name}', 'datetime');")
-        self.sql_execute(_sql)
-        
+                f" SELECT create_hypertable ('\"{_table_name}\"', 'datetime');")
+        self._create_table(_table_name, _sql)
+    
+    def init_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000, force=False):
+        self.init_bar_table(exchange, symbol, 'dollar', interval, force)
+    
+    def get_latest_bar(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=5_000_000):
+        _table_name = self.get_bar_table_name(exchange, symbol, bar_type, interval)
+        return self._fetch_row_cached(_table_name, 'latest', f'SELECT * FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1')
+    
     def get_latest_dollarbar(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000):
+        return self.get_latest_bar(exchange, symbol, 'dollar', interval)
+
+    def insert_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_dollar_cumsum=None, till_dollar_cumsum=None):
+        """
+        約定テーブルからドルバーをDB上で集計し、INSERT ... SELECTの1文でドルバーテーブルに書き込む関数
+        約定をクライアントに転送しないので、DollarbarAccumulatorで集計するよりも通信量が少ない。
+        パラメータ
+        ----------
+        exchange : str, default = 'ftx'
+            取引所名。
+        symbol : str, default = 'BTC-PERP'
+            シンボル名。
+        interval : int, default = 5_000_000
+            ドルバーの金額。
+        from_dollar_cumsum : Decimal, default = None
+            この値より大きいdollar_cumsumを持つ約定を集計する。Noneの場合は最初の約定から集計する。
+        till_dollar_cumsum : Decimal, 必須
+            最新の約定のdollar_cumsum。この約定を含むドルバーは次の約定で続きが来るかもしれないので書き込まない。
+
+        返り値
+        -------
+        書き込んだドルバーの本数。
+        """
+        if till_dollar_cumsum is None:
+            raise ValueError(f'最新の約定のdollar_cumsumを指定してください')
+        _trade_table_name = self.get_trade_table_name(exchange, symbol)
         _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
-        
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
-            return None
-        
-        _df = self.read_sql_query(f'SELECT * FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1', dtype={'open': str, 'high': str, 'low': str, 'close': str, 'amount': str, 'dollar_volume': str, 'dollar_buy_volume': str, 'dollar_sell_volume': str, 'dollar_liquidation_buy_volume': str, 'dollar_liquidation_sell_volume': str, 'dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['open'] = _df['open'].apply(_to_decimal)
-            _df['high'] = _df['high'].apply(_to_decimal)
-            _df['low'] = _df['low'].apply(_to_decimal)
-            _df['close'] = _df['close'].apply(_to_decimal)
-            _df['amount'] = _df['amount'].apply(_to_decimal)
-            _df['dollar_volume'] = _df['dollar_volume'].apply(_to_decimal)
-            _df['dollar_buy_volume'] = _df['dollar_buy_volume'].apply(_to_decimal)
-            _df['dollar_sell_volume'] = _df['dollar_sell_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_buy_volume'] = _df['dollar_liquidation_buy_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_sell_volume'] = _df['dollar_liquidation_sell_volume'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['buy_dollar_cumsum'] = _df['buy_dollar_cumsum'].apply(_to_decimal)
-            _df['sell_dollar_cumsum'] = _df['sell_dollar_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
-
-    def load_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None):
-        _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
-        _sql = f"SELECT * FROM \"{_table_name}\" WHERE datetime >= '{from_str}' AND datetime < '{to_str}' ORDER BY dollar_cumsum ASC"
-        
-        _df = self.read_sql_query(sql = _sql)
-        _df = _df[['datetime', 'open', 'high', 'low', 'close', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']]
-        return _df
+        _interval = Decimal(interval)
+
+        # 最新の約定を含むドルバーより前の、確定したドルバーの約定だけを(dollar_cumsum, id)のインデックスで範囲指定して読む
+        _params = {'interval': _interval, 'till_dollar_cumsum': (Decimal(till_dollar_cumsum) // _interval) * _interval}
+        _where = 'dollar_cumsum < %(till_dollar_cumsum)s'
+        if from_dollar_cumsum is not None:
+            _where = f'dollar_cumsum > %(from_dollar_cumsum)s AND {_where}'
+            _params['from_dollar_cumsum'] = Decimal(from_dollar_cumsum)
+            _from_datetime = self.get_dollar_cumsum_datetime(exchange, symbol, from_dollar_cumsum)
+            if _from_datetime is not None:
+                _where = f'datetime >= %(from_datetime)s AND {_where}'
+                _params['from_datetime'] = _from_datetime.to_pydatetime()
+
+        # バーの最初と最後の約定はTimescaleDBのfirst/lastでdollar_cumsum順に選ぶ。フィルタ付きのsumは該当する約定がない場合に0にする
+        # バーのIDはdivで求める。numericの/は商を表示桁数に丸めるので、バーの境界の直前の約定が次のバーに入ることがある
+        _sql = (f'INSERT INTO "{_table_name}" (datetime, datetime_from, id, id_from, open, high, low, close, amount, dollar_volume, dollar_buy_volume, dollar_sell_volume, dollar_liquidation_buy_volume, dollar_liquidation_sell_volume, dollar_cumsum, buy_dollar_cumsum, sell_dollar_cumsum)'
+                f' SELECT last(datetime, dollar_cumsum), first(datetime, dollar_cumsum), last(id, dollar_cumsum), first(id, dollar_cumsum),'
+                f' first(price, dollar_cumsum), max(price), min(price), last(price, dollar_cumsum), sum(amount), sum(dollar),'
+                f" COALESCE(sum(dollar) FILTER (WHERE side = 'buy'), 0), COALESCE(sum(dollar) FILTER (WHERE side = 'sell'), 0),"
+                f" COALESCE(sum(dollar) FILTER (WHERE side = 'buy' AND liquidation), 0), COALESCE(sum(dollar) FILTER (WHERE side = 'sell' AND liquidation), 0),"
+                f' max(dollar_cumsum), last(buy_dollar_cumsum, dollar_cumsum), last(sell_dollar_cumsum, dollar_cumsum)'
+                f' FROM "{_trade_table_name}" WHERE {_where}'
+                f' GROUP BY div(dollar_cumsum, %(interval)s) ORDER BY div(dollar_cumsum, %(interval)s)'
+                f' ON CONFLICT DO NOTHING')
+
+        try:
+            with self._raw_connection() as _connection, _connection.cursor() as _cursor:
+                _cursor.execute(_sql, _params)
+                return _cursor.rowcount
+        finally:
+            self._invalidate_cache(_table_name)
+
+    def _copy_to_arrow(self, table_name, columns, from_str, to_str, order_by):
+        # 期間の絞り込みと並べ替えはDBで行い、COPY TO STDOUTのCSVをArrowのCSVリーダーで型を指定して一括で変換する
+        # 時刻はセッションのタイムゾーンや書式によらないように、UNIX時間のマイクロ秒の整数で受け取る
+        _selects = []
+        for _column in columns:
+            if _column in ['datetime', 'datetime_from']:
+                _selects.append(f"EXTRACT(EPOCH FROM date_trunc('second', {_column}))::int8 * 1000000 + mod(EXTRACT(MICROSECONDS FROM {_column})::int8, 1000000) AS {_column}")
+            else:
+                _selects.append(_column)
+        _conditions = []
+        _params = {}
+        if from_str is not None:
+            _conditions.append('datetime >= %(from)s')
+            _params['from'] = from_str
+        if to_str is not None:
+            _conditions.append('datetime < %(to)s')
+            _params['to'] = to_str
+        _where = '' if len(_conditions) <= 0 else ' WHERE ' + ' AND '.join(_conditions)
+
+        _buffer = io.BytesIO()
+        with self._raw_connection() as _connection, _connection.cursor() as _cursor:
+            _query = _cursor.mogrify(f'SELECT {", ".join(_selects)} FROM "{table_name}"{_where} ORDER BY {order_by}', _params).decode()
+            _cursor.copy_expert(f'COPY ({_query}) TO STDOUT WITH (FORMAT csv)', _buffer)
+        if _buffer.tell() <= 0:
+            return empty_load_table(columns)
+
+        _column_types = {_column: pa.int64() if get_load_type(_column) == LOAD_TIMESTAMP_TYPE else get_load_type(_column) for _column in columns}
+        _table = pa_csv.read_csv(pa.BufferReader(_buffer.getbuffer()),
+                                 read_options=pa_csv.ReadOptions(column_names=columns),
+                                 convert_options=pa_csv.ConvertOptions(column_types=_column_types, true_values=['t'], false_values=['f'], null_values=[''], strings_can_be_null=True, quoted_strings_can_be_null=False))
+        for _index, _column in enumerate(columns):
+            if get_load_type(_column) == LOAD_TIMESTAMP_TYPE:
+                _table = _table.set_column(_index, _column, _table[_column].cast(LOAD_TIMESTAMP_TYPE))
+        return _table
+
+    def load_trades(self, exchange='ftx', symbol='BTC-PERP', from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        """
+        約定履歴を期間で絞り込み、COPY TO STDOUTで一括して読み出す関数
+        数値列はDecimalではなくfloat64、時刻はマイクロ秒単位のUTCで返すので、分析用に大量の約定を読む場合に使う。
+        パラメータ
+        ----------
+        exchange : str, default = 'ftx'
+            取引所名。
+        symbol : str, default = 'BTC-PERP'
+            シンボル名。
+        from_str : str, default = None
+            この時刻以降の約定を読み出す。Noneの場合は最初の約定から。
+        to_str : str, default = None
+            この時刻より前の約定を読み出す。Noneの場合は最新の約定まで。
+        columns : list, default = None
+            読み出す列。Noneの場合は全ての列。
+        output : str, default = 'pandas'
+            'pandas'はデータフレーム、'numpy'は列名をキーとするnumpy.ndarrayのdict、'arrow'はpyarrow.Tableで返す。
+        cache_dir : str, default = None
+            指定した場合、読み出した結果をテーブル名と条件ごとにこのディレクトリにキャッシュし、次回からはキャッシュを読む。
+            to_strがNoneの場合はキャッシュしない。
+        refresh : bool, default = False
+            Trueの場合はキャッシュを使わずにDBから読み直し、キャッシュを更新する。
+
+        返り値
+        -------
+        dollar_cumsum, idの昇順に並んだ約定。
+        """
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        _columns = check_load_params(LOAD_TRADE_COLUMNS if columns is None else columns, LOAD_TRADE_COLUMNS, output)
+        return load_with_cache(cache_dir, _table_name, _columns, from_str, to_str, output, refresh,
+                               lambda: self._copy_to_arrow(_table_name, _columns, from_str, to_str, 'dollar_cumsum ASC, id ASC'))
+
+    def load_bars(self, exchange='ftx', symbol='BTC-PERP', bar_type='dollar', interval=5_000_000, from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        """
+        バーを期間で絞り込み、COPY TO STDOUTで一括して読み出す関数
+        columnsを指定しない場合はdatetime, OHLC, 出来高と累積和の列を返す。その他の引数と返り値はload_tradesと同じ。
+        """
+        _table_name = self.get_bar_table_name(exchange, symbol, bar_type, interval)
+        _columns = check_load_params(DEFAULT_BAR_COLUMNS if columns is None else columns, LOAD_BAR_COLUMNS, output)
+        return load_with_cache(cache_dir, _table_name, _columns, from_str, to_str, output, refresh,
+                               lambda: self._copy_to_arrow(_table_name, _columns, from_str, to_str, 'dollar_cumsum ASC'))
+    
+    def load_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None, columns=None, output='pandas', cache_dir=None, refresh=False):
+        return self.load_bars(exchange, symbol, 'dollar', interval, from_str, to_str, columns, output, cache_dir, refresh)
@@ -0,0 +1,123 @@
+import json
+
+from datetime import timezone, datetime
+
+import aiohttp
+import ccxt
+import ccxt.pro as ccxtpro
+
+def timestamp_to_iso8601(timestamp_ms):
+    """
+    ミリ秒のUNIX時刻をccxtと同じ形式の文字列(例: 2021-01-01T00:00:00.000Z)に変換する関数
+    """
+    _datetime = datetime.fromtimestamp(timestamp_ms // 1000, tz=timezone.utc).replace(microsecond=(timestamp_ms % 1000) * 1000)
+    return _datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+class TradeStream:
+    """
+    WebSocketで約定を受け取るクライアントのインターフェース
+    watch_tradesはccxtのfetch_tradesと同じ形式の約定のリストを返し、接続が切れた場合はConnectionErrorを送出する。
+    """
+    async def connect(self):
+        raise NotImplementedError
+
+    async def watch_trades(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class CcxtProTradeStream(TradeStream):
+    """
+    ccxt.proのwatch_tradesで約定を受け取るクラス
+    パラメータ
+    ----------
+    exchange : str, 必須
+        ccxt.proの取引所名。
+    symbol : str, 必須
+        シンボル名。例: BTC/USDT
+    """
+    def __init__(self, exchange = None, symbol = None):
+        if exchange == None or symbol == None:
+            raise ValueError(f'取引所名とシンボル名を指定してください : exchange={exchange}, symbol={symbol}')
+
+        self._exchange = exchange
+        self._symbol = symbol
+        self._client = None
+
+    async def connect(self):
+        self._client = getattr(ccxtpro, self._exchange)()
+
+    async def watch_trades(self):
+        try:
+            # ccxt.proはnewUpdatesが有効なので、前回の呼び出し以降に受け取った約定だけが返る
+            return list(await self._client.watch_trades(self._symbol))
+        except ccxt.NetworkError as e:
+            raise ConnectionError(str(e))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+class BinanceWebSocketTradeStream(TradeStream):
+    """
+    BinanceのTrade Streams(<symbol>@trade)をccxtを使わずに直接受け取るクラス
+    urlにローカルのWebSocketサーバーを指定すればテストできる。
+    パラメータ
+    ----------
+    symbol : str, 必須
+        シンボル名。例: BTC/USDT
+    url : str, default = 'wss://stream.binance.com:9443/ws'
+        接続先のURL。ストリーム名はこの後ろに付加する。
+    heartbeat : float, default = 30
+        pingを送る間隔(秒)。応答がない場合は接続が切れたとみなす。
+    """
+    def __init__(self, symbol = None, url = 'wss://stream.binance.com:9443/ws', heartbeat = 30):
+        if symbol == None:
+            raise ValueError(f'シンボル名を指定してください : {symbol}')
+
+        self._symbol = symbol
+        self._url = f'{url.rstrip("/")}/{symbol.replace("/", "").lower()}@trade'
+        self._heartbeat = heartbeat
+        self._session = None
+        self._ws = None
+
+    async def connect(self):
+        self._session = aiohttp.ClientSession()
+        try:
+            self._ws = await self._session.ws_connect(self._url, heartbeat=self._heartbeat)
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f'{self._url} : {e}')
+
+    def _parse_trade(self, message):
+        # 価格と数量は文字列のまま渡し、固定小数点への変換で丸め誤差が出ないようにする
+        return {
+            'info': message,
+            'id': str(message['t']),
+            'timestamp': message['T'],
+            'datetime': timestamp_to_iso8601(message['T']),
+            'symbol': self._symbol,
+            'side': 'sell' if message['m'] == True else 'buy',
+            'price': message['p'],
+            'amount': message['q'],
+        }
+
+    async def watch_trades(self):
+        _message = await self._ws.receive()
+        if _message.type == aiohttp.WSMsgType.TEXT:
+            _data = json.loads(_message.data)
+            if _data.get('e') == 'trade':
+                return [self._parse_trade(_data)]
+            return []
+        elif _message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+            raise ConnectionError(f'WebSocket closed : {self._url}')
+        return []
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
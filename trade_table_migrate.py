@@ -0,0 +1,51 @@
+import argparse
+import os
+
+from timescaledb_util import TimeScaleDBUtil
+from trades_download_util import TradesDownloadUtil
+
+def main():
+    _exchange_list = list(TradesDownloadUtil.trades_params.keys())
+
+    # Commandline arguments
+    parser = argparse.ArgumentParser(description='Configure chunk interval, compression and retention of an existing trade table in TimescaleDB')
+
+    parser.add_argument('exchange', help=f'exchange name. {_exchange_list}')
+    parser.add_argument('symbol', help='symbol name. Example: BTC/USD')
+    parser.add_argument('--chunk-time-interval', default=None, help="chunk interval for new chunks. Example: '1 day'. Defaults to the per exchange value")
+    parser.add_argument('--compress-after', default=None, help="compress chunks older than this. Example: '7 days'. Requires TimescaleDB 2.11 or later. Set it after the backfill has finished, since writes into compressed chunks are slow. Compression settings are left unchanged if omitted")
+    parser.add_argument('--drop-after', default=None, help="drop chunks older than this. Trades are kept forever if omitted")
+    parser.add_argument('--no-compress-now', action='store_true', help='only add the compression policy and leave existing chunks to the background job')
+    parser.add_argument('--no-scan', action='store_true', help='skip the full table scan used to report scan time before and after')
+
+    args = parser.parse_args()
+
+    if args.exchange not in _exchange_list:
+        print(f'{args.exchange} is not supported')
+        return
+
+    # PostgreSQL設定
+    _pg_config = {
+        'user': os.environ['POSTGRES_USER'],
+        'password': os.environ['POSTGRES_PASSWORD'],
+        'host': os.environ['POSTGRES_HOST'],
+        'port': os.environ['POSTGRES_PORT'],
+        'database': os.environ['POSTGRES_DATABASE']
+    }
+    _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'], compress_after = args.compress_after, drop_after = args.drop_after)
+
+    _report = _dbutil.migrate_trade_table(exchange=args.exchange, symbol=args.symbol, chunk_time_interval=args.chunk_time_interval, compress_now=not args.no_compress_now, measure_scan=not args.no_scan)
+
+    # 移行前後のサイズとスキャン時間を表示する
+    print(f"Table: {_report['table']}")
+    for _key in ['before', 'after']:
+        _values = _report[_key]
+        _line = f"{_key:>6}: size = {_values['total_bytes'] / 1024**3:.2f} GiB, chunks = {_values['chunks']} (compressed {_values['compressed_chunks']})"
+        if 'scan_seconds' in _values:
+            _line += f", scan = {_values['scan_seconds']:.2f} s"
+        print(_line)
+    if _report['before']['total_bytes'] > 0:
+        print(f"ratio : {_report['after']['total_bytes'] / _report['before']['total_bytes']:.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -4,35 +4,80 @@ import os
 from datetime import timezone, datetime
 
 from timescaledb_util import TimeScaleDBUtil
+from parquet_store_util import ParquetStoreUtil
 from trades_download_util import TradesDownloadUtil
+from metrics_util import profile
+from trade_stream_util import BinanceWebSocketTradeStream
 
 def main():
-    # PostgreSQL設定
-    _pg_config = {
-        'user': os.environ['POSTGRES_USER'],
-        'password': os.environ['POSTGRES_PASSWORD'],
-        'host': os.environ['POSTGRES_HOST'],
-        'port': os.environ['POSTGRES_PORT'],
-        'database': os.environ['POSTGRES_DATABASE']
-    }
-    
-    _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
-    _tradesutil = TradesDownloadUtil(_dbutil)
-    _exchange_list = list(_tradesutil.trades_params.keys())
+    _exchange_list = list(TradesDownloadUtil.trades_params.keys())
     
     # Commandline arguments
     parser = argparse.ArgumentParser(description='Download public trades from some Crypto CEX')
 
     parser.add_argument('exchange', help=f'exchange name. {_exchange_list}')
     parser.add_argument('symbol', help='symbol name. Example: BTC/USD')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent fetch workers for exchanges with time windowed trade API')
+    parser.add_argument('--stream', action='store_true', help='keep receiving trades over WebSocket after the download and append them in micro batches')
+    parser.add_argument('--stream-url', default=None, help='connect to this Binance compatible trade stream URL instead of using ccxt.pro. Example: wss://stream.binance.com:9443/ws')
+    parser.add_argument('--batch-interval', type=float, default=1.0, help='seconds between writes of streamed trades')
+    parser.add_argument('--bybit-chunk-rows', type=int, default=200_000, help='transform and write Bybit daily files in chunks of this many rows to keep memory flat. 0 reads each file at once')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve per stage timings and counters at http://0.0.0.0:<port>/metrics in Prometheus text format')
+    parser.add_argument('--metrics-log-interval', type=float, default=None, help='write per stage timings and counters to stderr as a JSON line every this many seconds')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    parser.add_argument('--parquet-dir', default=None, help='store trades in date partitioned Parquet files under this directory instead of TimescaleDB')
 
     args = parser.parse_args()
     
+    if args.parquet_dir is not None:
+        _dbutil = ParquetStoreUtil(args.parquet_dir)
+    else:
+        # PostgreSQL設定
+        _pg_config = {
+            'user': os.environ['POSTGRES_USER'],
+            'password': os.environ['POSTGRES_PASSWORD'],
+            'host': os.environ['POSTGRES_HOST'],
+            'port': os.environ['POSTGRES_PORT'],
+            'database': os.environ['POSTGRES_DATABASE']
+        }
+        _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
+    _tradesutil = TradesDownloadUtil(_dbutil, bybit_chunk_rows=args.bybit_chunk_rows if args.bybit_chunk_rows > 0 else None)
+    
     if args.exchange not in _exchange_list:
         print(f'{args.exchange} is not supported')
         return
+    
+    # 処理段階ごとの所要時間とカウンタの出力
+    if args.metrics_port is not None:
+        _tradesutil.metrics.start_http_server(args.metrics_port)
+    _metrics_log = None
+    if args.metrics_log_interval is not None:
+        _metrics_log = _tradesutil.metrics.start_json_log(args.metrics_log_interval)
+    
+    try:
+        if args.profile is not None:
+            with profile(args.profile):
+                _run(args, _dbutil, _tradesutil)
+        else:
+            _run(args, _dbutil, _tradesutil)
+    finally:
+        if _metrics_log is not None:
+            # 終了時点の集計値を書き出す
+            _metrics_log.set()
+            _tradesutil.metrics.log_json()
+
+def _run(args, dbutil, tradesutil):
+    tradesutil.download_trades(exchange=args.exchange, symbol=args.symbol, since_datetime=datetime(2019, 3, 5, 0, 0, 0, tzinfo=timezone.utc), concurrency=args.concurrency)
+
+    if args.stream == True:
+        _stream = BinanceWebSocketTradeStream(args.symbol, url=args.stream_url) if args.stream_url is not None else None
+        try:
+            tradesutil.stream_trades(exchange=args.exchange, symbol=args.symbol, stream=_stream, batch_interval=args.batch_interval)
+        except KeyboardInterrupt:
+            pass
 
-    _tradesutil.download_trades(exchange=args.exchange, symbol=args.symbol, since_datetime=datetime(2019, 3, 5, 0, 0, 0, tzinfo=timezone.utc))
+    if args.parquet_dir is not None:
+        dbutil.compact_partitions()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
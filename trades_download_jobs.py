@@ -0,0 +1,42 @@
+import argparse
+import os
+
+from timescaledb_util import TimeScaleDBUtil
+from parquet_store_util import ParquetStoreUtil
+from download_scheduler_util import TradesDownloadScheduler
+
+def main():
+    # Commandline arguments
+    parser = argparse.ArgumentParser(description='Download public trades of many exchanges and symbols in one process')
+
+    parser.add_argument('jobs', help='job list file. Each line is "exchange symbol" (Example: binance BTC/USDT), or a JSON list of {"exchange": ..., "symbol": ...}')
+    parser.add_argument('--max-workers', type=int, default=None, help='number of exchanges downloaded in parallel. Default is all exchanges in the job list')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent fetch workers for each symbol on exchanges with time windowed trade API')
+    parser.add_argument('--parquet-dir', default=None, help='store trades in date partitioned Parquet files under this directory instead of TimescaleDB')
+
+    args = parser.parse_args()
+
+    if args.parquet_dir is not None:
+        _dbutil = ParquetStoreUtil(args.parquet_dir)
+    else:
+        # PostgreSQL設定
+        _pg_config = {
+            'user': os.environ['POSTGRES_USER'],
+            'password': os.environ['POSTGRES_PASSWORD'],
+            'host': os.environ['POSTGRES_HOST'],
+            'port': os.environ['POSTGRES_PORT'],
+            'database': os.environ['POSTGRES_DATABASE']
+        }
+        _dbutil = TimeScaleDBUtil(user = _pg_config['user'], password = _pg_config['password'], host = _pg_config['host'], port = _pg_config['port'], database = _pg_config['database'])
+
+    _scheduler = TradesDownloadScheduler(_dbutil, max_workers=args.max_workers, concurrency=args.concurrency)
+    _results = _scheduler.run(TradesDownloadScheduler.load_jobs(args.jobs))
+
+    if args.parquet_dir is not None:
+        _dbutil.compact_partitions()
+
+    for _result in _results:
+        print(f"{_result['exchange']} {_result['symbol']}: {_result['status']} ({_result['elapsed']:.1f} sec)")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,28 @@
-from time import mktime, sleep
+from time import mktime
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
 import traceback
 
 from datetime import timezone, datetime, timedelta
 import dateutil.parser as dp
 from decimal import Decimal
-from math import ceil, floor
+import numpy as np
 import pandas as pd
 
+import aiohttp
 import ccxt
 
 from timescaledb_util import TimeScaleDBUtil
+from ratelimit_util import TokenBucketRateLimiter
+from bybit_archive_util import BybitArchivePrefetcher
+from window_controller_util import AdaptiveWindowController, WindowDensityStore
+from trade_stream_util import CcxtProTradeStream
+from write_behind_util import WriteBehindWriter
+from metrics_util import Metrics
+from fixedpoint_util import precision_to_scale, compute_dollar_cumsums, compute_dollar_cumsums_decimal, get_decimal_value
 
 class TradesDownloadUtil:
     trades_params = {
@@ -20,6 +32,7 @@ class TradesDownloadUtil:
             'start_adjustment_timeunit': Decimal(1_000_000),
             'start_adjustment': True,
             'ratelimit_multiplier': 1.2,
+            'keep_full_page': True,
         },
         'binance': {
             'limit': 1000,
@@ -27,6 +40,7 @@ class TradesDownloadUtil:
             'start_adjustment_timeunit': Decimal(1_000_000),
             'start_adjustment': True,
             'ratelimit_multiplier': 1.0,
+            'keep_full_page': True,
         },
         'bitfinex2': {
             'limit': 1000,
@@ -34,39 +48,160 @@ class TradesDownloadUtil:
             'start_adjustment_timeunit': Decimal(1_000_000),
             'start_adjustment': True,
             'ratelimit_multiplier': 1.2,
+            'keep_full_page': True,
         },
         'ftx': {
             'limit': 5000,
             'max_interval': Decimal(24*60*60*1_000_000_000),
             'start_adjustment_timeunit': Decimal(1_000_000_000),
             'start_adjustment': False,
-            'ratelimit_multiplier': 1.0
+            'ratelimit_multiplier': 1.0,
+            'keep_full_page': False,
         },
         'kraken': {
             'limit': 1000,
             'max_interval': Decimal(-1),
             'start_adjustment_timeunit': Decimal(1_000),
             'start_adjustment': True,
-            'ratelimit_multiplier': 1.0
+            'ratelimit_multiplier': 1.0,
+            'keep_full_page': False,
         },
         'poloniex': {
             'limit': 1000,
             'max_interval': Decimal(24*60*60*1_000_000_000),
             'start_adjustment_timeunit': Decimal(1_000_000_000),
             'start_adjustment': True,
-            'ratelimit_multiplier': 1.0
+            'ratelimit_multiplier': 1.0,
+            'keep_full_page': False,
         },
         'bybit': {
             'limit': 0,
             'max_interval': 0,
             'start_adjustment_timeunit': Decimal(0),
             'start_adjustment': False,
-            'ratelimit_multiplier': 1.0
+            'ratelimit_multiplier': 1.0,
+            'keep_full_page': False,
         }
     }
     
-    def __init__(self, dbutil=None):
+    def __init__(self, dbutil=None, bybit_prefetcher=None, ccxt_clients=None, rate_limiters=None, window_density_store=None, write_behind_rows=50_000, write_behind_delay=1.0, write_behind_queue_size=16, metrics=None, bybit_chunk_rows=200_000):
         self._dbutil = dbutil
+        self._bybit_prefetcher = bybit_prefetcher if bybit_prefetcher is not None else BybitArchivePrefetcher()
+        self._window_density_store = window_density_store if window_density_store is not None else WindowDensityStore()
+        self._ccxt_clients = ccxt_clients if ccxt_clients is not None else {}
+        self._rate_limiters = rate_limiters if rate_limiters is not None else {}
+        self._thread_local = threading.local()
+        self._trades_listeners = []
+        self._listener_errors = []
+        self._write_behind_params = {'max_rows': write_behind_rows, 'max_delay': write_behind_delay, 'max_queue_size': write_behind_queue_size}
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._bybit_chunk_rows = bybit_chunk_rows
+    
+    @property
+    def metrics(self):
+        """
+        処理段階ごとの所要時間とリクエスト数・行数などのカウンタを集計しているmetrics_util.Metrics
+        """
+        return self._metrics
+    
+    @property
+    def listener_errors(self):
+        """
+        add_trades_listenerで登録した関数で発生した例外の(exchange, symbol, listener, exception)のリスト
+        """
+        return list(self._listener_errors)
+    
+    def add_trades_listener(self, listener):
+        """
+        約定のバッチを約定テーブルに書き込むたびに呼ばれる関数を登録する関数
+        パラメータ
+        ----------
+        listener : callable, 必須
+            listener(exchange, symbol, df)の形で、書き込んだ順に呼ばれる。dfは約定テーブルと同じ列を持つデータフレーム。
+            書き込みスレッドから呼ばれる。例外を送出した関数は、以降のバッチを受け取れず結果が正しくなくなるので登録を解除し、例外をlistener_errorsに記録する。
+            約定のダウンロードと書き込みはそのまま続ける。
+        """
+        self._trades_listeners.append(listener)
+    
+    def remove_trades_listener(self, listener):
+        """
+        add_trades_listenerで登録した関数の登録を解除する関数
+        """
+        if listener in self._trades_listeners:
+            self._trades_listeners.remove(listener)
+    
+    # 約定のバッチを約定テーブルに書き込み、登録された関数に渡す。再開位置のチェックポイントは書き込みと同じトランザクションで更新する
+    def _write_trades(self, exchange, symbol, trade_table_name, df, bybit_file_date=None):
+        _checkpoint = {
+            'exchange': exchange,
+            'symbol': symbol,
+            'datetime': pd.Timestamp(df.iloc[-1]['datetime']),
+            'id': df.iloc[-1]['id'],
+            'dollar_cumsum': get_decimal_value(df, 'dollar_cumsum'),
+            'buy_dollar_cumsum': get_decimal_value(df, 'buy_dollar_cumsum'),
+            'sell_dollar_cumsum': get_decimal_value(df, 'sell_dollar_cumsum'),
+            'bybit_file_date': bybit_file_date,
+        }
+        with self._metrics.timer('db_insert', exchange=exchange, symbol=symbol):
+            self._dbutil.df_to_sql(df=df, schema=trade_table_name, if_exists = 'append', checkpoint=_checkpoint)
+        self._metrics.inc('rows_written', len(df), exchange=exchange, symbol=symbol)
+        for _listener in list(self._trades_listeners):
+            try:
+                _listener(exchange, symbol, df)
+            except Exception as e:
+                # 約定は書き込み済みなので、関数の例外でダウンロードを止めない
+                print(f'Trades listener failed and was removed : {traceback.format_exc()}')
+                self._metrics.inc('listener_errors', exchange=exchange, symbol=symbol)
+                self._listener_errors.append((exchange, symbol, _listener, e))
+                self.remove_trades_listener(_listener)
+    
+    # 取引所ごとのccxtクライアントを取得する。マーケット情報の読み込みは最初の1回だけ行う
+    def _get_ccxt_client(self, exchange):
+        if exchange not in self._ccxt_clients:
+            _ccxt_client = getattr(ccxt, exchange)()
+            _ccxt_client.load_markets()
+            self._ccxt_clients[exchange] = _ccxt_client
+        return self._ccxt_clients[exchange]
+    
+    # 取引所ごとのレートリミッタを取得する。同じ取引所の全てのシンボルのダウンロードで共有する
+    def _get_rate_limiter(self, exchange, capacity=1):
+        if exchange not in self._rate_limiters:
+            self._rate_limiters[exchange] = TokenBucketRateLimiter.from_ccxt_client(self._get_ccxt_client(exchange), self.trades_params[exchange]['ratelimit_multiplier'], capacity=capacity)
+        return self._rate_limiters[exchange]
+    
+    # ダウンロードした約定のバッチを、書き込みスレッドでまとめて書き込むライタを作る。write_behind_queue_sizeが0の場合はその場で書き込む
+    def _create_trades_writer(self):
+        return WriteBehindWriter(self._write_trades_batch, **self._write_behind_params)
+    
+    def _write_trades_batch(self, key, df, bybit_file_date):
+        _exchange, _symbol, _trade_table_name = key
+        self._write_trades(_exchange, _symbol, _trade_table_name, df, bybit_file_date=bybit_file_date)
+    
+    # ダウンロードの再開位置を返す。チェックポイントがない場合(チェックポイント導入前のテーブル)は最新の約定を使う
+    def _get_resume_trade(self, exchange, symbol):
+        with self._metrics.timer('db_read', exchange=exchange, symbol=symbol):
+            _checkpoint = self._dbutil.get_trade_checkpoint(exchange, symbol)
+            if _checkpoint is not None:
+                return _checkpoint
+            return self._dbutil.get_latest_trade(exchange, symbol)
+    
+    # レートリミッタのトークンを待ってからfetch_tradesを呼び、待ち時間・通信時間・リクエスト数・行数を記録する
+    def _fetch_trades(self, ccxt_client, exchange, symbol, params, rate_limiter):
+        self._metrics.observe('ratelimit_wait', rate_limiter.acquire(), exchange=exchange)
+        self._metrics.inc('requests', exchange=exchange, symbol=symbol)
+        try:
+            with self._metrics.timer('http_fetch', exchange=exchange):
+                _result = ccxt_client.fetch_trades(symbol, params=params)
+        except ccxt.NetworkError:
+            self._metrics.inc('retries', exchange=exchange, symbol=symbol)
+            raise
+        self._metrics.inc('rows_fetched', len(_result), exchange=exchange, symbol=symbol)
+        return _result
+    
+    # 書き込みキューに約定のバッチを入れる。キューがいっぱいで待った時間を書き込みの詰まりとして記録する
+    def _put_trades(self, writer, exchange, symbol, trade_table_name, df, bybit_file_date=None):
+        with self._metrics.timer('write_queue_wait', exchange=exchange):
+            writer.put((exchange, symbol, trade_table_name), df, bybit_file_date)
     
     # ダウンロード時に利用するパラメータの作成
     def _get_fetch_trades_params(self, exchange=None, start_timestamp=None, end_timestamp=None):
@@ -104,7 +239,7 @@ class TradesDownloadUtil:
         return params
     
     # 約定情報のダウンロード
-    def download_trades(self, exchange=None, symbol=None, since_datetime=None):
+    def download_trades(self, exchange=None, symbol=None, since_datetime=None, concurrency=1):
         if exchange is None or symbol is None:
             return
         elif exchange == 'bybit':
@@ -113,11 +248,12 @@ class TradesDownloadUtil:
         
         # 取引所情報の取得
         _exchange = exchange
-        _ccxt_client = getattr(ccxt, _exchange)()
-        _ccxt_client.load_markets()
+        _ccxt_client = self._get_ccxt_client(_exchange)
         _ccxt_market = _ccxt_client.market(symbol)
         _price_precision = _ccxt_market['precision']['price']
         _amount_precision = _ccxt_market['precision']['amount']
+        _price_scale = precision_to_scale(_price_precision)
+        _amount_scale = precision_to_scale(_amount_precision)
         
         # 約定テーブルを初期化
         self._dbutil.init_trade_table(_exchange, symbol, force=False)
@@ -130,7 +266,7 @@ class TradesDownloadUtil:
         _sell_dollar_cumsum_offset = Decimal(0)
 
         # 約定データがDBにすでにあるならば最も新しい約定を取得して開始時間として設定
-        _latest_trade = self._dbutil.get_latest_trade(_exchange, symbol)
+        _latest_trade = self._get_resume_trade(_exchange, symbol)
         if _latest_trade is not None:
             _since_datetime = _latest_trade['datetime'] + timedelta(seconds=float(self.trades_params[exchange]['start_adjustment_timeunit']/1_000_000_000))
             _dollar_cumsum_offset = Decimal(_latest_trade['dollar_cumsum'])
@@ -149,93 +285,71 @@ class TradesDownloadUtil:
 
         _total_seconds_nsec = _till_timestamp_nsec - _since_timestamp_nsec
         
-        # 初期のダウンロード間隔は30分ごと
+        # 時間指定でダウンロードできる取引所では、期間を分割して並列にダウンロードできる
+        if concurrency > 1 and self.trades_params[exchange]['max_interval'] > 0:
+            self._download_trades_concurrent(_ccxt_client, _exchange, symbol, _trade_table_name, _since_timestamp_nsec, _till_timestamp_nsec, _dollar_cumsum_offset, _buy_dollar_cumsum_offset, _sell_dollar_cumsum_offset, concurrency, _price_scale, _amount_scale)
+            return
+        
+        # 時間指定でダウンロードできる取引所では、取得期間を約定の頻度から予測しながらページごとに書き込む
         if self.trades_params[exchange]['max_interval'] > 0:
-            _interval_nsec = Decimal(30*60*1_000_000_000)
-            _end_timestamp_nsec = _start_timestamp_nsec + _interval_nsec
-        else:
-            # 最大間隔が0以下の場合、間隔は利用せず、終了時間は最終終了時間を設定する
-            _interval_nsec = Decimal(-1)
-            _end_timestamp_nsec = _till_timestamp_nsec
+            _controller = self._create_window_controller(exchange, self._window_density_store.get(_exchange, symbol))
+            with tqdm(total = int(_total_seconds_nsec), initial=0) as _pbar, self._create_trades_writer() as _writer:
+                try:
+                    for _result, _next_timestamp_nsec in self._iter_trade_pages(_ccxt_client, exchange, symbol, _since_timestamp_nsec, _till_timestamp_nsec, _controller, self._get_rate_limiter(exchange)):
+                        if len(_result) > 0:
+                            # もし1個以上のデータがダウンロードされていたら、データベースに書き込む
+                            _df = self._trades_to_dataframe(_result, _dollar_cumsum_offset, _buy_dollar_cumsum_offset, _sell_dollar_cumsum_offset, _price_scale, _amount_scale)
+                            
+                            # 書き込みは書き込みスレッドに任せ、すぐに次のページを取得する
+                            self._put_trades(_writer, _exchange, symbol, _trade_table_name, _df)
+                            
+                            _dollar_cumsum_offset = get_decimal_value(_df, 'dollar_cumsum')
+                            _buy_dollar_cumsum_offset = get_decimal_value(_df, 'buy_dollar_cumsum')
+                            _sell_dollar_cumsum_offset = get_decimal_value(_df, 'sell_dollar_cumsum')
+                        
+                        # プログレスバーを更新
+                        _pbar.set_postfix_str(f'{_exchange}, {symbol}, start: {datetime.utcfromtimestamp(float(_next_timestamp_nsec/1_000_000_000))}, trades/sec: {_controller.trades_per_second or 0:.03f}, row_counts: {len(_result)}')
+                        _pbar.n = int(min(_next_timestamp_nsec, _till_timestamp_nsec)-_since_timestamp_nsec)
+                        _pbar.refresh()
+                    
+                    # 書き込み待ちの約定を全て書き込む
+                    _writer.close()
+                except ccxt.ExchangeError as e:
+                    print(f'ccxt.ExchangeError : {e}')
+                except:
+                    print(f'Other exceptions : {traceback.format_exc()}')
+                finally:
+                    # 学習した約定の頻度を次回の実行の最初の取得期間に使う
+                    self._window_density_store.set(_exchange, symbol, _controller.trades_per_second)
+            return
         
-        with tqdm(total = int(_total_seconds_nsec), initial=0) as _pbar:
+        # 最大間隔が0以下の場合、間隔は利用せず、終了時間は最終終了時間を設定する
+        _end_timestamp_nsec = _till_timestamp_nsec
+        
+        with tqdm(total = int(_total_seconds_nsec), initial=0) as _pbar, self._create_trades_writer() as _writer:
             while _start_timestamp_nsec < _till_timestamp_nsec:
                 try:
-                    sleep(_ccxt_client.rateLimit * self.trades_params[exchange]['ratelimit_multiplier'] / 1000)
-                    
-                    # 取得最大間隔が0よりも大きい場合、今回のダウンロードの終了時間を更新する
-                    if self.trades_params[exchange]['max_interval'] > 0:
-                        _end_timestamp_nsec = _start_timestamp_nsec+_interval_nsec
-                    
                     _params = self._get_fetch_trades_params(exchange, _start_timestamp_nsec, _end_timestamp_nsec)
-                    _result = _ccxt_client.fetch_trades(symbol, params=_params)
-
-                    if self.trades_params[exchange]['max_interval'] > 0 and len(_result) >= self.trades_params[exchange]['limit']:
-                        # もし取得間隔を利用するダウンロードで、取得した約定の件数がAPIの返す個数の上限値と同じか大きかったら、取得間隔を短くして再取得する
-                        _interval_nsec = max(Decimal(1), floor(_interval_nsec*Decimal(0.5)))
-                        _interval_nsec = int(_interval_nsec // self.trades_params[exchange]['start_adjustment_timeunit']) * self.trades_params[exchange]['start_adjustment_timeunit']
-
-                        # プログレスバーを更新
-                        _pbar.set_postfix_str(f'{_exchange}, {symbol}, start: {datetime.utcfromtimestamp(float(_start_timestamp_nsec/1_000_000_000))}, interval: {_interval_nsec/1_000_000_000:.03f}, row_counts: {len(_result)}')
-                        _pbar.refresh()
-                        continue
+                    _result = self._fetch_trades(_ccxt_client, exchange, symbol, _params, self._get_rate_limiter(exchange))
                     
                     if len(_result) > 0:
-                        # _resultにliquidationの情報を付加する
-                        for _item in _result:
-                            if 'liquidation' in _item['info']:
-                                _item['liquidation'] = _item['info']['liquidation']
-                            else:
-                                _item['liquidation'] = False
-
                         # もし1個以上のデータがダウンロードされていたら、データベースに書き込む
-                        _to_decimal = lambda x: Decimal(x)
+                        _df = self._trades_to_dataframe(_result, _dollar_cumsum_offset, _buy_dollar_cumsum_offset, _sell_dollar_cumsum_offset, _price_scale, _amount_scale)
                         
-                        _df = pd.DataFrame.from_dict(_result, dtype=str)
-                        _df = _df[['datetime', 'id', 'side', 'liquidation', 'price', 'amount']].sort_values('datetime', ascending=True).sort_values('id', ascending=True)
+                        self._put_trades(_writer, _exchange, symbol, _trade_table_name, _df)
                         
-                        _df['buy_dollar'] = Decimal(0)
-                        _df['sell_dollar'] = Decimal(0)
-                        
-                        _df['price'] = _df['price'].apply(_to_decimal)
-                        _df['amount'] = _df['amount'].apply(_to_decimal)
-                        _df['dollar'] = _df['price'] * _df['amount']
-                        _df['dollar_cumsum'] = _df['dollar'].cumsum() + _dollar_cumsum_offset
-                        
-                        _df.loc[_df['side'] == 'buy', 'buy_dollar'] = _df['dollar']
-                        _df.loc[_df['side'] == 'sell', 'sell_dollar'] = _df['dollar']
-                        _df['buy_dollar_cumsum'] = _df['buy_dollar'].cumsum() + _buy_dollar_cumsum_offset
-                        _df['sell_dollar_cumsum'] = _df['sell_dollar'].cumsum() + _sell_dollar_cumsum_offset
-                        
-                        _df.drop(['buy_dollar', 'sell_dollar'], axis=1, inplace=True)
-                        
-                        self._dbutil.df_to_sql(df=_df, schema=_trade_table_name, if_exists = 'append')
-                        
-                        _dollar_cumsum_offset = _df.iloc[-1]['dollar_cumsum']
-                        _buy_dollar_cumsum_offset = _df.iloc[-1]['buy_dollar_cumsum']
-                        _sell_dollar_cumsum_offset = _df.iloc[-1]['sell_dollar_cumsum']
+                        _dollar_cumsum_offset = get_decimal_value(_df, 'dollar_cumsum')
+                        _buy_dollar_cumsum_offset = get_decimal_value(_df, 'buy_dollar_cumsum')
+                        _sell_dollar_cumsum_offset = get_decimal_value(_df, 'sell_dollar_cumsum')
                         
                     # プログレスバーを更新
-                    _pbar.set_postfix_str(f'{_exchange}, {symbol}, start: {datetime.utcfromtimestamp(float(_start_timestamp_nsec/1_000_000_000))}, interval: {_interval_nsec/1_000_000_000:.03f}, row_counts: {len(_result)}')
-                    if self.trades_params[exchange]['max_interval'] > 0:
-                        _pbar.n = int(_end_timestamp_nsec-_since_timestamp_nsec)
-                    else:
-                        if len(_result) > 0:                    
-                            _pbar.n = int(Decimal(dp.parse(_df.iloc[-1]['datetime']).timestamp()).quantize(Decimal('0.000001'))*1_000_000_000-_since_timestamp_nsec)
+                    _pbar.set_postfix_str(f'{_exchange}, {symbol}, start: {datetime.utcfromtimestamp(float(_start_timestamp_nsec/1_000_000_000))}, row_counts: {len(_result)}')
+                    if len(_result) > 0:                    
+                        _pbar.n = int(Decimal(dp.parse(_df.iloc[-1]['datetime']).timestamp()).quantize(Decimal('0.000001'))*1_000_000_000-_since_timestamp_nsec)
                     _pbar.refresh()
                     
-                    # 約定データの取得間隔を調整
-                    if self.trades_params[exchange]['max_interval'] > 0:
-                        if len(_result) < self.trades_params[exchange]['limit']*0.9:
-                            _interval_nsec = min(self.trades_params[exchange]['max_interval'], ceil(_interval_nsec / self.trades_params[exchange]['start_adjustment_timeunit'] * Decimal(1.05)) * self.trades_params[exchange]['start_adjustment_timeunit'])
-                            _interval_nsec = int(_interval_nsec // self.trades_params[exchange]['start_adjustment_timeunit']) * self.trades_params[exchange]['start_adjustment_timeunit']
-                        if self.trades_params[exchange]['start_adjustment'] is True:
-                            _start_timestamp_nsec = _end_timestamp_nsec + self.trades_params[exchange]['start_adjustment_timeunit']
-                        else:
-                            _start_timestamp_nsec = _end_timestamp_nsec
-                    else:
-                        if exchange == 'kraken':
-                            _start_timestamp_nsec = Decimal(_df.iloc[-1]['id'])
+                    if exchange == 'kraken':
+                        _start_timestamp_nsec = Decimal(_df.iloc[-1]['id'])
                 except ccxt.NetworkError as e:
                     print(f'ccxt.NetworkError : {e}')
                     pass
@@ -246,12 +360,316 @@ class TradesDownloadUtil:
                     print(f'Other exceptions : {traceback.format_exc()}')
                     break
     
+    # 取引所の取得件数の上限と取得期間の上限から、取得期間を決めるコントローラを作る
+    # 上限件数に達したページを捨てない取引所では、ページが埋まるように長めの期間を予測する
+    def _create_window_controller(self, exchange, trades_per_second=None):
+        _trades_params = self.trades_params[exchange]
+        _target_fill = 2.0 if _trades_params['keep_full_page'] is True else 0.8
+        return AdaptiveWindowController(_trades_params['limit'], _trades_params['max_interval'], _trades_params['start_adjustment_timeunit'], trades_per_second, target_fill=_target_fill)
+    
+    # [start_timestamp_nsec, end_timestamp_nsec) の約定を、取得期間をcontrollerで決めながら1リクエスト分ずつ返すジェネレータ
+    # 返り値は(約定のリスト, 次のリクエストの開始時刻)。上限件数に達したページは、古い順に返す取引所(keep_full_page)では捨てずに最後の約定の時刻から続きを取得する
+    def _iter_trade_pages(self, ccxt_client, exchange, symbol, start_timestamp_nsec, end_timestamp_nsec, controller, rate_limiter):
+        _trades_params = self.trades_params[exchange]
+        _timeunit_nsec = _trades_params['start_adjustment_timeunit']
+        _start_adjustment_nsec = _timeunit_nsec if _trades_params['start_adjustment'] is True else Decimal(0)
+        
+        # 前のページの最後の約定と同じ時刻の約定ID。続きのページの先頭に同じ約定が含まれるので取り除く
+        _boundary_ids = set()
+        _start_timestamp_nsec = start_timestamp_nsec
+        
+        while _start_timestamp_nsec < end_timestamp_nsec:
+            _end_timestamp_nsec = max(_start_timestamp_nsec, min(_start_timestamp_nsec + controller.next_interval(), end_timestamp_nsec - _start_adjustment_nsec))
+            _params = self._get_fetch_trades_params(exchange, _start_timestamp_nsec, _end_timestamp_nsec)
+            
+            try:
+                _result = self._fetch_trades(ccxt_client, exchange, symbol, _params, rate_limiter)
+            except ccxt.NetworkError as e:
+                print(f'ccxt.NetworkError : {e}')
+                continue
+            
+            _full = len(_result) >= _trades_params['limit']
+            if _full and _trades_params['keep_full_page'] is False and _end_timestamp_nsec - _start_timestamp_nsec > _timeunit_nsec:
+                # ページの順序がわからない取引所では、取得期間を短くして再取得する
+                controller.update(len(_result), _end_timestamp_nsec - _start_timestamp_nsec, full=True, discarded=True)
+                self._metrics.inc('discarded_full_pages', exchange=exchange, symbol=symbol)
+                continue
+            
+            _page = [_trade for _trade in _result if _trade['id'] not in _boundary_ids]
+            _boundary_ids = set()
+            
+            if _full and _trades_params['keep_full_page'] is True:
+                # 最後の約定の時刻から続きを取得する。同じ時刻の約定は次のページにも含まれるのでIDを覚えておく
+                _last_timestamp_nsec = Decimal(_result[-1]['timestamp']) * 1_000_000
+                if _last_timestamp_nsec > _start_timestamp_nsec:
+                    _boundary_ids = set([_trade['id'] for _trade in _result if _trade['timestamp'] == _result[-1]['timestamp']])
+                    controller.update(len(_result), _last_timestamp_nsec - _start_timestamp_nsec, full=True)
+                    _start_timestamp_nsec = _last_timestamp_nsec
+                else:
+                    # 1つの時刻に上限件数以上の約定がある場合は時刻を進めるしかない
+                    print(f'More than {_trades_params["limit"]} trades at {datetime.utcfromtimestamp(float(_start_timestamp_nsec/1_000_000_000))}. Some trades may be skipped.')
+                    controller.update(len(_result), _timeunit_nsec, full=True)
+                    _start_timestamp_nsec = _start_timestamp_nsec + _timeunit_nsec
+            else:
+                controller.update(len(_result), _end_timestamp_nsec - _start_timestamp_nsec + _start_adjustment_nsec, full=_full)
+                _start_timestamp_nsec = _end_timestamp_nsec + _start_adjustment_nsec
+            
+            yield _page, _start_timestamp_nsec
+    
+    # ccxtのfetch_tradesの結果を約定テーブルと同じ列を持つデータフレームに変換する
+    def _trades_to_dataframe(self, result, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset, price_scale=0, amount_scale=0):
+        # resultにliquidationの情報を付加する
+        for _item in result:
+            if 'liquidation' in _item['info']:
+                _item['liquidation'] = _item['info']['liquidation']
+            else:
+                _item['liquidation'] = False
+
+        with self._metrics.timer('transform'):
+            _df = pd.DataFrame.from_dict(result, dtype=str)
+            _df = _df[['datetime', 'id', 'side', 'liquidation', 'price', 'amount']].sort_values('datetime', ascending=True).sort_values('id', ascending=True)
+        
+        # 金額の計算は固定小数点の整数演算で行い、int64に収まらない場合だけDecimalで計算する
+        with self._metrics.timer('decimal_conversion'):
+            try:
+                return compute_dollar_cumsums(_df, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset, price_scale, amount_scale)
+            except OverflowError:
+                return compute_dollar_cumsums_decimal(_df, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset)
+    
+    # ワーカースレッドごとのccxtクライアントを取得する。マーケット情報はメインスレッドのクライアントから引き継ぐ
+    def _get_thread_ccxt_client(self, ccxt_client):
+        _clients = getattr(self._thread_local, 'ccxt_clients', None)
+        if _clients is None:
+            _clients = {}
+            self._thread_local.ccxt_clients = _clients
+        
+        if ccxt_client.id not in _clients:
+            # リクエスト間隔は共有のレートリミッタで制御するので、ccxt側のレート制限は無効にする
+            _client = type(ccxt_client)({'enableRateLimit': False})
+            _client.set_markets(ccxt_client.markets, ccxt_client.currencies)
+            _clients[ccxt_client.id] = _client
+        return _clients[ccxt_client.id]
+    
+    # [start_timestamp_nsec, end_timestamp_nsec) の範囲の約定を取得期間を調整しながらすべて取得する
+    def _fetch_trades_shard(self, ccxt_client, exchange, symbol, start_timestamp_nsec, end_timestamp_nsec, rate_limiter, trades_per_second=None):
+        _ccxt_client = self._get_thread_ccxt_client(ccxt_client)
+        _controller = self._create_window_controller(exchange, trades_per_second)
+        
+        _trades = []
+        for _result, _ in self._iter_trade_pages(_ccxt_client, exchange, symbol, start_timestamp_nsec, end_timestamp_nsec, _controller, rate_limiter):
+            _trades.extend(_result)
+        
+        return _trades, _controller.requests, _controller.trades_per_second
+    
+    # 期間をシャードに分割して並列に取得し、取得したシャードを古い順にデータベースに書き込む
+    def _download_trades_concurrent(self, ccxt_client, exchange, symbol, trade_table_name, since_timestamp_nsec, till_timestamp_nsec, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset, concurrency, price_scale=0, amount_scale=0):
+        _trades_params = self.trades_params[exchange]
+        _rate_limiter = self._get_rate_limiter(exchange, capacity=concurrency)
+        _trades_per_second = self._window_density_store.get(exchange, symbol)
+        
+        # シャードの境界はstart_adjustment_timeunitの倍数に揃える
+        _shard_nsec = Decimal(int(_trades_params['max_interval'] // _trades_params['start_adjustment_timeunit'])) * _trades_params['start_adjustment_timeunit']
+        _shards = []
+        _shard_start_nsec = since_timestamp_nsec
+        while _shard_start_nsec < till_timestamp_nsec:
+            # 最後のシャードは終了時刻までにする
+            _shards.append((_shard_start_nsec, min(_shard_start_nsec + _shard_nsec, till_timestamp_nsec)))
+            _shard_start_nsec += _shard_nsec
+        
+        _total_seconds_nsec = till_timestamp_nsec - since_timestamp_nsec
+        with tqdm(total = int(_total_seconds_nsec), initial=0) as _pbar, ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='trades-fetch') as _executor, self._create_trades_writer() as _writer:
+            _pending = deque()
+            _shard_iter = iter(_shards)
+            
+            # 取得済みで書き込み待ちのシャードがメモリを圧迫しないように、同時に投入するシャード数を制限する
+            for _shard in _shard_iter:
+                _pending.append((_shard, _executor.submit(self._fetch_trades_shard, ccxt_client, exchange, symbol, _shard[0], _shard[1], _rate_limiter, _trades_per_second)))
+                if len(_pending) >= concurrency * 2:
+                    break
+            
+            while len(_pending) > 0:
+                _shard, _future = _pending.popleft()
+                try:
+                    _result, _requests, _shard_trades_per_second = _future.result()
+                except Exception as e:
+                    # 失敗したシャードより後の約定を書き込むと約定の抜けができるので、ここまでで止めて次回はチェックポイントから再開する
+                    if isinstance(e, ccxt.ExchangeError):
+                        print(f'ccxt.ExchangeError : {e}')
+                    else:
+                        print(f'Other exceptions : {traceback.format_exc()}')
+                    for _, _other_future in _pending:
+                        _other_future.cancel()
+                    break
+                
+                # 後続のシャードは直前のシャードで学習した約定の頻度から取得期間を決める
+                if _shard_trades_per_second is not None:
+                    _trades_per_second = _shard_trades_per_second
+                
+                _next_shard = next(_shard_iter, None)
+                if _next_shard is not None:
+                    _pending.append((_next_shard, _executor.submit(self._fetch_trades_shard, ccxt_client, exchange, symbol, _next_shard[0], _next_shard[1], _rate_limiter, _trades_per_second)))
+                
+                if len(_result) > 0:
+                    _df = self._trades_to_dataframe(_result, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset, price_scale, amount_scale)
+                    self._put_trades(_writer, exchange, symbol, trade_table_name, _df)
+                    
+                    dollar_cumsum_offset = get_decimal_value(_df, 'dollar_cumsum')
+                    buy_dollar_cumsum_offset = get_decimal_value(_df, 'buy_dollar_cumsum')
+                    sell_dollar_cumsum_offset = get_decimal_value(_df, 'sell_dollar_cumsum')
+                
+                # プログレスバーを更新
+                _pbar.set_postfix_str(f'{exchange}, {symbol}, start: {datetime.utcfromtimestamp(float(_shard[0]/1_000_000_000))}, workers: {concurrency}, requests: {_requests}, row_counts: {len(_result)}')
+                _pbar.n = int(min(_shard[1], till_timestamp_nsec) - since_timestamp_nsec)
+                _pbar.refresh()
+        
+        self._window_density_store.set(exchange, symbol, _trades_per_second)
+    
+    # 約定IDの大小比較に使うキー。数字だけのIDは数値として比較する
+    def _get_trade_id_key(self, trade_id):
+        _trade_id = str(trade_id)
+        return (0, int(_trade_id), '') if _trade_id.isdigit() else (1, 0, _trade_id)
+    
+    # データベースに書き込み済みの最新の約定から、ストリームで受け取った約定の書き込みに必要な状態を作る
+    def _get_stream_state(self, exchange, symbol):
+        _state = {'timestamp': None, 'id': None, 'offsets': [Decimal(0), Decimal(0), Decimal(0)]}
+        _latest_trade = self._get_resume_trade(exchange, symbol)
+        if _latest_trade is not None:
+            _state['timestamp'] = int(pd.Timestamp(_latest_trade['datetime']).value // 1_000_000)
+            _state['id'] = self._get_trade_id_key(_latest_trade['id'])
+            _state['offsets'] = [Decimal(_latest_trade[_column]) for _column in ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']]
+        return _state
+    
+    # 受け取った約定のうち書き込み済みの約定より新しいものを書き込み、書き込んだ件数を返す
+    def _write_stream_batch(self, exchange, symbol, trades, state, trade_table_name, price_scale=0, amount_scale=0):
+        _trades = [_trade for _trade in trades if state['timestamp'] is None or _trade['timestamp'] > state['timestamp'] or (_trade['timestamp'] == state['timestamp'] and self._get_trade_id_key(_trade['id']) > state['id'])]
+        if len(_trades) <= 0:
+            return 0
+        
+        _last_trade = max(_trades, key=lambda _trade: (_trade['timestamp'], self._get_trade_id_key(_trade['id'])))
+        _df = self._trades_to_dataframe(_trades, *state['offsets'], price_scale, amount_scale)
+        self._write_trades(exchange, symbol, trade_table_name, _df)
+        
+        state['timestamp'] = _last_trade['timestamp']
+        state['id'] = self._get_trade_id_key(_last_trade['id'])
+        state['offsets'] = [get_decimal_value(_df, _column) for _column in ['dollar_cumsum', 'buy_dollar_cumsum', 'sell_dollar_cumsum']]
+        return len(_trades)
+    
+    # バッファの約定をイベントループのスレッドで取り出し、DBへの書き込みは別スレッドで行う。書き込み中もストリームの受信とpingの応答を止めない
+    async def _flush_stream_buffer(self, exchange, symbol, buffer, state, trade_table_name, price_scale, amount_scale):
+        _trades = list(buffer)
+        buffer.clear()
+        return await asyncio.to_thread(self._write_stream_batch, exchange, symbol, _trades, state, trade_table_name, price_scale, amount_scale)
+    
+    # ストリームから約定を受け取ってバッファに追加し続ける。バッファがmax_batch_size件に達したらbatch_readyで知らせる
+    async def _receive_trades(self, stream, buffer, batch_ready, max_batch_size):
+        while True:
+            buffer.extend(await stream.watch_trades())
+            if len(buffer) >= max_batch_size:
+                batch_ready.set()
+    
+    # 約定のストリーミング
+    def stream_trades(self, exchange=None, symbol=None, stream=None, since_datetime=None, batch_interval=1.0, max_batch_size=1000, reconnect_wait=1.0, duration=None):
+        """
+        WebSocketで受け取った約定を、取引額の累積和をつなげながら少しずつ約定テーブルに書き込む関数
+        接続するたびに、接続前に取りこぼした約定をdownload_tradesでRESTから取得してからストリームの約定を書き込む。
+        パラメータ
+        ----------
+        exchange : str, 必須
+            取引所名。
+        symbol : str, 必須
+            シンボル名。例: BTC/USDT
+        stream : TradeStream, default = None
+            約定を受け取るクライアント。Noneの場合はccxt.proのwatch_tradesを使う。
+        since_datetime : datetime, default = None
+            約定テーブルが空の場合にRESTで取得を始める時刻。Noneの場合は現在時刻から始める。
+        batch_interval : float, default = 1.0
+            受け取った約定を書き込む間隔(秒)。
+        max_batch_size : int, default = 1000
+            この件数の約定を受け取った場合は、batch_intervalを待たずに書き込む。
+        reconnect_wait : float, default = 1.0
+            接続が切れてから再接続するまでの待ち時間(秒)。再接続に失敗するたびに倍になる(最大60秒)。
+        duration : float, default = None
+            ストリーミングを続ける秒数。Noneの場合は終了しない。
+
+        返り値
+        -------
+        int
+            ストリームから書き込んだ約定の件数。RESTで取得した約定は含まない。
+        """
+        if exchange is None or symbol is None:
+            raise ValueError(f'取引所名とシンボル名を指定してください : exchange={exchange}, symbol={symbol}')
+        if stream is None:
+            stream = CcxtProTradeStream(exchange, symbol)
+        if since_datetime is None:
+            since_datetime = datetime.now(timezone.utc)
+        
+        return asyncio.run(self._stream_trades_async(exchange, symbol, stream, since_datetime, batch_interval, max_batch_size, reconnect_wait, duration))
+    
+    async def _stream_trades_async(self, exchange, symbol, stream, since_datetime, batch_interval, max_batch_size, reconnect_wait, duration):
+        # 取引所情報の取得
+        _ccxt_market = self._get_ccxt_client(exchange).market(symbol)
+        _price_scale = precision_to_scale(_ccxt_market['precision']['price'])
+        _amount_scale = precision_to_scale(_ccxt_market['precision']['amount'])
+        
+        # 約定テーブルを初期化
+        self._dbutil.init_trade_table(exchange, symbol, force=False)
+        _trade_table_name = self._dbutil.get_trade_table_name(exchange, symbol)
+        
+        _loop = asyncio.get_running_loop()
+        _deadline = None if duration is None else _loop.time() + duration
+        _reconnect_wait = reconnect_wait
+        _written = 0
+        
+        while _deadline is None or _loop.time() < _deadline:
+            _buffer = []
+            _batch_ready = asyncio.Event()
+            _receiver = None
+            _state = None
+            try:
+                # 接続してから受け取った約定はバッファに貯めておき、接続前の約定をRESTで取得し終えてから書き込む
+                await stream.connect()
+                _receiver = asyncio.create_task(self._receive_trades(stream, _buffer, _batch_ready, max_batch_size))
+                await asyncio.to_thread(self.download_trades, exchange, symbol, since_datetime)
+                _state = self._get_stream_state(exchange, symbol)
+                _reconnect_wait = reconnect_wait
+                
+                while _deadline is None or _loop.time() < _deadline:
+                    _timeout = batch_interval if _deadline is None else max(0, min(batch_interval, _deadline - _loop.time()))
+                    try:
+                        await asyncio.wait_for(_batch_ready.wait(), _timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    _batch_ready.clear()
+                    
+                    _written += await self._flush_stream_buffer(exchange, symbol, _buffer, _state, _trade_table_name, _price_scale, _amount_scale)
+                    if _receiver.done():
+                        # 接続が切れた場合は例外を送出して再接続する
+                        _receiver.result()
+                        break
+            except (ConnectionError, OSError, aiohttp.ClientError, ccxt.NetworkError) as e:
+                print(f'Trade stream disconnected : {e}')
+                self._metrics.inc('stream_reconnects', exchange=exchange, symbol=symbol)
+                # 切断前に受け取った約定は書き込んでおく。足りない約定は再接続時にRESTで取得する
+                if _state is not None:
+                    _written += await self._flush_stream_buffer(exchange, symbol, _buffer, _state, _trade_table_name, _price_scale, _amount_scale)
+                await asyncio.sleep(_reconnect_wait)
+                _reconnect_wait = min(_reconnect_wait * 2, 60)
+            finally:
+                if _receiver is not None:
+                    _receiver.cancel()
+                    try:
+                        await _receiver
+                    except (asyncio.CancelledError, Exception):
+                        pass
+                await stream.close()
+        
+        return _written
+    
     def download_bybit_trades(self, exchange=None, symbol=None, since_datetime=None):
         # 取引所情報の取得
         _exchange = exchange
         _symbol = symbol
-        _ccxt_client = getattr(ccxt, _exchange)()
-        _ccxt_client.load_markets()
+        _ccxt_client = self._get_ccxt_client(_exchange)
         _ccxt_market = _ccxt_client.market(_symbol)
         _price_precision = _ccxt_market['precision']['price']
         _amount_precision = _ccxt_market['precision']['amount']
@@ -261,65 +679,173 @@ class TradesDownloadUtil:
         _trade_table_name = self._dbutil.get_trade_table_name(_exchange, _symbol)
         
         # 各種設定
-        _target_baseurl = 'https://public.bybit.com/trading'
         _exchange_symbol = _symbol.replace('/', '')
 
-        _latest_trade = self._dbutil.get_latest_trade(_exchange, _symbol)
+        _latest_trade = self._get_resume_trade(_exchange, _symbol)
         if _latest_trade is not None:
-            _since_datetime = _latest_trade['datetime'] + timedelta(days=1)
-            _since_datetime = _since_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+            # チェックポイントに最後に書き込み終えたファイルの日付があれば、その翌日から再開する
+            # ない場合は最後の約定の日付のファイルから読み直す。どちらの場合も書き込み済みの約定は_resume_tradeで読み飛ばす
+            _since_datetime = _latest_trade.get('bybit_file_date')
+            if _since_datetime is None:
+                _since_datetime = _latest_trade['datetime']
+            else:
+                _since_datetime = _since_datetime + timedelta(days=1)
+            _since_datetime = pd.Timestamp(_since_datetime).floor('D')
+            _resume_trade = _latest_trade
             _dollar_cumsum_offset = Decimal(_latest_trade['dollar_cumsum'])
+            _buy_dollar_cumsum_offset = Decimal(_latest_trade['buy_dollar_cumsum'])
+            _sell_dollar_cumsum_offset = Decimal(_latest_trade['sell_dollar_cumsum'])
             print('Dowload will resume after this last trade in DB')
             print(_since_datetime)
         else:
             _since_datetime = dp.parse('2019-10-01 00:00:00.000+00')
             _dollar_cumsum_offset = Decimal(0)
+            _buy_dollar_cumsum_offset = Decimal(0)
+            _sell_dollar_cumsum_offset = Decimal(0)
+            _resume_trade = None
 
+        # 今日の0時(UTC)より前の日付のファイルを順に処理する
         _now = datetime.now(timezone.utc)
         _end_datetime = datetime(_now.year, _now.month, _now.day, 0, 0, 0, tzinfo=timezone.utc)    
+        _target_dates = []
         _target_datetime = _since_datetime
+        while _target_datetime < _end_datetime:
+            _target_dates.append(_target_datetime)
+            _target_datetime = _target_datetime + timedelta(days=1)
         
-        with tqdm(total = mktime(_end_datetime.timetuple())*1_000_000 - mktime(_since_datetime.timetuple())*1_000_000, initial=0) as _pbar:
-            while True:
-                # 終了条件判定
-                _now = datetime.now(timezone.utc)
-                _end_datetime = datetime(_now.year, _now.month, _now.day, 0, 0, 0, tzinfo=timezone.utc)
-
+        _has_trades = _latest_trade is not None
+        with tqdm(total = mktime(_end_datetime.timetuple())*1_000_000 - mktime(_since_datetime.timetuple())*1_000_000, initial=0) as _pbar, self._create_trades_writer() as _writer:
+            # 後続の日付のファイルはワーカースレッドでキャッシュに先読みし、ここでは日付順に読み込んで書き込む
+            for _target_datetime, _target_path in self._bybit_prefetcher.iter_files(_exchange_symbol, _target_dates):
                 _pbar.n = mktime(_target_datetime.timetuple())*1_000_000 - mktime(_since_datetime.timetuple())*1_000_000
                 _pbar.set_postfix_str(f'Exchange: {_exchange}, Symbol: {_symbol}, Date = {_target_datetime}')
+                _pbar.refresh()
 
-                if _target_datetime >= _end_datetime:
-                    # すでに今日までのデータを読み終わっている
+                if _target_path is None:
+                    # シンボルの最初のファイルより前の日付は読み飛ばす。約定を書き込んだ後に欠けている日付で止め、次回はその日付から再開する
+                    # 読み飛ばして先に進むと、その日の約定が後から公開されても取得されないまま累積和がつながってしまう
+                    if _has_trades == False:
+                        print(f'Bybit archive for {_exchange_symbol} {_target_datetime.date()} does not exist. Skipped.')
+                        continue
+                    print(f'Bybit archive for {_exchange_symbol} {_target_datetime.date()} does not exist yet. Download will resume from this date.')
                     break
+                _has_trades = True
 
-                # Bybitのファイル名を生成
-                _target_url = f'{_target_baseurl}/{_exchange_symbol}/{_exchange_symbol}{_target_datetime.year:04d}-{_target_datetime.month:02d}-{_target_datetime.day:02d}.csv.gz'
-
-                # CSVファイルをデータフレームとしてダウンロード
-                try:
-                    _df = pd.read_csv(_target_url, compression='gzip', dtype='str')
-                except:
-                    # 何らかの例外が発生したので3秒待ってリトライ
-                    sleep(3)
-                    continue
-
-                # データフレームの加工
-                _df.sort_values('timestamp', inplace=True)
-                _df['datetime'] = pd.to_datetime(_df['timestamp'].apply(float), unit='s').dt.tz_localize('UTC')
-                _df.reset_index(drop=True, inplace=True)
-                _df['side'] = _df['side'].str.lower()
-                _df['size'] = _df['foreignNotional'].apply(Decimal)
-                _df['price'] = _df['price'].apply(Decimal)
-                _df['liquidation'] = False # BybitはLiquidation情報を持っていないがFalseとして付け加えておく
-                _df['dollar'] = _df['homeNotional'].apply(Decimal)
-                _df['dollar_cumsum'] = _df['dollar'].cumsum() + _dollar_cumsum_offset
-                _df.drop(['timestamp', 'symbol', 'tickDirection', 'grossValue', 'homeNotional', 'foreignNotional'], axis=1, inplace=True) # 必要ない列を削除
-                _df.columns = ['side', 'amount', 'price', 'id', 'datetime', 'liquidation', 'dollar', 'dollar_cumsum']
-                _df = _df.reindex(['datetime', 'id', 'side', 'liquidation', 'price', 'amount', 'dollar', 'dollar_cumsum'], axis=1)
-
+                # キャッシュしたCSVファイルを一定行数ずつ読み込み、累積和のオフセットを引き継ぎながら加工して書き込む
+                # 日付のチェックポイントはファイルの最後のチャンクでだけ更新し、途中で止まった場合は_resume_tradeの次の約定から再開する
+                _df = None
+                for _chunk in self._iter_bybit_csv_chunks(_exchange, _target_path):
+                    self._metrics.inc('rows_fetched', len(_chunk), exchange=_exchange, symbol=_symbol)
+                    _chunk, _resume_trade = self._skip_written_bybit_trades(_chunk, _resume_trade, _target_datetime)
+                    if _df is not None and len(_df) > 0:
+                        self._put_trades(_writer, _exchange, _symbol, _trade_table_name, _df)
+                    _df = self._bybit_trades_to_dataframe(_chunk, _dollar_cumsum_offset, _buy_dollar_cumsum_offset, _sell_dollar_cumsum_offset)
+                    if len(_df) > 0:
+                        _dollar_cumsum_offset = get_decimal_value(_df, 'dollar_cumsum')
+                        _buy_dollar_cumsum_offset = get_decimal_value(_df, 'buy_dollar_cumsum')
+                        _sell_dollar_cumsum_offset = get_decimal_value(_df, 'sell_dollar_cumsum')
 
-                self._dbutil.df_to_sql(df=_df, schema=_trade_table_name, if_exists = 'append')
+                if self._is_bybit_resume_file(_resume_trade, _target_datetime):
+                    # 書き込み済みの約定と同じファイルが読めていないので、続きを書き込むと累積和がずれる
+                    raise ValueError(f'再開位置の約定 {_resume_trade["id"]} がBybitのファイル {_target_path} に見つかりません')
+                if _df is not None and len(_df) > 0:
+                    self._put_trades(_writer, _exchange, _symbol, _trade_table_name, _df, _target_datetime)
+    
+    _bybit_csv_columns = ['timestamp', 'side', 'price', 'trdMatchID', 'homeNotional', 'foreignNotional']
+    # 価格と数量は固定小数点に正確に変換するため文字列のまま読み込む
+    _bybit_csv_dtypes = {'timestamp': 'float64', 'side': 'str', 'price': 'str', 'trdMatchID': 'str', 'homeNotional': 'str', 'foreignNotional': 'str'}
+    
+    # BybitのCSVファイルを必要な列だけ、bybit_chunk_rows行ずつ返す
+    # チャンクごとに前のチャンクの最後の約定から続けてtimestamp順に並んでいるかを確認しながら読むので、ファイルの大きさによらずメモリ使用量が一定になる
+    # 並んでいない約定が見つかった場合は、その直前までをファイルの順序のまま返し、残りはファイル全体を読み込んでtimestamp順に並べ替えて返す
+    # 返す順序はチャンクの行数によらず同じになるので、途中で止まっても次回は同じ順序で再開できる。bybit_chunk_rowsがNoneの場合はファイル全体を並べ替える
+    def _iter_bybit_csv_chunks(self, exchange, path):
+        _chunk_rows = self._bybit_chunk_rows
+        _read_params = {'compression': 'gzip', 'usecols': self._bybit_csv_columns, 'dtype': self._bybit_csv_dtypes}
+        _yielded = 0
+        if _chunk_rows is not None:
+            _last_timestamp = -np.inf
+            with pd.read_csv(path, chunksize=_chunk_rows, **_read_params) as _reader:
+                while True:
+                    with self._metrics.timer('csv_read', exchange=exchange):
+                        _chunk = next(_reader, None)
+                    if _chunk is None:
+                        return
+                    _timestamps = _chunk['timestamp'].to_numpy()
+                    _unsorted = (_timestamps < np.concatenate([[_last_timestamp], _timestamps[:-1]])).nonzero()[0]
+                    if len(_unsorted) > 0:
+                        if _unsorted[0] > 0:
+                            yield _chunk.iloc[:_unsorted[0]]
+                        _yielded += int(_unsorted[0])
+                        break
+                    yield _chunk
+                    _yielded += len(_chunk)
+                    _last_timestamp = _timestamps[-1]
 
-                _target_datetime = _target_datetime + timedelta(days=1)
-                if len(_df) > 0:
-                    _dollar_cumsum_offset = _df.iloc[-1]['dollar_cumsum']
\ No newline at end of file
+        with self._metrics.timer('csv_read', exchange=exchange):
+            _df = pd.read_csv(path, **_read_params)
+        # 同じtimestampの約定はファイル内の順序を保つ
+        _df = _df.iloc[_yielded:].sort_values('timestamp', kind='stable')
+        _step = len(_df) if _chunk_rows is None else _chunk_rows
+        for _start in range(0, len(_df), max(_step, 1)):
+            yield _df.iloc[_start:_start + _step]
+    
+    # 再開位置の約定がfile_dateのファイルに含まれるかを返す。Bybitのファイルは日付(UTC)ごとなので、約定の日付で判定する
+    @staticmethod
+    def _is_bybit_resume_file(resume_trade, file_date):
+        if resume_trade is None:
+            return False
+        _dates = [pd.Timestamp(_datetime) for _datetime in [resume_trade['datetime'], file_date]]
+        _dates = [(_date.tz_localize('UTC') if _date.tzinfo is None else _date.tz_convert('UTC')).floor('D') for _date in _dates]
+        return _dates[0] == _dates[1]
+    
+    # ファイルの途中まで書き込んで止まった場合に、書き込み済みの約定を読み飛ばす
+    # resume_tradeはチェックポイントの最後の約定。それを含むファイルでは、_iter_bybit_csv_chunksの返す順序でその約定までを除く
+    # 並んでいないファイルはtimestamp順に返らないので、時刻ではなく順序で判定する必要がある
+    # それより前の日付のファイルでは、resume_trade以前の時刻の約定を除く
+    # resume_tradeより後の約定が見つかったら以降は読み飛ばさないのでNoneを返す
+    @classmethod
+    def _skip_written_bybit_trades(cls, chunk, resume_trade, file_date=None):
+        if resume_trade is None or len(chunk) <= 0:
+            return chunk, resume_trade
+        if file_date is not None and cls._is_bybit_resume_file(resume_trade, file_date):
+            _positions = (chunk['trdMatchID'].to_numpy() == resume_trade['id']).nonzero()[0]
+            if len(_positions) > 0:
+                return chunk.iloc[_positions[-1] + 1:], None
+            return chunk.iloc[0:0], resume_trade
+        _datetimes = pd.to_datetime(chunk['timestamp'], unit='s', utc=True).dt.round('us')
+        _resume_datetime = pd.Timestamp(resume_trade['datetime']).round('us')
+        _keep = (_datetimes > _resume_datetime).to_numpy(copy=True)
+        _same = (_datetimes == _resume_datetime).to_numpy()
+        if _same.any():
+            _ids = chunk['trdMatchID'].to_numpy()
+            _positions = (_same & (_ids == resume_trade['id'])).nonzero()[0]
+            if len(_positions) > 0:
+                # チェックポイントの約定より後ろにある同時刻の約定は書き込まれていない
+                _keep[_positions[-1] + 1:] |= _same[_positions[-1] + 1:]
+                return chunk[_keep], None
+        if _keep.all():
+            return chunk, None
+        if _keep.any():
+            return chunk[_keep], None
+        return chunk.iloc[0:0], resume_trade
+    
+    # BybitのCSVファイル(_iter_bybit_csv_chunksの返す順序)を約定テーブルと同じ列を持つデータフレームに変換する
+    def _bybit_trades_to_dataframe(self, df, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset):
+        with self._metrics.timer('transform'):
+            _df = pd.DataFrame({
+                'datetime': pd.to_datetime(pd.to_numeric(df['timestamp']), unit='s', utc=True),
+                'id': df['trdMatchID'],
+                'side': df['side'].str.lower(),
+                'liquidation': False, # BybitはLiquidation情報を持っていないがFalseとして付け加えておく
+                'price': df['price'],
+                'amount': df['foreignNotional'],
+                'dollar': df['homeNotional'],
+            }).reset_index(drop=True)
+        
+        # dollarはCSVのhomeNotionalをそのまま使い、累積和は固定小数点の整数演算で計算する
+        with self._metrics.timer('decimal_conversion'):
+            try:
+                return compute_dollar_cumsums(_df, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset)
+            except OverflowError:
+                return compute_dollar_cumsums_decimal(_df, dollar_cumsum_offset, buy_dollar_cumsum_offset, sell_dollar_cumsum_offset)
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import timezone, datetime
+from decimal import Decimal
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsではプロセス間のロックは行わない
+    fcntl = None
+
+# 同じファイルに保存するWindowDensityStoreで共有するロック
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+def _get_path_lock(path):
+    with _path_locks_lock:
+        return _path_locks.setdefault(path, threading.Lock())
+
+class AdaptiveWindowController:
+    """
+    時間指定で約定を取得するAPIの取得期間を、直近の約定の頻度(件/秒)から決めるクラス
+    1回のリクエストで返る約定の件数が上限のtarget_fill倍程度になるように期間を予測する。
+    パラメータ
+    ----------
+    limit : int, 必須
+        1回のリクエストで返る約定の上限件数。
+    max_interval : Decimal, 必須
+        取得期間の上限(ナノ秒)。
+    timeunit : Decimal, 必須
+        取得期間の単位(ナノ秒)。取得期間はこの倍数に揃える。
+    trades_per_second : float, default = None
+        前回までに学習した約定の頻度。Noneの場合は最初の取得期間を30分にする。
+    target_fill : float, default = 0.8
+        1回のリクエストで取得したい件数の、上限件数に対する割合。
+    smoothing : float, default = 0.5
+        上限に達しなかったリクエストで観測した頻度を反映する割合(指数移動平均の係数)。
+    """
+    def __init__(self, limit = None, max_interval = None, timeunit = None, trades_per_second = None, target_fill = 0.8, smoothing = 0.5):
+        if limit == None or limit <= 0:
+            raise ValueError(f'上限件数には正の値を指定してください : {limit}')
+        if max_interval == None or max_interval <= 0:
+            raise ValueError(f'取得期間の上限には正の値を指定してください : {max_interval}')
+        if timeunit == None or timeunit <= 0:
+            raise ValueError(f'取得期間の単位には正の値を指定してください : {timeunit}')
+
+        self._limit = limit
+        self._max_interval = Decimal(max_interval)
+        self._timeunit = Decimal(timeunit)
+        self._trades_per_second = trades_per_second
+        self._target_fill = target_fill
+        self._smoothing = smoothing
+        self._requests = 0
+
+    @property
+    def trades_per_second(self):
+        return self._trades_per_second
+
+    @property
+    def requests(self):
+        return self._requests
+
+    def next_interval(self):
+        """
+        次のリクエストの取得期間(ナノ秒)を返す関数
+        """
+        if self._trades_per_second is None:
+            _interval = Decimal(30*60*1_000_000_000)
+        elif self._trades_per_second <= 0:
+            _interval = self._max_interval
+        else:
+            _interval = Decimal(self._target_fill * self._limit / self._trades_per_second * 1_000_000_000)
+
+        _interval = min(self._max_interval, _interval)
+        return max(self._timeunit, Decimal(int(_interval // self._timeunit)) * self._timeunit)
+
+    def update(self, trade_count = 0, covered_interval = None, full = False, discarded = False):
+        """
+        リクエストの結果から約定の頻度を更新する関数
+        パラメータ
+        ----------
+        trade_count : int, default = 0
+            取得した約定の件数。
+        covered_interval : Decimal, 必須
+            取得した約定がカバーしている期間(ナノ秒)。上限件数に達した場合は開始時刻から最後の約定までの期間。
+        full : bool, default = False
+            取得した件数が上限件数に達したかどうか。
+        discarded : bool, default = False
+            上限件数に達した結果を使わずに取得し直すかどうか。この場合の頻度は下限値でしかないので、頻度を2倍以上に見積もる。
+        """
+        self._requests += 1
+        _observed = trade_count / float(max(Decimal(covered_interval), self._timeunit) / 1_000_000_000)
+        if discarded == True:
+            self._trades_per_second = max(self._trades_per_second or 0.0, _observed * 2)
+        elif full == True or self._trades_per_second is None:
+            # 上限に達したページの最後の約定までの期間は、実際の頻度をそのまま表している
+            self._trades_per_second = _observed
+        else:
+            self._trades_per_second = (1 - self._smoothing) * self._trades_per_second + self._smoothing * _observed
+
+class WindowDensityStore:
+    """
+    AdaptiveWindowControllerが学習した約定の頻度を取引所とシンボルごとにJSONファイルに保存し、次回の実行で使うクラス
+    パラメータ
+    ----------
+    path : str, default = '~/.cache/crypto_trades_downloader/window_density.json'
+        保存先のファイルパス。同じファイルに保存するインスタンスやプロセスの間では、書き込みを排他して互いの頻度を消さない。
+    """
+    def __init__(self, path = '~/.cache/crypto_trades_downloader/window_density.json'):
+        self._path = os.path.abspath(os.path.expanduser(path))
+        self._lock = _get_path_lock(self._path)
+
+    def _get_key(self, exchange, symbol):
+        return f'{exchange}/{symbol}'
+
+    def _read(self):
+        if os.path.exists(self._path) == False:
+            return {}
+        try:
+            with open(self._path, 'r') as _f:
+                return json.load(_f)
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def _write_lock(self):
+        # 同じプロセスのスレッドはパスごとのロックで、別のプロセスはロックファイルで排他する
+        with self._lock:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(f'{self._path}.lock', 'a') as _f:
+                if fcntl is not None:
+                    fcntl.flock(_f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(_f.fileno(), fcntl.LOCK_UN)
+
+    def get(self, exchange = None, symbol = None):
+        """
+        保存されている約定の頻度(件/秒)を返す関数。ない場合はNone
+        """
+        with self._lock:
+            _entry = self._read().get(self._get_key(exchange, symbol))
+        return None if _entry is None else _entry['trades_per_second']
+
+    def set(self, exchange = None, symbol = None, trades_per_second = None):
+        """
+        約定の頻度(件/秒)を保存する関数
+        """
+        if trades_per_second is None:
+            return
+        with self._write_lock():
+            _densities = self._read()
+            _densities[self._get_key(exchange, symbol)] = {'trades_per_second': trades_per_second, 'updated_at': datetime.now(timezone.utc).isoformat()}
+
+            # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+            _tmp_path = f'{self._path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(_tmp_path, 'w') as _f:
+                json.dump(_densities, _f, indent=2, sort_keys=True)
+            os.replace(_tmp_path, self._path)
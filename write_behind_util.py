@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+
+from fixedpoint_util import concat_fixedpoint
+
+class WriteBehindWriter:
+    """
+    データフレームをキューに入れ、書き込みスレッドで行数か時間の単位にまとめて書き込むクラス
+    キューがいっぱいの場合はputが待つので、書き込みが取得より遅い場合は取得側が書き込みに合わせて遅くなる。
+    パラメータ
+    ----------
+    write : callable, 必須
+        write(key, df, context)の形で書き込みスレッドから呼ばれる関数。dfは同じkeyで続けてputされたデータフレームをつなげたもの、contextはその中で最後にputされたNoneでないもの。
+    max_rows : int, default = 50_000
+        1回の書き込みにまとめる行数の目安。この行数に達したらすぐに書き込む。
+    max_delay : float, default = 1.0
+        最初のデータフレームをキューから受け取ってから書き込むまでの最大の待ち時間(秒)。
+    max_queue_size : int, default = 16
+        書き込み待ちのデータフレームの最大数。0の場合はスレッドを使わずputの中で書き込む。
+    """
+    _CLOSE = object()
+
+    def __init__(self, write = None, max_rows = 50_000, max_delay = 1.0, max_queue_size = 16):
+        if write == None:
+            raise ValueError(f'書き込みを行う関数を指定してください')
+        if max_queue_size < 0:
+            raise ValueError(f'max_queue_sizeには0以上を指定してください : {max_queue_size}')
+
+        self._write = write
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._failed = False
+        self._closed = False
+
+        if max_queue_size > 0:
+            self._queue = queue.Queue(maxsize=max_queue_size)
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 例外で抜ける場合は書き込みスレッドの例外で上書きしない
+        self.close(raise_error = exc_type is None)
+        return False
+
+    def _raise_error(self):
+        if self._error is not None:
+            _error = self._error
+            self._error = None
+            raise _error
+
+    def put(self, key = None, df = None, context = None):
+        """
+        データフレームを書き込み待ちのキューに入れる関数。書き込みスレッドで例外が発生していた場合はその例外を送出する
+        パラメータ
+        ----------
+        key : hashable, 必須
+            書き込み先を表すキー。keyが同じデータフレームだけをまとめて書き込む。
+        df : pandas.DataFrame, 必須
+            書き込むデータフレーム。
+        context : object, default = None
+            writeにそのまま渡す値。後からcontextがNoneのデータフレームとまとめて書き込む場合も、この値を渡す。
+        """
+        if self._closed == True:
+            raise ValueError('WriteBehindWriterは既に閉じられています')
+        self._raise_error()
+        if self._failed == True:
+            raise IOError('書き込みに失敗したため、これ以上書き込めません')
+        if df is None or len(df) <= 0:
+            return
+
+        if self._queue is None:
+            self._write(key, df, context)
+            return
+
+        # キューに空きができるまで待つ。その間に書き込みスレッドが停止していたら例外を送出する
+        while True:
+            try:
+                self._queue.put((key, df, context), timeout=1.0)
+                return
+            except queue.Full:
+                self._raise_error()
+
+    def close(self, raise_error = True):
+        """
+        キューに残っているデータフレームを全て書き込んでから書き込みスレッドを終了する関数
+        """
+        if self._closed == True:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(self._CLOSE)
+            self._thread.join()
+        if raise_error == True:
+            self._raise_error()
+
+    def _flush(self, key, dfs, context):
+        if len(dfs) > 0:
+            self._write(key, concat_fixedpoint(dfs), context)
+
+    def _run(self):
+        _item = None
+        while True:
+            if _item is None:
+                _item = self._queue.get()
+            if _item is self._CLOSE:
+                return
+
+            # 同じキーのデータフレームを、行数がmax_rowsに達するかmax_delay秒経つまでまとめる
+            _key, _df, _context = _item
+            _dfs = [_df]
+            _rows = len(_df)
+            _deadline = time.monotonic() + self._max_delay
+            _item = None
+            while _rows < self._max_rows:
+                try:
+                    _next = self._queue.get(timeout=max(0, _deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if _next is self._CLOSE or _next[0] != _key:
+                    _item = _next
+                    break
+                _dfs.append(_next[1])
+                # BybitのファイルのようにcontextがNoneのデータフレームが続いても、前のデータフレームのcontext(ファイルの日付)を失わない
+                if _next[2] is not None:
+                    _context = _next[2]
+                _rows += len(_next[1])
+
+            try:
+                # 書き込みに失敗した後のデータフレームは、書き込むと約定の抜けができるので捨てる
+                if self._failed == False:
+                    self._flush(_key, _dfs, _context)
+            except Exception as e:
+                # 例外はputかcloseで取得側のスレッドに送出する
+                self._failed = True
+                self._error = e